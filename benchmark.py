@@ -0,0 +1,589 @@
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import mysql.connector
+
+import sqldiff
+
+# 合成字段类型: (COLUMN_TYPE, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, NUMERIC_PRECISION, NUMERIC_SCALE, DATETIME_PRECISION)
+COLUMN_TYPES = (
+    ('int(11)', 'int', None, 10, 0, None),
+    ('bigint(20)', 'bigint', None, 19, 0, None),
+    ('varchar(32)', 'varchar', 32, None, None, None),
+    ('varchar(255)', 'varchar', 255, None, None, None),
+    ('decimal(10,2)', 'decimal', None, 10, 2, None),
+    ('datetime', 'datetime', None, None, None, 0),
+    ('text', 'text', 65535, None, None, None),
+)
+
+PHASES = ('load', 'model', 'diff', 'render')
+
+
+def make_column(column_name, position, column_type):
+    """
+    合成 COLUMNS 的一行（字段名 -> 值）
+    """
+    column_type, data_type, max_length, precision, scale, datetime_precision = column_type
+    character = max_length is not None
+    return {
+        'COLUMN_NAME': column_name,
+        'ORDINAL_POSITION': position,
+        'COLUMN_DEFAULT': None,
+        'IS_NULLABLE': 'YES',
+        'DATA_TYPE': data_type,
+        'CHARACTER_MAXIMUM_LENGTH': max_length,
+        'CHARACTER_OCTET_LENGTH': max_length * 4 if character else None,
+        'NUMERIC_PRECISION': precision,
+        'NUMERIC_SCALE': scale,
+        'DATETIME_PRECISION': datetime_precision,
+        'CHARACTER_SET_NAME': 'utf8mb4' if character else None,
+        'COLLATION_NAME': 'utf8mb4_general_ci' if character else None,
+        'COLUMN_TYPE': column_type,
+        'EXTRA': '',
+    }
+
+
+def generate_table(rnd, table_name, columns, indexes):
+    """
+    合成一张表：自增主键 + columns 个字段 + indexes 个二级索引；
+    返回 {'table': TABLES 行, 'columns': [COLUMNS 行], 'indexes': [(索引名, NON_UNIQUE, [字段名])]}
+    """
+    column_list = [dict(make_column('id', 1, COLUMN_TYPES[1]), IS_NULLABLE='NO', EXTRA='auto_increment')]
+    for i in range(1, columns):
+        column_list.append(make_column('c%d' % i, i + 1, rnd.choice(COLUMN_TYPES)))
+    index_list = [('PRIMARY', 0, ['id'])]
+    for i in range(indexes):
+        index_columns = rnd.sample([column['COLUMN_NAME'] for column in column_list[1:]], min(columns - 1, rnd.randint(1, 3)))
+        index_list.append(('idx_%d' % i, rnd.choice((0, 1, 1, 1)), index_columns))
+    rows = rnd.randint(1000, 10000000)
+    return {
+        'table': {
+            'TABLE_NAME': table_name,
+            'ENGINE': 'InnoDB',
+            'TABLE_COLLATION': 'utf8mb4_general_ci',
+            'CREATE_TIME': datetime.datetime(2024, 1, 1),
+            'UPDATE_TIME': None,
+            'VERSION': 10,
+            'TABLE_ROWS': rows,
+            'DATA_LENGTH': rows * 120,
+            'INDEX_LENGTH': rows * 40 * indexes,
+            'AVG_ROW_LENGTH': 120,
+            'AUTO_INCREMENT': rows + 1,
+        },
+        'columns': column_list,
+        'indexes': index_list,
+    }
+
+
+def drift_table(rnd, table):
+    """
+    在 target 一侧制造一处结构漂移：删/加/改/移动字段，删/改名/新增索引
+    """
+    columns = [dict(column) for column in table['columns']]
+    indexes = list(table['indexes'])
+    kind = rnd.choice(('drop_column', 'add_column', 'modify_column', 'move_column',
+                       'drop_index', 'rename_index', 'add_index'))
+    if kind == 'drop_column' and len(columns) > 2:
+        dropped = columns.pop(rnd.randrange(1, len(columns)))['COLUMN_NAME']
+        indexes = [index for index in indexes if dropped not in index[2]]
+    elif kind == 'add_column':
+        columns.append(make_column('legacy', len(columns) + 1, rnd.choice(COLUMN_TYPES)))
+    elif kind == 'modify_column' and len(columns) > 1:
+        i = rnd.randrange(1, len(columns))
+        columns[i] = make_column(columns[i]['COLUMN_NAME'], i + 1, rnd.choice(COLUMN_TYPES))
+    elif kind == 'move_column' and len(columns) > 2:
+        columns.insert(1, columns.pop())
+    elif kind == 'drop_index' and len(indexes) > 1:
+        indexes.pop()
+    elif kind == 'rename_index' and len(indexes) > 1:
+        index_name, non_unique, index_columns = indexes.pop()
+        indexes.append((index_name + '_old', non_unique, index_columns))
+    else:
+        indexes.append(('idx_extra', 1, [columns[-1]['COLUMN_NAME']]))
+    for position, column in enumerate(columns, 1):
+        column['ORDINAL_POSITION'] = position
+    return dict(table, columns=columns, indexes=indexes)
+
+
+def generate_schemas(tables, columns, indexes, drift, seed):
+    """
+    合成一对 source / target 库：drift 比例的表在 target 有漂移，
+    另有少量表只在一边存在；返回 {库名: {表名: generate_table() 的结果}}
+    """
+    rnd = random.Random(seed)
+    source = {}
+    target = {}
+    for i in range(tables):
+        table = generate_table(rnd, 't%06d' % i, columns, indexes)
+        source[table['table']['TABLE_NAME']] = table
+        if rnd.random() < drift:
+            if rnd.random() < 0.05:
+                continue
+            table = drift_table(rnd, table)
+        target[table['table']['TABLE_NAME']] = table
+    for i in range(max(1, int(tables * drift * 0.05))):
+        table = generate_table(rnd, 'old%06d' % i, columns, indexes)
+        target[table['table']['TABLE_NAME']] = table
+    return {'bench_src': source, 'bench_tgt': target}
+
+
+def get_memory_backend(schemas):
+    """
+    把 generate_schemas() 的结果转成 MemoryBackend 的行格式
+    """
+    memory_schemas = {}
+    for database, tables in schemas.items():
+        memory_schemas[database] = {
+            'charset': 'utf8mb4',
+            'tables': [table['table'] for _, table in sorted(tables.items())],
+            'columns': [dict(column, TABLE_NAME=table_name) for table_name, table in sorted(tables.items())
+                        for column in table['columns']],
+            'statistics': [{'TABLE_NAME': table_name, 'NON_UNIQUE': non_unique, 'INDEX_NAME': index_name,
+                            'SEQ_IN_INDEX': seq, 'COLUMN_NAME': column_name, 'SUB_PART': None, 'INDEX_TYPE': 'BTREE'}
+                           for table_name, table in sorted(tables.items())
+                           for index_name, non_unique, index_columns in table['indexes']
+                           for seq, column_name in enumerate(index_columns, 1)],
+            'partitions': [dict(partition, TABLE_NAME=table_name) for table_name, table in sorted(tables.items())
+                           for partition in table.get('partitions', [])],
+        }
+    return sqldiff.MemoryBackend(memory_schemas, server='bench')
+
+
+def load_mysql(information, schemas):
+    """
+    把合成的两个库建到本地 MySQL（先删除同名库），返回 MySQLBackend
+    """
+    # 与 --apply 一样，DROP DATABASE IF EXISTS 的 note、8.0 上 int(11) 的弃用警告不当作错误
+    connection = mysql.connector.connect(**dict(sqldiff.get_db_config(information), raise_on_warnings=False))
+    cursor = connection.cursor()
+    empty = {'schema': (True, 'utf8mb4'), 'tables': {}, 'columns': {}, 'statistics': {}}
+    memory_backend = get_memory_backend(schemas)
+    for database in schemas:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            metadata = sqldiff.wait_metadata(sqldiff.submit_metadata(executor, memory_backend, database))
+        cursor.execute("DROP DATABASE IF EXISTS `%s`" % database)
+        cursor.execute("CREATE DATABASE `%s` DEFAULT CHARACTER SET utf8mb4" % database)
+        cursor.execute("USE `%s`" % database)
+        diff_sql, _ = sqldiff.diff_schema(metadata, empty)
+        for sql in diff_sql:
+            cursor.execute(sql)
+    cursor.close()
+    connection.close()
+    return sqldiff.MySQLBackend(sqldiff.get_server_name(information), sqldiff.get_connection_pool(information, 4))
+
+
+def run_phases(backend, jobs):
+    """
+    依次执行各阶段，返回 {阶段: 秒数} 和 diff 语句数
+    """
+    seconds = {}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        source_metadata, target_metadata = sqldiff.fetch_metadata(
+            executor, [(backend, 'bench_src'), (backend, 'bench_tgt')])
+    seconds['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for metadata in (source_metadata, target_metadata):
+        for table_name in metadata['tables']:
+            sqldiff.get_column_dic_and_pos(metadata['columns'].get(table_name, []))
+            sqldiff.get_statistics(metadata['statistics'].get(table_name, []))
+    seconds['model'] = time.perf_counter() - start
+
+    # diff 只比较得到结构化的变更；render 为生成语句和输出文本
+    start = time.perf_counter()
+    schema_changes = list(sqldiff.iter_schema_changes(source_metadata, target_metadata))
+    seconds['diff'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table_diffs = list(sqldiff.iter_render_changes(schema_changes, 'utf8mb4'))
+    sqldiff.write_diff_stream(io.StringIO(), table_diffs, 'utf8mb4')
+    seconds['render'] = time.perf_counter() - start
+
+    return seconds, sum(len(diff_sql) for _, diff_sql, _, _ in table_diffs)
+
+
+def run_peak_memory(backend, jobs):
+    """
+    在 tracemalloc 下再执行一遍各阶段，返回 {阶段: 峰值字节数}，峰值为阶段内新分配的部分；
+    tracemalloc 会拖慢执行，不与计时混在一起
+    """
+    peaks = {}
+    tracemalloc.start()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            source_metadata, target_metadata = sqldiff.fetch_metadata(
+                executor, [(backend, 'bench_src'), (backend, 'bench_tgt')])
+        peaks['load'] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        for metadata in (source_metadata, target_metadata):
+            for table_name in metadata['tables']:
+                sqldiff.get_column_dic_and_pos(metadata['columns'].get(table_name, []))
+                sqldiff.get_statistics(metadata['statistics'].get(table_name, []))
+        peaks['model'] = tracemalloc.get_traced_memory()[1] - base
+
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        schema_changes = list(sqldiff.iter_schema_changes(source_metadata, target_metadata))
+        peaks['diff'] = tracemalloc.get_traced_memory()[1] - base
+
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        table_diffs = list(sqldiff.iter_render_changes(schema_changes, 'utf8mb4'))
+        sqldiff.write_diff_stream(io.StringIO(), table_diffs, 'utf8mb4')
+        peaks['render'] = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def record_page_boundaries(pages, boundaries):
+    """
+    透传 open_metadata_pages() 的页，把每页最后一张表的表名记入 boundaries
+    """
+    for page in pages:
+        boundaries.append(list(page['tables'])[-1])
+        yield page
+
+
+def check_paged_diff(backend, jobs, page_sizes):
+    """
+    --check：分页的归并比较（--page-size）与整库比较的每张表的语句、差异说明和代价必须相同，
+    且分页结果按表名的二进制序产出；返回出现了错开的页边界（一边的页在另一边某页的中间结束）的页大小
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        source_metadata, target_metadata = sqldiff.fetch_metadata(
+            executor, [(backend, 'bench_src'), (backend, 'bench_tgt')])
+        expected = dict((table_name, (diff_sql, diff, cost)) for table_name, diff_sql, diff, cost
+                        in sqldiff.iter_schema_diff(source_metadata, target_metadata))
+        misaligned = []
+        for page_size in page_sizes:
+            source_boundaries, target_boundaries = [], []
+            source_header, source_pages = sqldiff.open_metadata_pages(executor, backend, 'bench_src', page_size)
+            target_header, target_pages = sqldiff.open_metadata_pages(executor, backend, 'bench_tgt', page_size)
+            paged = list(sqldiff.iter_render_changes(sqldiff.iter_merge_schema_changes(
+                record_page_boundaries(source_pages, source_boundaries), target_header,
+                record_page_boundaries(target_pages, target_boundaries)), 'utf8mb4'))
+            table_names = [table_name for table_name, _, _, _ in paged]
+            if table_names != sorted(table_names, key=lambda table_name: table_name.encode('utf-8')):
+                raise click.ClickException('--page-size {} 的结果没有按表名排序'.format(page_size))
+            actual = dict((table_name, (diff_sql, diff, cost)) for table_name, diff_sql, diff, cost in paged)
+            for table_name in sorted(set(expected) | set(actual)):
+                if expected.get(table_name) != actual.get(table_name):
+                    raise click.ClickException('--page-size {} 的结果与整库比较不同: {}\n{}\n{}'.format(
+                        page_size, table_name, expected.get(table_name), actual.get(table_name)))
+            if set(source_boundaries) != set(target_boundaries):
+                misaligned.append(page_size)
+            click.echo('paged     page size {:<6} {:>6} + {:<6} pages, {} tables same as full diff'.format(
+                page_size, len(source_boundaries), len(target_boundaries), len(actual)))
+    return misaligned
+
+
+def apply_column_changes(column_names, table_changes):
+    """
+    按 MySQL 执行 ALTER 的方式把 table_changes 的字段子句作用到 target 的字段顺序上：
+    先去掉 DROP 的字段和带 AFTER / FIRST 的字段，再按子句顺序逐个插入，AFTER 的字段必须已经在表中
+    """
+    column_changes = [change for change in table_changes.changes if isinstance(change, sqldiff.ColumnChange)]
+    positioned = set(change.column_name for change in column_changes if change.after is not None)
+    dropped = set(change.column_name for change in column_changes if change.action == 'DROP')
+    column_names = [column_name for column_name in column_names if column_name not in dropped | positioned]
+    for change in column_changes:
+        if change.after == 'FIRST':
+            column_names.insert(0, change.column_name)
+        elif change.after is not None:
+            after = change.after[len('AFTER `'):-1]
+            if after not in column_names:
+                raise click.ClickException('{}: {} AFTER 的字段 {} 还不在表中'.format(
+                    table_changes.table_name, change.column_name, after))
+            column_names.insert(column_names.index(after) + 1, change.column_name)
+        elif change.action == 'ADD':
+            column_names.append(change.column_name)
+    return column_names
+
+
+def check_column_order(seed, count):
+    """
+    --check：随机打乱、增删、修改 count 张表的字段，生成的字段子句执行后字段顺序必须与 source 相同，
+    且移动的字段数最少（公共字段数减去它们在两边顺序的最长公共子序列，这里用 O(n^2) 的动态规划独立计算）
+    """
+    rnd = random.Random(seed)
+    schemas = {'bench_src': {}, 'bench_tgt': {}}
+    for i in range(count):
+        column_names = ['c%d' % j for j in range(rnd.randint(1, 16))]
+        for database in schemas:
+            names = rnd.sample(column_names, rnd.randint(1, len(column_names)))
+            table = generate_table(rnd, 'cols%06d' % i, 2, 0)
+            table['columns'] = [make_column(column_name, position, rnd.choice(COLUMN_TYPES[:2]))
+                                for position, column_name in enumerate(names, 1)]
+            table['indexes'] = []
+            schemas[database][table['table']['TABLE_NAME']] = table
+    backend = get_memory_backend(schemas)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_metadata, target_metadata = sqldiff.fetch_metadata(
+            executor, [(backend, 'bench_src'), (backend, 'bench_tgt')])
+    moved = 0
+    for table_changes in sqldiff.iter_schema_changes(source_metadata, target_metadata):
+        source_names = [column['COLUMN_NAME'] for column in schemas['bench_src'][table_changes.table_name]['columns']]
+        target_names = [column['COLUMN_NAME'] for column in schemas['bench_tgt'][table_changes.table_name]['columns']]
+        if apply_column_changes(target_names, table_changes) != source_names:
+            raise click.ClickException('{}: 执行字段子句后顺序与 source 不同\n{}\n{}'.format(
+                table_changes.table_name, source_names, target_names))
+        common = [column_name for column_name in target_names if column_name in source_names]
+        source_common = [column_name for column_name in source_names if column_name in target_names]
+        lengths = [0] * (len(source_common) + 1)
+        for column_name in common:
+            previous = 0
+            for j, source_column_name in enumerate(source_common, 1):
+                previous, lengths[j] = lengths[j], (previous + 1 if column_name == source_column_name
+                                                    else max(lengths[j], lengths[j - 1]))
+        moves = sum(1 for change in table_changes.changes if isinstance(change, sqldiff.ColumnChange)
+                    and change.action in ('MOVE', 'MODIFY') and change.after is not None)
+        if moves != len(common) - lengths[-1]:
+            raise click.ClickException('{}: 移动了 {} 个字段，最少只需要 {} 个'.format(
+                table_changes.table_name, moves, len(common) - lengths[-1]))
+        moved += moves
+    click.echo('columns   {} tables, {} columns moved, all in source order with fewest moves'.format(count, moved))
+
+
+def generate_partitions(rnd, method):
+    """
+    合成一张表的分区 [(分区名, PARTITION_DESCRIPTION)]：RANGE 为递增上界（可能以 MAXVALUE 结尾），
+    LIST 为 1~12 中部分值的分组，HASH 只有分区数；分区名大多由值得出，部分改名
+    """
+    if method == 'RANGE':
+        bounds = sorted(rnd.sample(range(10, 130, 10), rnd.randint(1, 8)))
+        partitions = [(rnd.choice(('p', 'p', 'q')) + str(bound), str(bound)) for bound in bounds]
+        if rnd.random() < 0.3:
+            partitions.append(('pmax', 'MAXVALUE'))
+        return partitions
+    if method == 'LIST':
+        values = rnd.sample(range(1, 13), rnd.randint(1, 8))
+        groups = {}
+        for value in values:
+            groups.setdefault(rnd.randrange(4), []).append(value)
+        return [(rnd.choice(('p', 'p', 'q')) + str(min(group)), ','.join(str(value) for value in sorted(group)))
+                for group in groups.values()]
+    return [('p%d' % i, None) for i in range(rnd.randint(1, 8))]
+
+
+def apply_partition_changes(method, partitions, table_changes):
+    """
+    按 MySQL 的规则把 table_changes 的分区变更作用到 target 的分区 [(分区名, 描述)] 上：
+    DROP 的分区须存在；RANGE 的 ADD 只能加在最后，REORGANIZE 的分区须相邻且不缩小覆盖的范围（不在最后时范围不变）；
+    LIST 各分区的值不能重叠；HASH 只看分区数
+    """
+    def bound(description):
+        return float('inf') if description == 'MAXVALUE' else int(description)
+
+    def fail(message):
+        raise click.ClickException('{}: {}\n{}'.format(table_changes.table_name, message, table_changes.changes))
+
+    partitions = list(partitions)
+    for change in table_changes.changes:
+        if not isinstance(change, sqldiff.PartitionChange):
+            continue
+        new_partitions = [(partition.partition_name, partition.partition_description) for partition in change.partitions]
+        names = [name for name, _ in partitions]
+        if change.action in ('DROP', 'REORGANIZE') and not set(change.partition_names) <= set(names):
+            fail('{} 的分区 {} 不存在'.format(change.action, change.partition_names))
+        if change.action in ('REORGANIZE', 'PARTITION') and not new_partitions:
+            fail('{} 没有新的分区定义'.format(change.action))
+        if change.action in ('DROP', 'REORGANIZE') and not change.partition_names:
+            fail('{} 没有指定分区'.format(change.action))
+        if change.action == 'PARTITION':
+            partitions = new_partitions
+        elif change.action == 'REMOVE':
+            partitions = []
+        elif method == 'HASH' and change.action in ('ADD', 'COALESCE'):
+            count = len(partitions) + (change.count if change.action == 'ADD' else -change.count)
+            partitions = [('p%d' % i, None) for i in range(count)]
+        elif change.action == 'DROP':
+            partitions = [partition for partition in partitions if partition[0] not in change.partition_names]
+        elif change.action == 'ADD':
+            if method == 'RANGE' and partitions and bound(new_partitions[0][1]) <= bound(partitions[-1][1]):
+                fail('ADD 的分区不在最后')
+            partitions += new_partitions
+        elif change.action == 'REORGANIZE':
+            positions = [names.index(name) for name in change.partition_names]
+            if method == 'RANGE':
+                if positions != list(range(positions[0], positions[0] + len(positions))):
+                    fail('REORGANIZE 的分区不相邻')
+                old_bound = bound(partitions[positions[-1]][1])
+                new_bound = bound(new_partitions[-1][1])
+                if new_bound < old_bound or (positions[-1] < len(partitions) - 1 and new_bound != old_bound):
+                    fail('REORGANIZE 改变了覆盖的范围')
+                partitions[positions[0]:positions[-1] + 1] = new_partitions
+            else:
+                partitions = [partition for partition in partitions if partition[0] not in change.partition_names]
+                partitions += new_partitions
+        else:
+            fail('未知的分区变更 {}'.format(change.action))
+        if method == 'RANGE' and [bound(description) for _, description in partitions] != \
+                sorted(set(bound(description) for _, description in partitions)):
+            fail('RANGE 分区的上界不是严格递增')
+        if method == 'LIST':
+            values = [value for _, description in partitions for value in description.split(',')]
+            if len(values) != len(set(values)):
+                fail('LIST 分区的值重叠')
+        if len(set(name for name, _ in partitions)) != len(partitions):
+            fail('分区名重复')
+    return partitions
+
+
+def check_partitions(seed, count):
+    """
+    --check：随机生成 count 张 RANGE / LIST / HASH 分区表，分区变更执行后与 source 的分区相同
+    （RANGE 按顺序比较，LIST 不比较顺序）；返回各种分区变更的次数
+    """
+    rnd = random.Random(seed)
+    schemas = {'bench_src': {}, 'bench_tgt': {}}
+    methods = {}
+    for i in range(count):
+        table_name = 'part%06d' % i
+        methods[table_name] = method = rnd.choice(('RANGE', 'RANGE', 'LIST', 'HASH'))
+        for database in schemas:
+            table = generate_table(rnd, table_name, 2, 0)
+            table['partitions'] = [{
+                'PARTITION_NAME': name, 'PARTITION_ORDINAL_POSITION': position, 'PARTITION_METHOD': method,
+                'PARTITION_EXPRESSION': '`id`', 'PARTITION_DESCRIPTION': description, 'SUBPARTITION_METHOD': None,
+                'TABLE_ROWS': 100, 'DATA_LENGTH': 16384, 'INDEX_LENGTH': 0,
+            } for position, (name, description) in enumerate(generate_partitions(rnd, method), 1)]
+            schemas[database][table_name] = table
+    backend = get_memory_backend(schemas)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_metadata, target_metadata = sqldiff.fetch_metadata(
+            executor, [(backend, 'bench_src'), (backend, 'bench_tgt')])
+    actions = {}
+    for table_changes in sqldiff.iter_schema_changes(source_metadata, target_metadata):
+        table_name = table_changes.table_name
+        method = methods[table_name]
+        source, target = [[(partition['PARTITION_NAME'], partition['PARTITION_DESCRIPTION'])
+                           for partition in schemas[database][table_name]['partitions']]
+                          for database in ('bench_src', 'bench_tgt')]
+        partitions = apply_partition_changes(method, target, table_changes)
+        if (partitions if method == 'RANGE' else sorted(partitions, key=str)) != \
+                (source if method == 'RANGE' else sorted(source, key=str)):
+            raise click.ClickException('{}: 执行分区变更后与 source 不同\n{}\n{}\n{}'.format(
+                table_name, source, target, partitions))
+        for change in table_changes.changes:
+            if isinstance(change, sqldiff.PartitionChange):
+                actions[change.action] = actions.get(change.action, 0) + 1
+    click.echo('partition {} tables same as source after {}'.format(
+        count, ', '.join('{} {}'.format(number, action) for action, number in sorted(actions.items()))))
+    return actions
+
+
+def get_commit():
+    """
+    当前 git 提交，不在 git 仓库中时为 None
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new):
+    """
+    输出两次结果各阶段的耗时和峰值内存对比
+    """
+    click.echo('phase     {:>12} {:>12} {:>8}   {:>10} {:>10}'.format(
+        old['commit'] or 'old', new['commit'] or 'new', 'ratio', 'old peak', 'new peak'))
+    for phase in PHASES:
+        old_phase = old['phases'][phase]
+        new_phase = new['phases'][phase]
+        click.echo('{:<9} {:>11.4f}s {:>11.4f}s {:>7.2f}x   {:>10} {:>10}'.format(
+            phase, old_phase['seconds'], new_phase['seconds'],
+            new_phase['seconds'] / old_phase['seconds'] if old_phase['seconds'] else 0,
+            sqldiff.format_size(old_phase['peak_bytes']), sqldiff.format_size(new_phase['peak_bytes'])))
+
+
+@click.command()
+@click.option("--tables", default=2000, show_default=True, type=click.IntRange(1), help="每个库的表数。")
+@click.option("--columns", default=20, show_default=True, type=click.IntRange(2), help="每张表的字段数（含主键）。")
+@click.option("--indexes", default=4, show_default=True, type=click.IntRange(0), help="每张表的二级索引数。")
+@click.option("--drift", default=0.1, show_default=True, type=click.FloatRange(0, 1), help="target 中有结构漂移的表的比例。")
+@click.option("--seed", default=1, show_default=True, help="随机种子，相同参数和种子生成相同的库。")
+@click.option("--repeat", default=3, show_default=True, type=click.IntRange(1), help="重复次数，各阶段取最短耗时。")
+@click.option("--jobs", default=4, show_default=True, type=click.IntRange(1, 32), help="元数据并发查询数。")
+@click.option("--mysql", "information", help="把合成的库建到本地 MySQL 上测试（会删除重建 bench_src / bench_tgt 库），"
+                                             "不指定则用内存后端（MemoryBackend）。(格式: <user>:<password>@<host>:<port>)")
+@click.option("--save", type=click.Path(dir_okay=False), help="结果保存为 JSON 文件。")
+@click.option("--compare", type=click.File('r'), help="与之前 --save 的结果对比。")
+@click.option("--check", is_flag=True, default=False,
+              help="不计时，检查生成的语句：分页比较（--page-size 取 1、7 和约三分之一的表数）与整库比较的结果相同，"
+                   "随机调整字段顺序的表执行字段子句后与 source 相同且移动最少，随机分区的表执行分区变更后与 source 相同。")
+def benchmark(tables, columns, indexes, drift, seed, repeat, jobs, information, save, compare, check):
+    """
+    sqldiff 基准测试：合成一对大库，分阶段计时 load / model / diff / render，
+    输出吞吐量(表/秒)和各阶段峰值内存
+    """
+    schemas = generate_schemas(tables, columns, indexes, drift, seed)
+    if information is not None:
+        backend = load_mysql(information, schemas)
+    else:
+        backend = get_memory_backend(schemas)
+    if check:
+        misaligned = check_paged_diff(backend, jobs, sorted({1, 7, max(1, tables // 3)}))
+        check_column_order(seed, tables)
+        partition_actions = check_partitions(seed, tables)
+        backend.close()
+        if not misaligned:
+            raise click.ClickException('两边的页边界都对齐，没有检查到页边界落在另一边页中间的情况，请加大 --tables / --drift')
+        if 'REORGANIZE' not in partition_actions:
+            raise click.ClickException('没有生成 REORGANIZE PARTITION，请加大 --tables')
+        click.echo('ok')
+        return
+    table_count = len(schemas['bench_src']) + len(schemas['bench_tgt'])
+
+    best = {}
+    statement_count = 0
+    for _ in range(repeat):
+        seconds, statement_count = run_phases(backend, jobs)
+        for phase, value in seconds.items():
+            best[phase] = min(best.get(phase, value), value)
+    peaks = run_peak_memory(backend, jobs)
+
+    result = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'backend': 'mysql' if information is not None else 'memory',
+        'params': {'tables': tables, 'columns': columns, 'indexes': indexes, 'drift': drift, 'seed': seed,
+                   'repeat': repeat, 'jobs': jobs},
+        'statements': statement_count,
+        'phases': dict((phase, {'seconds': best[phase],
+                                'tables_per_second': table_count / best[phase] if best[phase] else None,
+                                'peak_bytes': peaks[phase]}) for phase in PHASES),
+    }
+
+    click.echo('{} + {} tables, {} statements ({}, commit {})'.format(
+        len(schemas['bench_src']), len(schemas['bench_tgt']), statement_count, result['backend'], result['commit']))
+    for phase in PHASES:
+        click.echo('{:<9} {:>10.4f}s {:>12.0f} tables/s   peak {}'.format(
+            phase, best[phase], result['phases'][phase]['tables_per_second'] or 0,
+            sqldiff.format_size(peaks[phase])))
+
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if compare is not None:
+        compare_results(json.load(compare), result)
+    backend.close()
+
+
+if __name__ == '__main__':
+    benchmark()
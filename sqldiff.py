@@ -1,66 +1,509 @@
+import asyncio
+import bisect
+import contextlib
+import datetime
+import decimal
+import fnmatch
+import functools
+import hashlib
+import http.server
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import socketserver
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import click
 import mysql.connector
+import mysql.connector.pooling
+
+# 比较和生成语句实际使用的字段
+TABLE_FIELDS = ('TABLE_NAME', 'ENGINE', 'TABLE_COLLATION', 'CREATE_TIME', 'UPDATE_TIME', 'VERSION',
+                'TABLE_ROWS', 'DATA_LENGTH', 'INDEX_LENGTH', 'AVG_ROW_LENGTH', 'AUTO_INCREMENT')
+COLUMN_FIELDS = (
+    'COLUMN_NAME', 'ORDINAL_POSITION', 'COLUMN_DEFAULT', 'IS_NULLABLE', 'DATA_TYPE',
+    'CHARACTER_MAXIMUM_LENGTH', 'CHARACTER_OCTET_LENGTH', 'NUMERIC_PRECISION', 'NUMERIC_SCALE',
+    'DATETIME_PRECISION', 'CHARACTER_SET_NAME', 'COLLATION_NAME', 'COLUMN_TYPE', 'EXTRA',
+)
+STATISTIC_FIELDS = ('NON_UNIQUE', 'INDEX_NAME', 'SEQ_IN_INDEX', 'COLUMN_NAME', 'SUB_PART', 'INDEX_TYPE')
+PARTITION_FIELDS = ('PARTITION_NAME', 'PARTITION_ORDINAL_POSITION', 'PARTITION_METHOD', 'PARTITION_EXPRESSION',
+                    'PARTITION_DESCRIPTION', 'SUBPARTITION_METHOD', 'TABLE_ROWS', 'DATA_LENGTH', 'INDEX_LENGTH')
+# KEY_COLUMN_USAGE 的列，UPDATE_RULE / DELETE_RULE 来自 REFERENTIAL_CONSTRAINTS
+FOREIGN_KEY_FIELDS = ('CONSTRAINT_NAME', 'ORDINAL_POSITION', 'COLUMN_NAME', 'REFERENCED_TABLE_SCHEMA',
+                      'REFERENCED_TABLE_NAME', 'REFERENCED_COLUMN_NAME', 'UPDATE_RULE', 'DELETE_RULE')
+
+# 结构模型：一张表、一个字段、一个索引各是一个元组，字段名即小写的 information_schema 列名；
+# Index.columns 为按 SEQ_IN_INDEX 排序的 ((字段名, 前缀长度), ...)
+Table = namedtuple('Table', [field.lower() for field in TABLE_FIELDS])
+Column = namedtuple('Column', [field.lower() for field in COLUMN_FIELDS])
+Index = namedtuple('Index', ('index_name', 'non_unique', 'index_type', 'columns'))
+# Partition 为一个分区（子分区的行合并到所在分区，table_rows / data_length / index_length 为各子分区之和）
+Partition = namedtuple('Partition', [field.lower() for field in PARTITION_FIELDS])
+# ForeignKey 为一个外键，columns / referenced_columns 按 ORDINAL_POSITION 排序；
+# referenced_schema 为被引用表所在的库，与本表同库时为 None（两边库名不同也能比较）
+ForeignKey = namedtuple('ForeignKey', ('constraint_name', 'columns', 'referenced_schema', 'referenced_table',
+                                       'referenced_columns', 'update_rule', 'delete_rule'))
+
+# 结构化的差异：diff_table_changes() 比较一张表的结果，render_table_changes() 把它生成为语句和差异说明。
+# action 为 CREATE / ALTER / DROP；changes 为下面几种变更组成的元组，按 ALTER 子句的顺序（CREATE 时全部是 ADD），分区变更在最后；
+# source / target 为两边的 Table，version 为目标库版本，algorithm / lock / cost 为 ALTER 子句的估计（没有子句为 None / 0，
+# 不含分区变更各自的代价），
+# online_key 为可以分批复制的主键字段（没有为 None），copy_columns 为在线变更时要复制的字段，
+# foreign_key_tables 为 target 中与本表有外键关系（本表引用、引用本表）的表名，没有外键信息时为 None
+TableChanges = namedtuple('TableChanges', ('table_name', 'action', 'changes', 'source', 'target', 'version',
+                                           'algorithm', 'lock', 'cost', 'online_key', 'copy_columns',
+                                           'foreign_key_tables'))
+# 字段变更：action 为 ADD / DROP / MODIFY（定义不同）/ MOVE（定义相同、位置不同），source / target 为两边的 Column；
+# after 为 'AFTER `字段`' / 'FIRST'（不改位置为 None），position 为 source 中的序号
+ColumnChange = namedtuple('ColumnChange', ('action', 'column_name', 'source', 'target', 'after', 'position'))
+# 索引变更：action 为 ADD / DROP / MODIFY（DROP + ADD）/ RENAME，source / target 为两边的 Index，old_name 为改名前的名字
+IndexChange = namedtuple('IndexChange', ('action', 'index_name', 'source', 'target', 'old_name'))
+# 外键变更：action 为 ADD / DROP / MODIFY（DROP + ADD），source / target 为两边的 ForeignKey；
+# 删除外键、新增外键各单独生成一条 ALTER，分别放在本表其它语句之前、之后，get_diff_layers() 按它们排依赖；
+# DROP 的表也带上它引用同库其它表的外键（DROP），先删外键，被引用的表就可以与它并发删除
+ForeignKeyChange = namedtuple('ForeignKeyChange', ('action', 'constraint_name', 'source', 'target'))
+# 表选项变更：option 为 ENGINE / TABLE_COLLATION，只报告，不生成语句
+OptionChange = namedtuple('OptionChange', ('option', 'source', 'target'))
+# 分区变更，每个单独生成一条 ALTER：action 为 ADD / DROP / REORGANIZE（只重组有差异的相邻分区）/
+# COALESCE（HASH / KEY 减少分区数）/ PARTITION（分区方式不同，按 source 整表重新分区）/ REMOVE（source 不分区）/
+# MANUAL（含子分区的表，只报告）；partition_names 为 target 中涉及的分区名，partitions 为 source 中对应的 Partition，
+# count 为 HASH / KEY 增加或减少的分区数，cost 为估计代价（需要复制的字节数）
+PartitionChange = namedtuple('PartitionChange', ('action', 'partition_names', 'partitions', 'count', 'cost'))
+
+# 表名过滤（--include / --exclude / --filter-file）：include / exclude 为 (kind, pattern) 元组，
+# kind 为 name（表名）/ glob（* ? [...] 通配符）/ regex（re: 开头，与 MySQL REGEXP 一样按搜索匹配）；
+# include 为空表示全部表，表名匹配 include 中任一模式且不匹配 exclude 中的任何模式才比较
+TableFilter = namedtuple('TableFilter', ('include', 'exclude'))
+
+# 目标库版本：major / minor / patch 为按 MySQL 规则估计时使用的版本，与 (5, 7, 0) 这样的元组比较；
+# MariaDB 时 mariadb 为它自己的 (major, minor, patch)，MySQL 为 None
+ServerVersion = namedtuple('ServerVersion', ('major', 'minor', 'patch', 'mariadb'))
+
+# 大表在线变更的阈值：DATA_LENGTH 字节数、TABLE_ROWS 行数（None 不限），每批复制的字节数
+OnlineOptions = namedtuple('OnlineOptions', ('min_size', 'min_rows', 'chunk_size'))
+# 在线变更的影子表、触发器名的前缀最长字符数：标识符最长 64，_<前缀>_osc_upd_old 另占 12 个字符
+ONLINE_PREFIX_LENGTH = 64 - len('__osc_upd_old')
+
+# 快照文件: MAGIC + 头(版本号, 索引区偏移) + 每张表一个 zlib 压缩的 JSON 块 + 索引区
+SNAPSHOT_MAGIC = b'SQLDIFF\x00'
+SNAPSHOT_VERSION = 6
+SNAPSHOT_HEADER = struct.Struct('>HQ')
+
+# ALTER 的执行方式，按代价从小到大；LOCK 按限制从小到大
+DDL_ALGORITHMS = ('INSTANT', 'INPLACE', 'COPY')
+DDL_LOCKS = ('NONE', 'SHARED', 'EXCLUSIVE')
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+
+# 库是否存在及默认字符集、服务器版本
+SCHEMA_QUERY = "SELECT `DEFAULT_CHARACTER_SET_NAME` FROM `information_schema`.`SCHEMATA` WHERE `SCHEMA_NAME` = %s"
+VERSION_QUERY = "SELECT VERSION()"
+
+# --targets-file 中的分片范围，如 shard{001..800}
+TARGET_RANGE = re.compile(r'\{(\d+)\.\.(\d+)\}')
+
+# --watch 识别的表级 DDL：multi 后可以是逗号（RENAME 还有 TO）分隔的多张表，其余只取第一张表
+DDL_STATEMENT = re.compile(
+    r'(?:\s|/\*.*?\*/)*(?:'
+    r'(?P<multi>DROP\s+(?:TEMPORARY\s+)?TABLES?(?:\s+IF\s+EXISTS)?|RENAME\s+TABLES?)'
+    r'|(?P<alter>ALTER\s+(?:ONLINE\s+|IGNORE\s+)*TABLE)'
+    r'|CREATE\s+(?:TEMPORARY\s+)?TABLE(?:\s+IF\s+NOT\s+EXISTS)?|TRUNCATE(?:\s+TABLE)?|(?:OPTIMIZE|ANALYZE)\s+TABLE'
+    r'|(?:CREATE|DROP)\s+(?:ONLINE\s+|OFFLINE\s+)?(?:UNIQUE\s+|FULLTEXT\s+|SPATIAL\s+)?INDEX\s+(?:`(?:[^`]|``)+`|\w+)'
+    r'(?:\s+USING\s+\w+)?\s+ON)\s+', re.I | re.S)
+DDL_TABLE_NAME = re.compile(r'(?:`((?:[^`]|``)+)`|(\w+))(?:\s*\.\s*(?:`((?:[^`]|``)+)`|(\w+)))?')
+DDL_TABLE_SEPARATOR = re.compile(r'\s*(?:,|\s+TO\s+)\s*', re.I)
+DDL_ALTER_RENAME = re.compile(r'\bRENAME\s+(?:(?:TO|AS)\s+)?(?!(?:COLUMN|INDEX|KEY)\b)', re.I)
+
+# PARTITION_DESCRIPTION 中的一个值：带引号的字符串、数字或 MAXVALUE（LIST COLUMNS 的括号不算在内）
+PARTITION_VALUE = re.compile(r"'(?:[^'\\]|\\.|'')*'|[^,\s()]+")
+
+# fleet 子进程内共享的源库快照，由 init_fleet_worker() 打开
+fleet_source_snapshot = None
+
+# --timings 的计量，未开启时为 None
+timings = None
+
+# --timings 的阶段，按执行顺序
+TIMING_PHASES = ('connect', 'version', 'schema', 'tables', 'columns', 'statistics', 'partitions', 'foreign_keys',
+                 'digests', 'diff', 'render')
+
+
+class Timings(object):
+    """
+    --timings 的计量：按阶段累计调用次数、查询数、行数、字节数（字段值长度之和，近似网络传输量）和耗时，
+    按表累计行数、字节数和 diff / render 耗时，并记录每条查询；可在多个线程中同时使用
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.tables = {}
+        self.queries = []
+
+    def phase(self, phase):
+        return self.phases.setdefault(phase, {'calls': 0, 'queries': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0})
+
+    def table(self, table_name):
+        return self.tables.setdefault(table_name, {'rows': 0, 'bytes': 0, 'diff': 0.0, 'render': 0.0})
+
+    def add_call(self, phase, seconds, table_name=None):
+        with self.lock:
+            phase_timing = self.phase(phase)
+            phase_timing['calls'] += 1
+            phase_timing['seconds'] += seconds
+            if table_name is not None:
+                self.table(table_name)[phase] += seconds
+
+    def add_query(self, phase, seconds, rows, table_column=None):
+        size = 0
+        table_sizes = {}
+        for row in rows:
+            row_size = sum(len(value) if isinstance(value, (str, bytes, bytearray)) else 8
+                           for value in (row.values() if isinstance(row, dict) else row) if value is not None)
+            size += row_size
+            if table_column is not None:
+                table_name = row[table_column]
+                if isinstance(table_name, (bytes, bytearray)):
+                    table_name = table_name.decode('utf-8')
+                table_size = table_sizes.setdefault(table_name, [0, 0])
+                table_size[0] += 1
+                table_size[1] += row_size
+        with self.lock:
+            phase_timing = self.phase(phase)
+            phase_timing['queries'] += 1
+            phase_timing['rows'] += len(rows)
+            phase_timing['bytes'] += size
+            for table_name, (table_rows, table_size) in table_sizes.items():
+                table_timing = self.table(table_name)
+                table_timing['rows'] += table_rows
+                table_timing['bytes'] += table_size
+            self.queries.append({'phase': phase, 'seconds': seconds, 'rows': len(rows), 'bytes': size})
+
+    @contextlib.contextmanager
+    def measure(self, phase, table_name=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_call(phase, time.perf_counter() - start, table_name)
+
+    def slowest_tables(self, limit=10):
+        """
+        diff + render 耗时最长的 limit 张表：[(表名, 计量)]
+        """
+        return sorted(self.tables.items(), key=lambda item: item[1]['diff'] + item[1]['render'], reverse=True)[:limit]
+
+    def slowest_queries(self, limit=5):
+        return sorted(self.queries, key=lambda query: query['seconds'], reverse=True)[:limit]
+
+    def sorted_phases(self):
+        return sorted(self.phases.items(),
+                      key=lambda item: TIMING_PHASES.index(item[0]) if item[0] in TIMING_PHASES else len(TIMING_PHASES))
+
+    def summary(self):
+        """
+        给人看的汇总：各阶段、最慢的表、最慢的查询
+        """
+        lines = ['timings: total {:.3f}s'.format(time.time() - self.start),
+                 '{:<11} {:>6} {:>8} {:>10} {:>10} {:>10}'.format('phase', 'calls', 'queries', 'rows', 'bytes', 'seconds')]
+        for phase, phase_timing in self.sorted_phases():
+            lines.append('{:<11} {:>6} {:>8} {:>10} {:>10} {:>10.4f}'.format(
+                phase, phase_timing['calls'], phase_timing['queries'], phase_timing['rows'],
+                format_size(phase_timing['bytes']), phase_timing['seconds']))
+        slowest_tables = self.slowest_tables()
+        if slowest_tables:
+            lines.append('slowest tables:')
+            for table_name, table_timing in slowest_tables:
+                lines.append('  {:<40} diff {:.4f}s render {:.4f}s rows {} bytes {}'.format(
+                    table_name, table_timing['diff'], table_timing['render'], table_timing['rows'],
+                    format_size(table_timing['bytes'])))
+        slowest_queries = self.slowest_queries()
+        if slowest_queries:
+            lines.append('slowest queries:')
+            for query in slowest_queries:
+                lines.append('  {:<11} {:.4f}s rows {} bytes {}'.format(
+                    query['phase'], query['seconds'], query['rows'], format_size(query['bytes'])))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps({
+            'start': self.start,
+            'seconds': time.time() - self.start,
+            'phases': dict(self.sorted_phases()),
+            'slowest_tables': [dict(table_timing, table=table_name) for table_name, table_timing in self.slowest_tables()],
+            'queries': self.queries,
+        }, indent=2)
+
+    def to_prometheus(self):
+        """
+        Prometheus text-file 格式（node_exporter textfile collector）；表级指标只输出最慢的表，避免基数过大
+        """
+        lines = ['# HELP sqldiff_run_seconds Wall time of the last sqldiff run.',
+                 '# TYPE sqldiff_run_seconds gauge',
+                 'sqldiff_run_seconds %f' % (time.time() - self.start),
+                 '# HELP sqldiff_run_timestamp_seconds Start time of the last sqldiff run.',
+                 '# TYPE sqldiff_run_timestamp_seconds gauge',
+                 'sqldiff_run_timestamp_seconds %f' % self.start]
+        for name in ('calls', 'queries', 'rows', 'bytes', 'seconds'):
+            lines.append('# HELP sqldiff_phase_%s Per-phase %s of the last sqldiff run.' % (name, name))
+            lines.append('# TYPE sqldiff_phase_%s gauge' % name)
+            for phase, phase_timing in self.sorted_phases():
+                lines.append('sqldiff_phase_%s{phase="%s"} %s' % (name, phase, phase_timing[name]))
+        lines.append('# HELP sqldiff_table_seconds Per-table diff / render seconds of the slowest tables.')
+        lines.append('# TYPE sqldiff_table_seconds gauge')
+        for table_name, table_timing in self.slowest_tables():
+            for phase in ('diff', 'render'):
+                lines.append('sqldiff_table_seconds{table="%s",phase="%s"} %f' % (
+                    table_name.replace('\\', '\\\\').replace('"', '\\"'), phase, table_timing[phase]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, output_format):
+        """
+        写到临时文件再改名，采集方不会读到写了一半的文件
+        """
+        content = self.to_prometheus() if output_format == 'prometheus' else self.to_json() + '\n'
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.sqldiff-timings')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+def timed(phase):
+    """
+    装饰器：开启 --timings 时把每次调用的耗时计入 phase
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if timings is None:
+                return func(*args, **kwargs)
+            with timings.measure(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def fetch_all(cursor, phase, query, params=(), table_column=None):
+    """
+    执行查询并取回全部行；开启 --timings 时计入 phase 的查询数、行数、字节数，
+    table_column 为表名所在的列时同时按表累计
+    """
+    if timings is None:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    start = time.perf_counter()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    timings.add_query(phase, time.perf_counter() - start, rows, table_column)
+    return rows
+
+
+def get_db_config(information):
+    """
+    解析 <user>:<password>@<host>:<port> 为连接参数
+    """
+    index = information.rindex('@')
+    user = information[0:index].split(':', 1)
+    host = information[index + 1:].split(':', 1)
+    return {
+        'user': user[0],
+        'password': user[1],
+        'host': host[0],
+        'port': host[1],
+        'database': 'information_schema',
+        'charset': 'utf8',
+        'autocommit': True,
+        'raise_on_warnings': True
+    }
+
+
+def get_server_name(information):
+    """
+    服务器标识 <host>:<port>，不含用户名密码
+    """
+    db_config = get_db_config(information)
+    return '%s:%s' % (db_config['host'], db_config['port'])
 
 
+@timed('connect')
 def get_connection(information):
     """
     获取数据库连接对象
     """
     connection = None
     try:
-        index = information.rindex('@')
-        user = information[0:index].split(':', 1)
-        host = information[index + 1:].split(':', 1)
-        db_config = {
-            'user': user[0],
-            'password': user[1],
-            'host': host[0],
-            'port': host[1],
-            'database': 'information_schema',
-            'charset': 'utf8',
-            'autocommit': True,
-            'raise_on_warnings': True
-        }
-        connection = mysql.connector.connect(**db_config)
+        connection = mysql.connector.connect(**get_db_config(information))
     except Exception as e:
         click.secho('ERROR: %s' % e, fg='red', err=True)
         sys.exit(1)
     return connection
 
 
+@timed('connect')
+def get_connection_pool(information, pool_size):
+    """
+    获取数据库连接池，pool_size 即最多同时使用的连接数
+    """
+    pool = None
+    try:
+        pool = mysql.connector.pooling.MySQLConnectionPool(pool_size=pool_size, **get_db_config(information))
+    except Exception as e:
+        click.secho('ERROR: %s' % e, fg='red', err=True)
+        sys.exit(1)
+    return pool
+
+
+def close_connection_pool(pool):
+    """
+    关闭连接池中的全部空闲连接
+    """
+    pool._remove_connections()
+
+
+@timed('connect')
+def get_apply_pool(information, database, pool_size, charset):
+    """
+    --apply 执行 DDL 用的连接池：连接到目标库，DROP ... IF EXISTS 等产生的 note 不当作错误
+    """
+    db_config = get_db_config(information)
+    db_config.update({'database': database, 'charset': charset, 'raise_on_warnings': False})
+    pool = None
+    try:
+        pool = mysql.connector.pooling.MySQLConnectionPool(pool_size=pool_size, **db_config)
+    except Exception as e:
+        click.secho('ERROR: %s' % e, fg='red', err=True)
+        sys.exit(1)
+    return pool
+
+
+def pooled_query(pool, func, *args):
+    """
+    从连接池借一个连接执行 func(connection, *args)，用完归还
+    """
+    connection = pool.get_connection()
+    try:
+        return func(connection, *args)
+    finally:
+        connection.close()
+
+
+@timed('schema')
 def get_schema(connection, database):
     """
     获取 对应数据库信息：
     数据库是否存在，默认字符集信息
     """
-    cursor_schema = connection.cursor(dictionary=True)
-    query_schema = "SELECT * FROM `information_schema`.`SCHEMATA` WHERE `SCHEMA_NAME` = '%s'" % database
-    cursor_schema.execute(query_schema)
-    schema_data = cursor_schema.fetchone()
-    if cursor_schema.rowcount <= 0:
-        raise Exception('源数据库 `%s` 不存在。' % database)
+    cursor_schema = connection.cursor()
+    schema_data_list = fetch_all(cursor_schema, 'schema', SCHEMA_QUERY, (database,))
     cursor_schema.close()
-    return True, schema_data['DEFAULT_CHARACTER_SET_NAME']
+    return make_schema(database, schema_data_list)
+
+
+def make_schema(database, schema_data_list):
+    if not schema_data_list:
+        raise Exception('源数据库 `%s` 不存在。' % database)
+    return True, schema_data_list[0][0]
 
 
-def get_table(connection, database):
+def intern_row(row):
+    """
+    一行查询结果转为 list：字符串驻留（表名、字段名、类型在各表间大量重复），bytes 按 utf-8 解码
+    """
+    values = []
+    for value in row:
+        if isinstance(value, (bytes, bytearray)):
+            value = value.decode('utf-8')
+        if isinstance(value, str):
+            value = sys.intern(value)
+        values.append(value)
+    return values
+
+
+@timed('version')
+def get_server_version(connection):
+    """
+    获取 服务器版本，如 8.0.32 / 5.7.44-log
+    """
+    cursor_version = connection.cursor()
+    version = fetch_all(cursor_version, 'version', VERSION_QUERY)[0][0]
+    cursor_version.close()
+    return version
+
+
+@timed('tables')
+def get_table(connection, database, table_names=None, name_filter=None):
     """
     获取 对应数据库全部表信息：
+    指定 table_names 时只查这些表，不存在的表没有结果；指定 name_filter 时只查通过过滤的表
     """
-    cursor_table = connection.cursor(dictionary=True)
-    query_table = "SELECT * FROM `information_schema`.`TABLES` WHERE `TABLE_SCHEMA` = '%s' " \
-                  "ORDER BY `TABLE_NAME` ASC" % database
-    cursor_table.execute(query_table)
-    table_data_list = cursor_table.fetchall()
-    if cursor_table.rowcount <= 0:
-        raise Exception('源数据库 `%s` 没有数据表。' % database)
+    cursor_table = connection.cursor()
+    table_data_list = []
+    for table_filter, table_params in table_name_filters(table_names, name_filter):
+        table_data_list += fetch_all(cursor_table, 'tables', get_table_query(table_filter), (database,) + table_params, 0)
+    cursor_table.close()
+    return make_table_dic(database, table_data_list, table_names, name_filter)
 
+
+def get_table_query(table_filter=''):
+    """
+    TABLES 查询，参数为 (database,) + table_name_filters() 的参数
+    """
+    return "SELECT %s FROM `information_schema`.`TABLES` WHERE `TABLE_SCHEMA` = %%s%s " \
+           "ORDER BY `TABLE_NAME` ASC" % (', '.join('`%s`' % field for field in TABLE_FIELDS), table_filter)
+
+
+@timed('tables')
+def get_table_page(connection, database, after, size, name_filter=None):
+    """
+    分页读取表信息：表名（二进制序）大于 after 的前 size 张表，按表名排序；
+    返回 (本页最后一个表名, 通过 name_filter 的表信息)，本页不满 size 张时表名为 None，表示已经读完
+    """
+    table_filter, table_params = get_name_filter_predicate(name_filter)
+    cursor_table = connection.cursor()
+    table_data_list = fetch_all(cursor_table, 'tables', get_table_page_query(table_filter, size),
+                                (database, after) + table_params, 0)
     cursor_table.close()
+    return make_table_page(table_data_list, size, name_filter)
+
+
+def get_table_page_query(table_filter, size):
+    """
+    TABLES 的 keyset 分页查询，参数为 (database, after) + get_name_filter_predicate() 的参数；
+    按二进制排序，与 Python 中 str 的比较顺序一致，两边服务器的排序规则不同也能归并
+    """
+    return "SELECT %s FROM `information_schema`.`TABLES` " \
+           "WHERE `TABLE_SCHEMA` = %%s AND CAST(`TABLE_NAME` AS BINARY) > %%s%s " \
+           "ORDER BY CAST(`TABLE_NAME` AS BINARY) ASC LIMIT %d" % \
+           (', '.join('`%s`' % field for field in TABLE_FIELDS), table_filter, size)
+
+
+def make_table_page(table_data_list, size, name_filter=None):
+    tables = make_table_dic(None, table_data_list, ())
+    last = next(reversed(tables)) if len(table_data_list) >= size else None
+    return last, dict((table_name, table_data) for table_name, table_data in tables.items()
+                      if match_table_filter(name_filter, table_name))
+
+
+def make_table_dic(database, table_data_list, table_names=None, name_filter=None):
     table_data_dic = {}
     for v in table_data_list:
-        table_data_dic[v['TABLE_NAME']] = v
+        table_data = Table._make(intern_row(v))
+        table_data_dic[table_data.table_name] = table_data
+    if table_names is None and name_filter is None and not table_data_dic:
+        raise Exception('源数据库 `%s` 没有数据表。' % database)
     return table_data_dic
 
 
@@ -70,443 +513,3572 @@ def drop_table(source_table, target_table):
     """
     diff_sql = []
     diff = []
-    for target_table_name, target_table_data in target_table.items():
+    for target_table_name in target_table:
         if target_table_name not in source_table:
             diff_sql.append("DROP TABLE IF EXISTS `%s`;" % target_table_name)
             diff.append('TABLE: {} SRC no exist but DES exist, need drop'.format(target_table_name))
     return diff_sql, diff
 
 
-def get_column(connection, database, table_name):
-    cursor_column = connection.cursor(dictionary=True)
+def get_column_dic_and_pos(column_data_list):
+    columns = {}
+    columns_pos = {}
+    for column_data in column_data_list:
+        columns[column_data.column_name] = column_data
+        columns_pos[column_data.ordinal_position] = column_data
+    return columns, columns_pos
+
+
+def get_indexes(statistic_data_list):
+    """
+    STATISTICS 的行（STATISTIC_FIELDS 顺序）按索引名合并为 Index，保持索引第一次出现的顺序
+    """
+    index_parts = {}
+    for non_unique, index_name, seq_in_index, column_name, sub_part, index_type in statistic_data_list:
+        index_parts.setdefault(index_name, (non_unique, index_type, []))[2].append((seq_in_index, column_name, sub_part))
+    return [Index(index_name, non_unique, index_type,
+                  tuple((column_name, sub_part) for _, column_name, sub_part in sorted(parts)))
+            for index_name, (non_unique, index_type, parts) in index_parts.items()]
+
+
+def get_statistics(index_list):
+    return dict((index.index_name, index) for index in index_list)
+
+
+def table_name_filters(table_names, name_filter=None, size=500):
+    """
+    把表名列表拆成若干 `TABLE_NAME` IN (...) 条件和对应参数，不匹配 name_filter 的表名先去掉；
+    table_names 为 None 时只生成一次整库查询，条件为 get_name_filter_predicate() 的结果
+    """
+    if table_names is None:
+        yield get_name_filter_predicate(name_filter)
+        return
+    table_names = [table_name for table_name in table_names if match_table_filter(name_filter, table_name)]
+    for i in range(0, len(table_names), size):
+        chunk = tuple(table_names[i:i + size])
+        yield " AND `TABLE_NAME` IN (%s)" % ', '.join(['%s'] * len(chunk)), chunk
+
+
+def parse_table_pattern(pattern):
+    """
+    解析一个表名模式为 (kind, pattern)：re: 开头为正则，含 * ? [ 为通配符，否则为表名
+    """
+    if pattern.startswith('re:'):
+        try:
+            re.compile(pattern[3:])
+        except re.error as e:
+            raise Exception('表名正则 `%s` 错误：%s' % (pattern[3:], e))
+        return 'regex', pattern[3:]
+    if any(char in pattern for char in '*?['):
+        return 'glob', pattern
+    return 'name', pattern
+
+
+def make_table_filter(include=(), exclude=(), filter_lines=()):
+    """
+    由 --include / --exclude 和 --filter-file 的行生成 TableFilter，没有任何模式时返回 None；
+    过滤文件每行一个模式，! 开头为排除，空行和 # 开头的行忽略
+    """
+    include = [parse_table_pattern(pattern) for pattern in include]
+    exclude = [parse_table_pattern(pattern) for pattern in exclude]
+    for line in filter_lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('!'):
+            exclude.append(parse_table_pattern(line[1:].strip()))
+        else:
+            include.append(parse_table_pattern(line))
+    if not include and not exclude:
+        return None
+    return TableFilter(tuple(include), tuple(exclude))
+
+
+def match_table_pattern(kind, pattern, table_name):
+    if kind == 'regex':
+        return re.search(pattern, table_name) is not None
+    if kind == 'glob':
+        return fnmatch.fnmatchcase(table_name, pattern)
+    return table_name == pattern
+
 
-    query_column = "SELECT * FROM `information_schema`.`COLUMNS` " \
-                   "WHERE `TABLE_SCHEMA` = '%s' AND `TABLE_NAME` = '%s' " \
-                   "ORDER BY `ORDINAL_POSITION` ASC" % \
-                   (database, table_name)
+def match_table_filter(name_filter, table_name):
+    """
+    表名是否通过 name_filter（None 表示不过滤）
+    """
+    if name_filter is None:
+        return True
+    if name_filter.include and not any(match_table_pattern(kind, pattern, table_name)
+                                       for kind, pattern in name_filter.include):
+        return False
+    return not any(match_table_pattern(kind, pattern, table_name) for kind, pattern in name_filter.exclude)
+
+
+def get_like_pattern(pattern):
+    """
+    通配符转为 LIKE 模式：* -> %，? -> _，% _ \\ 转义
+    """
+    return ''.join('%' if char == '*' else '_' if char == '?' else '\\' + char if char in '%_\\' else char
+                   for char in pattern)
+
+
+def is_portable_regex(pattern):
+    """
+    正则是否只用到 MySQL 5.7（Henry Spencer）、8.0（ICU）的 REGEXP 与 Python re 含义相同的写法：
+    ASCII 普通字符、反斜杠转义的标点、. ^ $ | ( )、跟在字符或分组后的 * + ? {m,n}，
+    以及不含反斜杠、嵌套 [ 和集合运算的 [...]；\\d \\w、(?...)、非贪婪量词等返回 False，只在本地检查
+    """
+    previous = None
+    depth = 0
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if not char.isascii() or not char.isprintable():
+            return False
+        if char == '\\':
+            if position + 1 >= len(pattern) or pattern[position + 1].isalnum() or not pattern[position + 1].isprintable() \
+                    or not pattern[position + 1].isascii():
+                return False
+            position += 2
+            previous = 'atom'
+            continue
+        if char == '[':
+            end = pattern.find(']', position + 2 if pattern[position + 1:position + 2] == '^' else position + 1)
+            content = pattern[position + 1:end].lstrip('^')
+            if end < 0 or not content or content.startswith(']') or '\\' in content or '[' in content \
+                    or any(operator in content for operator in ('&&', '--', '~~')) \
+                    or not all(item.isascii() and item.isprintable() for item in content):
+                return False
+            position = end + 1
+            previous = 'atom'
+            continue
+        if char == '{':
+            match = re.match(r'\{(\d+)(,(\d*))?\}', pattern[position:])
+            if match is None or previous != 'atom' or int(match.group(1)) > 255 \
+                    or (match.group(3) and not int(match.group(1)) <= int(match.group(3)) <= 255):
+                return False
+            position += match.end()
+            previous = 'quantifier'
+            continue
+        if char in '*+?':
+            if previous != 'atom':
+                return False
+            previous = 'quantifier'
+        elif char == '(':
+            if pattern[position + 1:position + 2] in ('?', ')'):
+                return False
+            depth += 1
+            previous = 'open'
+        elif char == ')':
+            if depth == 0 or previous in ('open', 'alternation'):
+                return False
+            depth -= 1
+            previous = 'atom'
+        elif char == '|':
+            if previous in (None, 'open', 'alternation'):
+                return False
+            previous = 'alternation'
+        elif char in '^$':
+            previous = 'anchor'
+        elif char in ']}':
+            return False
+        else:
+            previous = 'atom'
+        position += 1
+    return depth == 0 and previous not in (None, 'alternation')
 
-    cursor_column.execute(query_column)
 
-    column_data_t = cursor_column.fetchall()
-    column_data_count = cursor_column.rowcount
+def get_name_filter_predicate(name_filter):
+    """
+    name_filter 尽量转为 SQL 条件，返回 (条件, 参数)，不需要的表不离开服务器：
+    表名 -> IN，不含 [...] 的通配符 -> LIKE，is_portable_regex() 的正则 -> REGEXP。
+    information_schema 的表名可能是不区分大小写的排序规则，所以 include 的条件只保证不漏掉表，
+    exclude 按二进制比较；REGEXP 不能与二进制串一起用（8.0.22 起报错），排除用的正则和 [...] 通配符只在本地检查；
+    include 中有 [...] 通配符或 REGEXP 不能照样执行的正则时，include 整体只在本地检查。
+    查询结果仍要经过 match_table_filter() / filter_metadata()
+    """
+    if name_filter is None:
+        return '', ()
+    predicates = []
+    params = []
+    if name_filter.include and not any((kind == 'glob' and '[' in pattern) or (kind == 'regex' and not is_portable_regex(pattern))
+                                       for kind, pattern in name_filter.include):
+        names = [pattern for kind, pattern in name_filter.include if kind == 'name']
+        conditions = ["`TABLE_NAME` IN (%s)" % ', '.join(['%s'] * len(names))] if names else []
+        params += names
+        for kind, pattern in name_filter.include:
+            if kind == 'glob':
+                conditions.append("`TABLE_NAME` LIKE %s")
+                params.append(get_like_pattern(pattern))
+            elif kind == 'regex':
+                conditions.append("`TABLE_NAME` REGEXP %s")
+                params.append(pattern)
+        predicates.append('(%s)' % ' OR '.join(conditions))
+    names = [pattern for kind, pattern in name_filter.exclude if kind == 'name']
+    if names:
+        predicates.append("CAST(`TABLE_NAME` AS BINARY) NOT IN (%s)" % ', '.join(['%s'] * len(names)))
+        params += names
+    for kind, pattern in name_filter.exclude:
+        if kind == 'glob' and '[' not in pattern:
+            predicates.append("CAST(`TABLE_NAME` AS BINARY) NOT LIKE %s")
+            params.append(get_like_pattern(pattern))
+    return ''.join(' AND %s' % predicate for predicate in predicates), tuple(params)
+
+
+def filter_metadata(metadata, name_filter):
+    """
+    fetch_metadata() 等读取的元数据中去掉不通过 name_filter 的表（服务器上没能过滤掉的），返回新的 dict；
+    之后 DROP 的检测、结构摘要的比较都只涉及通过过滤的表
+    """
+    if name_filter is None:
+        return metadata
+    filtered = dict(metadata)
+    for part in ('tables', 'columns', 'statistics', 'partitions', 'foreign_keys', 'digests'):
+        if part in metadata:
+            filtered[part] = dict((table_name, value) for table_name, value in metadata[part].items()
+                                  if match_table_filter(name_filter, table_name))
+    return filtered
+
+
+@timed('columns')
+def get_schema_columns(connection, database, table_names=None, name_filter=None):
+    """
+    获取 对应数据库全部表的字段信息：
+    一次查询整个库，只取 COLUMN_FIELDS，按表名分组为 Column 列表；
+    指定 table_names 时只查这些表
+    """
+    cursor_column = connection.cursor()
+    column_data_list = []
+    for table_filter, table_params in table_name_filters(table_names, name_filter):
+        column_data_list += fetch_all(cursor_column, 'columns', get_column_query(table_filter),
+                                      (database,) + table_params, 0)
     cursor_column.close()
-    return column_data_count, column_data_t
+    return make_column_dic(column_data_list)
 
 
-def get_column_dic_and_pos(column_data_list):
-    columns = {}
-    columns_pos = {}
-    for source_column_data in column_data_list:
-        column_data = filter_column(source_column_data)
-        columns[column_data['COLUMN_NAME']] = column_data
-        columns_pos[column_data['ORDINAL_POSITION']] = column_data
-    return columns, columns_pos
+def get_column_query(table_filter=''):
+    """
+    COLUMNS 查询，参数为 (database,) + table_name_filters() 的参数
+    """
+    return "SELECT `TABLE_NAME`, %s FROM `information_schema`.`COLUMNS` " \
+           "WHERE `TABLE_SCHEMA` = %%s%s " \
+           "ORDER BY `TABLE_NAME` ASC, `ORDINAL_POSITION` ASC" % \
+           (', '.join('`%s`' % field for field in COLUMN_FIELDS), table_filter)
 
 
-def get_statistic_t(connection, database, table_name):
-    cursor_statistic = connection.cursor(dictionary=True)
+def make_column_dic(column_data_list):
+    column_data_dic = {}
+    for column_data in column_data_list:
+        column_data = intern_row(column_data)
+        column_data_dic.setdefault(column_data[0], []).append(Column._make(column_data[1:]))
+    return column_data_dic
 
-    query_statistic = "SELECT * FROM `information_schema`.`STATISTICS` " \
-                      "WHERE `TABLE_SCHEMA` = '%s' AND `TABLE_NAME` = '%s'" % \
-                      (database, table_name)
 
-    cursor_statistic.execute(query_statistic)
-    statistic_data_t = cursor_statistic.fetchall()
-    statistic_data_count = cursor_statistic.rowcount
+@timed('statistics')
+def get_schema_statistics(connection, database, table_names=None, name_filter=None):
+    """
+    获取 对应数据库全部表的索引信息：
+    一次查询整个库，只取 STATISTIC_FIELDS，按表名分组为 Index 列表；
+    指定 table_names 时只查这些表
+    """
+    cursor_statistic = connection.cursor()
+    statistic_data_list = []
+    for table_filter, table_params in table_name_filters(table_names, name_filter):
+        statistic_data_list += fetch_all(cursor_statistic, 'statistics', get_statistic_query(table_filter),
+                                         (database,) + table_params, 0)
     cursor_statistic.close()
+    return make_statistic_dic(statistic_data_list)
 
-    return statistic_data_count, statistic_data_t
 
+def get_statistic_query(table_filter=''):
+    """
+    STATISTICS 查询，参数为 (database,) + table_name_filters() 的参数
+    """
+    return "SELECT `TABLE_NAME`, %s FROM `information_schema`.`STATISTICS` " \
+           "WHERE `TABLE_SCHEMA` = %%s%s" % \
+           (', '.join('`%s`' % field for field in STATISTIC_FIELDS), table_filter)
 
-def get_statistics(statistic_data_t):
-    statistics = {}
-    for statistic_data in statistic_data_t:
-        if statistic_data['INDEX_NAME'] in statistics:
-            statistics[statistic_data['INDEX_NAME']].update({
-                statistic_data['SEQ_IN_INDEX']: filter_statistics(statistic_data)
-            })
+
+def make_statistic_dic(statistic_data_list):
+    statistic_data_dic = {}
+    for statistic_data in statistic_data_list:
+        statistic_data = intern_row(statistic_data)
+        statistic_data_dic.setdefault(statistic_data[0], []).append(statistic_data[1:])
+    return dict((table_name, get_indexes(statistic_data_list))
+                for table_name, statistic_data_list in statistic_data_dic.items())
+
+
+@timed('partitions')
+def get_schema_partitions(connection, database, table_names=None, name_filter=None):
+    """
+    获取 对应数据库全部分区表的分区信息：
+    一次查询整个库，只取 PARTITION_FIELDS，按表名分组为按序号排列的 Partition 列表（不分区的表没有结果）；
+    指定 table_names 时只查这些表
+    """
+    cursor_partition = connection.cursor()
+    partition_data_list = []
+    for table_filter, table_params in table_name_filters(table_names, name_filter):
+        partition_data_list += fetch_all(cursor_partition, 'partitions', get_partition_query(table_filter),
+                                         (database,) + table_params, 0)
+    cursor_partition.close()
+    return make_partition_dic(partition_data_list)
+
+
+def get_partition_query(table_filter=''):
+    """
+    PARTITIONS 查询，参数为 (database,) + table_name_filters() 的参数；不分区的表只有一行 PARTITION_NAME 为 NULL，不取
+    """
+    return "SELECT `TABLE_NAME`, %s FROM `information_schema`.`PARTITIONS` " \
+           "WHERE `TABLE_SCHEMA` = %%s AND `PARTITION_NAME` IS NOT NULL%s " \
+           "ORDER BY `TABLE_NAME` ASC, `PARTITION_ORDINAL_POSITION` ASC" % \
+           (', '.join('`%s`' % field for field in PARTITION_FIELDS), table_filter)
+
+
+def make_partition_dic(partition_data_list):
+    """
+    PARTITIONS 的行按表名分组为 Partition 列表，同一分区的子分区行（相邻）合并为一个
+    """
+    partition_data_dic = {}
+    for partition_data in partition_data_list:
+        partition_data = intern_row(partition_data)
+        partitions = partition_data_dic.setdefault(partition_data[0], [])
+        partition = Partition._make(partition_data[1:])
+        if partitions and partitions[-1].partition_name == partition.partition_name:
+            last = partitions[-1]
+            partitions[-1] = last._replace(table_rows=(last.table_rows or 0) + (partition.table_rows or 0),
+                                           data_length=(last.data_length or 0) + (partition.data_length or 0),
+                                           index_length=(last.index_length or 0) + (partition.index_length or 0))
         else:
-            statistics[statistic_data['INDEX_NAME']] = {
-                statistic_data['SEQ_IN_INDEX']: filter_statistics(statistic_data)
-            }
-    return statistics
+            partitions.append(partition)
+    return partition_data_dic
 
 
+@timed('foreign_keys')
+def get_schema_foreign_keys(connection, database, table_names=None, name_filter=None):
+    """
+    获取 对应数据库全部表的外键信息：
+    一次查询整个库（KEY_COLUMN_USAGE 关联 REFERENTIAL_CONSTRAINTS），按表名分组为 ForeignKey 列表；
+    指定 table_names 时只查这些表
+    """
+    cursor_foreign_key = connection.cursor()
+    foreign_key_data_list = []
+    for table_filter, table_params in table_name_filters(table_names, name_filter):
+        foreign_key_data_list += fetch_all(cursor_foreign_key, 'foreign_keys', get_foreign_key_query(table_filter),
+                                           (database,) + table_params, 0)
+    cursor_foreign_key.close()
+    return make_foreign_key_dic(database, foreign_key_data_list)
+
 
-@click.command()
-@click.option("--source", required=True, help="指定源服务器。(格式: <user>:<password>@<host>:<port>)")
-@click.option("--target", help="指定目标服务器。(格式: <user>:<password>@<host>:<port>)")
-@click.option("--db", required=True, help="指定数据库。(格式: <source_db>:<target_db>)")
-@click.pass_context
-def mysqldiff(ctx, source, target, db):
+def get_foreign_key_query(table_filter=''):
     """
-    数据库结构差异(target 2 source) 工具
+    外键查询，参数为 (database,) + table_name_filters() 的参数；
+    USING 合并了两边的 TABLE_NAME，table_name_filters() 的条件不需要加表别名
+    """
+    return "SELECT `TABLE_NAME`, %s FROM `information_schema`.`KEY_COLUMN_USAGE` AS `k` " \
+           "JOIN `information_schema`.`REFERENTIAL_CONSTRAINTS` AS `r` " \
+           "USING (`CONSTRAINT_SCHEMA`, `CONSTRAINT_NAME`, `TABLE_NAME`) " \
+           "WHERE `k`.`TABLE_SCHEMA` = %%s%s " \
+           "ORDER BY `TABLE_NAME` ASC, `CONSTRAINT_NAME` ASC, `k`.`ORDINAL_POSITION` ASC" % \
+           (', '.join('`%s`.`%s`' % ('r' if field in ('UPDATE_RULE', 'DELETE_RULE') else 'k', field)
+                      for field in FOREIGN_KEY_FIELDS), table_filter)
 
-    :param source :输入指定源服务器(格式: <user>:<password>@<host>:<port>)
 
-    :param target :输入指定目标服务器(格式: <user>:<password>@<host>:<port>)
+def make_foreign_key_dic(database, foreign_key_data_list):
+    """
+    外键的行（每个字段一行）按表名、约束名合并为 ForeignKey，保持约束第一次出现的顺序
+    """
+    foreign_key_parts = {}
+    for foreign_key_data in foreign_key_data_list:
+        (table_name, constraint_name, ordinal_position, column_name, referenced_schema, referenced_table,
+         referenced_column, update_rule, delete_rule) = intern_row(foreign_key_data)
+        foreign_key_parts.setdefault(table_name, {}).setdefault(
+            constraint_name, (referenced_schema, referenced_table, update_rule, delete_rule, []))[4].append(
+            (ordinal_position, column_name, referenced_column))
+    return dict((table_name, [ForeignKey(constraint_name, tuple(column_name for _, column_name, _ in sorted(parts)),
+                                         None if referenced_schema == database else referenced_schema, referenced_table,
+                                         tuple(referenced_column for _, _, referenced_column in sorted(parts)),
+                                         update_rule, delete_rule)
+                              for constraint_name, (referenced_schema, referenced_table, update_rule, delete_rule, parts)
+                              in constraints.items()])
+                for table_name, constraints in foreign_key_parts.items())
+
+
+def get_digest_expression(fields):
+    """
+    一行的 64 位摘要按表 BIT_XOR 聚合：与行的先后无关，NULL 与字符串经 QUOTE() 区分
+    """
+    return "BIT_XOR(CAST(CONV(LEFT(MD5(CONCAT_WS(',', %s)), 16), 16, 10) AS UNSIGNED))" % \
+           ', '.join('QUOTE(`%s`)' % field for field in fields)
 
-    :param db     :指定数据库(格式: <source_db>:<target_db>)
 
-    输出 diff 以及 alter 具体语句
+@timed('digests')
+def get_schema_digests(connection, database, name_filter=None):
+    """
+    获取 对应数据库每张表的结构摘要：
+    在服务器上对 COLUMN_FIELDS / STATISTIC_FIELDS 做哈希聚合，
+    返回 {表名: (字段摘要, 索引摘要)}
     """
-    source_connection = None
-    target_connection = None
+    table_filter, table_params = get_name_filter_predicate(name_filter)
+    cursor_digest = connection.cursor()
+    column_digests, statistic_digests = [fetch_all(cursor_digest, 'digests', query_digest, (database,) + table_params)
+                                         for query_digest in get_digest_queries(table_filter)]
+    cursor_digest.close()
+    return make_digest_dic(column_digests, statistic_digests)
 
-    try:
-        source_database, target_database = db.split(':', 1)
 
-        source_connection = get_connection(source)
-        source_exist, source_default_character = get_schema(source_connection, source_database)
-        source_schema_data = {'DEFAULT_CHARACTER_SET_NAME': source_default_character}
-        if source_exist:
-            print('source database default table CHARACTER name is {}'.format(source_default_character))
+def get_digest_queries(table_filter=''):
+    """
+    COLUMNS / STATISTICS 的摘要查询，参数都是 (database,) + get_name_filter_predicate() 的参数
+    """
+    return ["SELECT `TABLE_NAME`, %s FROM `information_schema`.`%s` WHERE `TABLE_SCHEMA` = %%s%s GROUP BY `TABLE_NAME`" %
+            (get_digest_expression(fields), view, table_filter)
+            for view, fields in (('COLUMNS', COLUMN_FIELDS), ('STATISTICS', STATISTIC_FIELDS))]
 
-        source_table_data_dic = get_table(source_connection, source_database)
-        # target:
-        if target is None:
-            target_connection = source_connection
-        else:
-            target_connection = get_connection(target)
-        target_exist, target_default_character = get_schema(target_connection, target_database)
-        if target_exist:
-            print('target database default table CHARACTER name is {}'.format(target_default_character))
-
-        target_table_data_dic = get_table(target_connection, target_database)
-
-        diff_sql = []
-        diff = []
-        # DROP TABLE...
-        diff_sql_drop, diff_drop = drop_table(source_table_data_dic, target_table_data_dic)
-        diff_sql += diff_sql_drop
-        diff += diff_drop
-
-        for source_table_name, source_table_data in source_table_data_dic.items():
-            if source_table_name in target_table_data_dic:
-                if source_table_data_dic[source_table_name]['ENGINE'] != source_table_data_dic[source_table_name]['ENGINE']:
-                    diff.append('TABLE: {} SRC ENGINE is {} but DES ENGINE is {}'.format(source_table_name, source_table_data_dic[source_table_name]['ENGINE'], source_table_data_dic[source_table_name]['ENGINE']))
-                if source_table_data_dic[source_table_name]['TABLE_COLLATION'] != source_table_data_dic[source_table_name]['TABLE_COLLATION']:
-                    diff.append('TABLE: {} SRC TABLE_COLLATION is {} but DES TABLE_COLLATION is {}'.format(source_table_name, source_table_data_dic[source_table_name]['TABLE_COLLATION'], source_table_data_dic[source_table_name]['TABLE_COLLATION']))
-                # ALTER TABLE
-                source_column_data_count, source_column_data_t = get_column(source_connection, source_database, source_table_name)
-                target_column_data_count, target_column_data_t = get_column(target_connection, target_database, source_table_name)
-                # ALTER LIST...
-                alter_tables = []
-                alter_columns = []
-                alter_keys = []
-                # for column
-                if source_column_data_count > 0 and target_column_data_count > 0:
-                    source_columns, source_columns_pos = get_column_dic_and_pos(source_column_data_t)
-                    target_columns, target_columns_pos = get_column_dic_and_pos(target_column_data_t)
-                    if source_columns != target_columns:
-                        alter_tables.append("ALTER TABLE `%s`" % source_table_name)
-                        # drop column
-                        for column_name, column in target_columns.items():
-                            if column_name not in source_columns:
-                                diff.append('TABLE: {} COLUMN: {} SRC no exist but DES exist, need drop DES column'.format(source_table_name, column_name))  # TAG 6:30
-                                target_columns = reset_calc_position(column_name, column['ORDINAL_POSITION'],
-                                                                     target_columns, 3)
-                                alter_columns.append("  DROP COLUMN `%s`" % column_name)
-
-                        # add column
-                        for column_name, column in source_columns.items():
-                            if column_name not in target_columns:
-                                diff.append('TABLE: {} COLUMN: {} SRC exist but DES not exist, need add DES column'.format(source_table_name, column_name))
-                                null_able = get_col_default_null_able_info(column)
-                                character = extra = ''
-                                if column['CHARACTER_SET_NAME'] is not None:
-                                    if column['CHARACTER_SET_NAME'] != source_schema_data['DEFAULT_CHARACTER_SET_NAME']:
-                                        character = ' CHARACTER SET %s' % column['CHARACTER_SET_NAME']
-                                if column['EXTRA'] != '':
-                                    extra = ' %s' % column['EXTRA'].upper()
-
-                                after = get_column_after(column['ORDINAL_POSITION'], source_columns_pos)
-
-                                # 重新计算字段位置
-                                target_columns = reset_calc_position(column_name, column['ORDINAL_POSITION'],
-                                                                     target_columns, 1)
-
-                                alter_columns.append(
-                                    "  ADD COLUMN `{column_name}` {column_type}{character}{null_able}{extra} {after}".format(
-                                        column_name=column_name, column_type=column['COLUMN_TYPE'], character=character,
-                                        null_able=null_able, extra=extra, after=after))
-
-                        # modify column
-                        for column_name, column in source_columns.items():
-                            if column_name in target_columns:
-                                if column != target_columns[column_name]:
-                                    diff.append('TABLE: {} COLUMN: {} SRC and DES is different, need modify DES column'.format(source_table_name, column_name))
-                                    null_able = get_col_default_null_able_info(column)
-                                    character = extra = ''
-                                    if column['CHARACTER_SET_NAME'] is not None:
-                                        if column['CHARACTER_SET_NAME'] != source_schema_data['DEFAULT_CHARACTER_SET_NAME']:
-                                            character = ' CHARACTER SET %s' % column['CHARACTER_SET_NAME']
-
-                                    if column['EXTRA'] != '':
-                                        extra = ' %s' % column['EXTRA'].upper()
-
-                                    after = get_column_after(column['ORDINAL_POSITION'], source_columns_pos)
-
-                                    # 重新计算字段位置
-                                    target_columns = reset_calc_position(column_name, column['ORDINAL_POSITION'],
-                                                                         target_columns, 2)
-                                    alter_columns.append(
-                                        "  MODIFY COLUMN `{column_name}` {column_type}{character}{null_able}{extra} {after}".format(
-                                            column_name=column_name, column_type=column['COLUMN_TYPE'], character=character, null_able=null_able,
-                                            extra=extra, after=after))
-
-                # for index
-                source_statistic_data_count, source_statistic_data_t = get_statistic_t(source_connection, source_database, source_table_name)
-                _, target_statistic_data_t = get_statistic_t(target_connection, target_database, source_table_name)
-
-                if source_statistic_data_count > 0:
-                    source_statistics = get_statistics(source_statistic_data_t)
-                    target_statistics = get_statistics(target_statistic_data_t)
-
-                    if source_statistics != target_statistics:
-                        if not alter_tables:
-                            alter_tables.append("ALTER TABLE `%s`" % source_table_name)
-                        # index diff
-                        same_statistics = []
-                        for target_index_name, target_statistic in target_statistics.items():
-                            for source_index_name, source_statistic in source_statistics.items():
-                                if target_statistic == source_statistic:
-                                    same_statistics.append(target_statistic)
-
-                        # drop
-                        for index_name, statistic in target_statistics.items():
-                            if statistic not in same_statistics:
-                                diff.append('TABLE: {} INDEX: {} SRC not exist  but DES exist, need drop DES index'.format(source_table_name, index_name))
-                        # add
-                        for index_name, statistic in source_statistics.items():
-                            if statistic not in same_statistics:
-                                diff.append('TABLE: {} INDEX: {} SRC exist but DES not exist, need add DES index'.format(source_table_name, index_name))
-
-
-
-                        # drop index for index name
-                        for target_index_name, target_statistic in target_statistics.items():
-                            if target_index_name not in source_statistics:
-                                if 'PRIMARY' == target_index_name:
-                                    alter_keys.append("  DROP PRIMARY KEY")
-                                else:
-                                    alter_keys.append("  DROP INDEX `%s`" % target_index_name)
-                        # modify index
-                        for index_name, statistic in source_statistics.items():
-                            if index_name in target_statistics:
-                                # modify index = DROP INDEX ... AND ADD KEY ...
-                                if statistic != target_statistics[index_name]:
-                                    if 'PRIMARY' == index_name:
-                                        alter_keys.append("  DROP PRIMARY KEY")
-                                    else:
-                                        alter_keys.append("  DROP INDEX `%s`" % index_name)
-
-                                    alter_keys.append("  ADD %s" % get_add_keys(index_name, statistic))
-                            else:
-                                # ADD KEY
-                                alter_keys.append("  ADD %s" % get_add_keys(index_name, statistic))
-
-                        if alter_keys:
-                            for alter_key in alter_keys:
-                                alter_columns.append(alter_key)
-
-                if alter_columns:
-                    for alter_column in alter_columns:
-                        if alter_column == alter_columns[-1]:
-                            column_dot = ';'
-                        else:
-                            column_dot = ','
-                        alter_tables.append('%s%s' % (alter_column, column_dot))
 
-                if alter_tables:
-                    diff_sql.append('\n'.join(alter_tables))
+def make_digest_dic(column_digests, statistic_digests):
+    column_digests = dict(column_digests)
+    statistic_digests = dict(statistic_digests)
+    return dict((table_name, (column_digests.get(table_name), statistic_digests.get(table_name)))
+                for table_name in set(column_digests) | set(statistic_digests))
 
-            else:
-                # CREATE TABLE...
-                source_column_data_count, source_column_data = get_column(source_connection, source_database, source_table_name)
 
-                if source_column_data_count > 0:
-                    source_statistics_data_count, source_statistics_data_t = get_statistic_t(source_connection, source_database, source_table_name)
+class MetadataBackend(object):
+    """
+    元数据来源接口：按库提供服务器版本、字符集、表、字段、索引、分区、外键和结构摘要，
+    返回值分别与 get_server_version() / get_schema() / get_table() / get_schema_columns() /
+    get_schema_statistics() / get_schema_partitions() / get_schema_foreign_keys() / get_schema_digests() 相同；
+    name_filter 为 TableFilter，能在服务器上过滤的尽量在服务器上过滤；方法会在线程池中并发调用
+    """
+
+    # 服务器标识，用作缓存键和 fleet 结果文件名
+    server = None
+
+    def get_server_version(self):
+        raise NotImplementedError
+
+    def get_schema(self, database):
+        raise NotImplementedError
+
+    def get_tables(self, database, table_names=None, name_filter=None):
+        raise NotImplementedError
+
+    def get_table_page(self, database, after, size, name_filter=None):
+        raise NotImplementedError
+
+    def get_columns(self, database, table_names=None, name_filter=None):
+        raise NotImplementedError
+
+    def get_statistics(self, database, table_names=None, name_filter=None):
+        raise NotImplementedError
+
+    def get_partitions(self, database, table_names=None, name_filter=None):
+        raise NotImplementedError
+
+    def get_foreign_keys(self, database, table_names=None, name_filter=None):
+        raise NotImplementedError
+
+    def get_digests(self, database, name_filter=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
 
-                    create_tables = ["CREATE TABLE IF NOT EXISTS `%s` (" % source_table_name]
 
-                    diff.append('TABLE: {} SRC exist but DES not exist, need add DES table'.format(source_table_name))
-                    # COLUMN...
-                    for column in source_column_data:
-                        null_able = get_col_default_null_able_info(column)
+class MySQLBackend(MetadataBackend):
+    """
+    在线 MySQL：每次调用从连接池借一个连接查询 information_schema
+    """
+
+    def __init__(self, server, pool):
+        self.server = server
+        self.pool = pool
+
+    @classmethod
+    def connect(cls, information, pool_size=4):
+        """
+        按 <user>:<password>@<host>:<port> 建立连接池，出错时抛出异常而不是退出进程，作为库使用时用这个
+        """
+        return cls(get_server_name(information),
+                   mysql.connector.pooling.MySQLConnectionPool(pool_size=pool_size, **get_db_config(information)))
+
+    def query(self, func, *args):
+        return pooled_query(self.pool, func, *args)
+
+    def get_server_version(self):
+        return self.query(get_server_version)
+
+    def get_schema(self, database):
+        return self.query(get_schema, database)
+
+    def get_tables(self, database, table_names=None, name_filter=None):
+        return self.query(get_table, database, table_names, name_filter)
 
-                        character = extra = dot = ''
+    def get_table_page(self, database, after, size, name_filter=None):
+        return self.query(get_table_page, database, after, size, name_filter)
 
-                        if column['CHARACTER_SET_NAME'] is not None:
-                            if column['CHARACTER_SET_NAME'] != source_schema_data['DEFAULT_CHARACTER_SET_NAME']:
-                                character = ' CHARACTER SET %s' % column['CHARACTER_SET_NAME']
+    def get_columns(self, database, table_names=None, name_filter=None):
+        return self.query(get_schema_columns, database, table_names, name_filter)
 
-                        if column['EXTRA'] != '':
-                            extra = ' %s' % column['EXTRA'].upper()
+    def get_statistics(self, database, table_names=None, name_filter=None):
+        return self.query(get_schema_statistics, database, table_names, name_filter)
 
-                        if column != source_column_data[-1] or source_statistics_data_count > 0:
-                            dot = ','
+    def get_partitions(self, database, table_names=None, name_filter=None):
+        return self.query(get_schema_partitions, database, table_names, name_filter)
 
-                        create_tables.append(
-                            "  `{column_name}` {column_type}{character}{null_able}{extra}{dot}".format(
-                                column_name=column['COLUMN_NAME'], column_type=column['COLUMN_TYPE'],
-                                character=character,
-                                null_able=null_able, extra=extra, dot=dot))
+    def get_foreign_keys(self, database, table_names=None, name_filter=None):
+        return self.query(get_schema_foreign_keys, database, table_names, name_filter)
 
-                    # key
-                    create_tables_keys = []
-                    if source_statistics_data_count > 0:
-                        source_statistics_data_dic = get_statistics(source_statistics_data_t)
+    def get_digests(self, database, name_filter=None):
+        return self.query(get_schema_digests, database, name_filter)
 
-                        for index_name, source_statistics_data in source_statistics_data_dic.items():
-                            create_tables_keys.append("  {key_slot}".format(key_slot=get_add_keys(index_name, source_statistics_data)))
+    def close(self):
+        close_connection_pool(self.pool)
 
-                    create_tables.append(",\n".join(create_tables_keys))
-                    create_tables.append(
-                        ") ENGINE={engine} DEFAULT CHARSET={charset};".format(engine=source_table_data['ENGINE'],
-                                                                              charset=source_schema_data['DEFAULT_CHARACTER_SET_NAME']))
-                    diff_sql.append("\n".join(create_tables))
 
-        if diff_sql:
-            print('\n'.join(diff))
-            print('SET NAMES %s;\n' % source_schema_data['DEFAULT_CHARACTER_SET_NAME'])
-            print("\n\n".join(diff_sql))
+def get_async_connector():
+    """
+    --async-fetch 依赖 mysql.connector.aio（mysql-connector-python 8.3 及以上），没有时报错
+    """
+    try:
+        import mysql.connector.aio
+    except ImportError:
+        raise click.UsageError('--async-fetch 需要 mysql-connector-python 8.3 及以上：pip install -U mysql-connector-python')
+    return mysql.connector.aio
+
 
+class AsyncMySQLBackend(MetadataBackend):
+    """
+    用 asyncio（mysql.connector.aio）查询的在线 MySQL，适合高延迟链路：
+    后台线程运行事件循环，concurrency 个连接同时建立（握手不再逐个排队），
+    每个连接同时执行一条查询，分块的查询一起发出，超过 concurrency 的查询等待空闲连接；
+    总耗时接近几个 RTT 加传输时间。接口与 MySQLBackend 相同，方法可以在线程池中并发调用
+    """
+
+    def __init__(self, information, concurrency=4):
+        self.aio = get_async_connector()
+        self.server = get_server_name(information)
+        self.information = information
+        self.connections = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        try:
+            self.run(self.open(information, concurrency))
+        except Exception:
+            self.close()
+            raise
+
+    def run(self, coroutine):
+        """
+        在事件循环中执行 coroutine 并等待结果
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def open(self, information, concurrency):
+        db_config = get_db_config(information)
+        db_config['port'] = int(db_config['port'])
+        results = await asyncio.gather(*[self.aio.connect(**db_config) for _ in range(concurrency)],
+                                       return_exceptions=True)
+        connections = [result for result in results if not isinstance(result, BaseException)]
+        self.connections = asyncio.Queue()
+        for connection in connections:
+            self.connections.put_nowait(connection)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def query(self, func, *args):
+        """
+        不在元数据读取路径上的少量查询（通配符展开、--apply 前的设置检查）用一个临时的同步连接执行 func(connection, *args)
+        """
+        connection = mysql.connector.connect(**get_db_config(self.information))
+        try:
+            return func(connection, *args)
+        finally:
+            connection.close()
+
+    async def fetch(self, phase, query, params=(), table_column=None):
+        """
+        借一个空闲连接执行查询并取回全部行，计入 --timings
+        """
+        connection = await self.connections.get()
+        try:
+            start = time.perf_counter()
+            cursor = await connection.cursor()
+            try:
+                await cursor.execute(query, params)
+                rows = await cursor.fetchall()
+            finally:
+                await cursor.close()
+        finally:
+            self.connections.put_nowait(connection)
+        if timings is not None:
+            timings.add_query(phase, time.perf_counter() - start, rows, table_column)
+        return rows
+
+    async def fetch_chunks(self, phase, query_func, database, table_names, name_filter):
+        """
+        按 table_name_filters() 分块的查询同时发出，合并全部行
+        """
+        results = await asyncio.gather(*[self.fetch(phase, query_func(table_filter), (database,) + table_params, 0)
+                                         for table_filter, table_params in table_name_filters(table_names, name_filter)])
+        return [row for rows in results for row in rows]
+
+    async def fetch_digests(self, database, name_filter):
+        table_filter, table_params = get_name_filter_predicate(name_filter)
+        return await asyncio.gather(*[self.fetch('digests', query_digest, (database,) + table_params)
+                                      for query_digest in get_digest_queries(table_filter)])
+
+    @timed('version')
+    def get_server_version(self):
+        return self.run(self.fetch('version', VERSION_QUERY))[0][0]
+
+    @timed('schema')
+    def get_schema(self, database):
+        return make_schema(database, self.run(self.fetch('schema', SCHEMA_QUERY, (database,))))
+
+    @timed('tables')
+    def get_tables(self, database, table_names=None, name_filter=None):
+        return make_table_dic(database, self.run(self.fetch_chunks('tables', get_table_query, database, table_names,
+                                                                   name_filter)), table_names, name_filter)
+
+    @timed('tables')
+    def get_table_page(self, database, after, size, name_filter=None):
+        table_filter, table_params = get_name_filter_predicate(name_filter)
+        return make_table_page(self.run(self.fetch('tables', get_table_page_query(table_filter, size),
+                                                   (database, after) + table_params, 0)), size, name_filter)
+
+    @timed('columns')
+    def get_columns(self, database, table_names=None, name_filter=None):
+        return make_column_dic(self.run(self.fetch_chunks('columns', get_column_query, database, table_names,
+                                                          name_filter)))
+
+    @timed('statistics')
+    def get_statistics(self, database, table_names=None, name_filter=None):
+        return make_statistic_dic(self.run(self.fetch_chunks('statistics', get_statistic_query, database, table_names,
+                                                             name_filter)))
+
+    @timed('partitions')
+    def get_partitions(self, database, table_names=None, name_filter=None):
+        return make_partition_dic(self.run(self.fetch_chunks('partitions', get_partition_query, database, table_names,
+                                                             name_filter)))
+
+    @timed('foreign_keys')
+    def get_foreign_keys(self, database, table_names=None, name_filter=None):
+        return make_foreign_key_dic(database, self.run(self.fetch_chunks('foreign_keys', get_foreign_key_query, database,
+                                                                         table_names, name_filter)))
+
+    @timed('digests')
+    def get_digests(self, database, name_filter=None):
+        return make_digest_dic(*self.run(self.fetch_digests(database, name_filter)))
+
+    async def close_connections(self):
+        while self.connections is not None and not self.connections.empty():
+            await self.connections.get_nowait().close()
+
+    def close(self):
+        try:
+            self.run(self.close_connections())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+@timed('connect')
+def get_async_backend(information, concurrency):
+    """
+    获取 asyncio 后端，concurrency 即与该服务器同时建立的连接数
+    """
+    backend = None
+    try:
+        backend = AsyncMySQLBackend(information, concurrency)
     except Exception as e:
         click.secho('ERROR: %s' % e, fg='red', err=True)
         sys.exit(1)
-    finally:
-        if source_connection is not None:
-            source_connection.close()
-        if target_connection is not None:
-            target_connection.close()
+    return backend
 
 
-def filter_column(column):
-    return {
-        'COLUMN_NAME': column['COLUMN_NAME'],
-        'ORDINAL_POSITION': column['ORDINAL_POSITION'],
-        'COLUMN_DEFAULT': column['COLUMN_DEFAULT'],
-        'IS_NULLABLE': column['IS_NULLABLE'],
-        'DATA_TYPE': column['DATA_TYPE'],
-        'CHARACTER_MAXIMUM_LENGTH': column['CHARACTER_MAXIMUM_LENGTH'],
-        'CHARACTER_OCTET_LENGTH': column['CHARACTER_OCTET_LENGTH'],
-        'NUMERIC_PRECISION': column['NUMERIC_PRECISION'],
-        'NUMERIC_SCALE': column['NUMERIC_SCALE'],
-        'DATETIME_PRECISION': column['DATETIME_PRECISION'],
-        'CHARACTER_SET_NAME': column['CHARACTER_SET_NAME'],
-        'COLLATION_NAME': column['COLLATION_NAME'],
-        'COLUMN_TYPE': column['COLUMN_TYPE'],
-        'EXTRA': column['EXTRA']
+class MemoryBackend(MetadataBackend):
+    """
+    内存中的元数据，用于没有服务器时测试、基准测试和 fixture：
+    schemas 为 {库名: {'charset': 默认字符集, 'tables': [TABLES 行], 'columns': [COLUMNS 行], 'statistics': [STATISTICS 行],
+    'partitions': [PARTITIONS 行，可省略], 'foreign_keys': [KEY_COLUMN_USAGE 行加上 UPDATE_RULE / DELETE_RULE，可省略]}}，
+    每行是 information_schema 列名 -> 值的 dict（除表以外的行含 TABLE_NAME），
+    只需包含 TABLE_FIELDS / COLUMN_FIELDS / STATISTIC_FIELDS / PARTITION_FIELDS / FOREIGN_KEY_FIELDS 中的列，缺少的按 NULL
+    """
+
+    def __init__(self, schemas, version='8.0.32', server='memory'):
+        self.schemas = schemas
+        self.version = version
+        self.server = server
+
+    @classmethod
+    def load(cls, path):
+        """
+        从 JSON fixture 加载：{"version": ..., "server": ..., "schemas": {...}}
+        """
+        with open(path) as f:
+            fixture = json.load(f)
+        return cls(fixture['schemas'], fixture.get('version', '8.0.32'), fixture.get('server', 'memory'))
+
+    def _schema(self, database):
+        if database not in self.schemas:
+            raise Exception('源数据库 `%s` 不存在。' % database)
+        return self.schemas[database]
+
+    def _rows(self, database, part, fields, table_names, name_filter=None):
+        """
+        某一部分的行按表名分组，每行按 fields 顺序转为驻留后的值列表
+        """
+        if table_names is not None:
+            table_names = set(table_names)
+        rows = {}
+        for row in self._schema(database).get(part, []):
+            if (table_names is None or row['TABLE_NAME'] in table_names) \
+                    and match_table_filter(name_filter, row['TABLE_NAME']):
+                rows.setdefault(row['TABLE_NAME'], []).append(intern_row([row.get(field) for field in fields]))
+        return rows
+
+    @timed('version')
+    def get_server_version(self):
+        return self.version
+
+    @timed('schema')
+    def get_schema(self, database):
+        return True, self._schema(database)['charset']
+
+    @timed('tables')
+    def get_tables(self, database, table_names=None, name_filter=None):
+        tables = dict((table_name, Table._make(rows[0]))
+                      for table_name, rows in sorted(self._rows(database, 'tables', TABLE_FIELDS, table_names,
+                                                                name_filter).items()))
+        if table_names is None and name_filter is None and not tables:
+            raise Exception('源数据库 `%s` 没有数据表。' % database)
+        return tables
+
+    @timed('tables')
+    def get_table_page(self, database, after, size, name_filter=None):
+        rows = self._rows(database, 'tables', TABLE_FIELDS, None)
+        table_names = sorted(table_name for table_name in rows if table_name > after)[:size]
+        return make_table_page([rows[table_name][0] for table_name in table_names], size, name_filter)
+
+    @timed('columns')
+    def get_columns(self, database, table_names=None, name_filter=None):
+        return dict((table_name, [Column._make(row) for row in sorted(rows, key=lambda row: row[1])])
+                    for table_name, rows in self._rows(database, 'columns', COLUMN_FIELDS, table_names,
+                                                       name_filter).items())
+
+    @timed('statistics')
+    def get_statistics(self, database, table_names=None, name_filter=None):
+        return dict((table_name, get_indexes(rows))
+                    for table_name, rows in self._rows(database, 'statistics', STATISTIC_FIELDS, table_names,
+                                                       name_filter).items())
+
+    @timed('partitions')
+    def get_partitions(self, database, table_names=None, name_filter=None):
+        rows = self._rows(database, 'partitions', PARTITION_FIELDS, table_names, name_filter)
+        return make_partition_dic([[table_name] + row for table_name in sorted(rows)
+                                   for row in sorted(rows[table_name], key=lambda row: row[1]) if row[0] is not None])
+
+    @timed('foreign_keys')
+    def get_foreign_keys(self, database, table_names=None, name_filter=None):
+        rows = self._rows(database, 'foreign_keys', FOREIGN_KEY_FIELDS, table_names, name_filter)
+        return make_foreign_key_dic(database, [[table_name] + row for table_name in sorted(rows)
+                                               for row in sorted(rows[table_name], key=lambda row: (row[0], row[1]))])
+
+    @timed('digests')
+    def get_digests(self, database, name_filter=None):
+        """
+        与 get_schema_digests() 相同的思路：每行 64 位摘要按表异或，只能与同样来自 MemoryBackend 的摘要比较
+        """
+        digests = {}
+        for index, (part, fields) in enumerate((('columns', COLUMN_FIELDS), ('statistics', STATISTIC_FIELDS))):
+            for table_name, rows in self._rows(database, part, fields, None, name_filter).items():
+                digest = 0
+                for row in rows:
+                    digest ^= int(hashlib.md5(json.dumps(row, default=snapshot_encode).encode('utf-8')).hexdigest()[:16], 16)
+                digests.setdefault(table_name, [None, None])[index] = digest
+        return dict((table_name, tuple(digest)) for table_name, digest in digests.items())
+
+
+def submit_metadata(executor, backend, database, details=True, digest=False, name_filter=None):
+    """
+    提交 对应数据库 diff 需要读取的全部元数据查询：
+    服务器版本、字符集、表信息、分区信息、外键信息、字段信息、索引信息，各自独立，并发执行；
+    details 为 False 时只查字符集、表信息、分区信息和外键信息（字段、索引之后按需查询），
+    digest 为 True 时同时查询每张表的结构摘要，name_filter 为 TableFilter 时各查询只取通过过滤的表
+    """
+    futures = {
+        'version': executor.submit(backend.get_server_version),
+        'schema': executor.submit(backend.get_schema, database),
+        'tables': executor.submit(backend.get_tables, database, None, name_filter),
+        'partitions': executor.submit(backend.get_partitions, database, None, name_filter),
+        'foreign_keys': executor.submit(backend.get_foreign_keys, database, None, name_filter),
     }
+    if details:
+        futures['columns'] = executor.submit(backend.get_columns, database, None, name_filter)
+        futures['statistics'] = executor.submit(backend.get_statistics, database, None, name_filter)
+    if digest:
+        futures['digests'] = executor.submit(backend.get_digests, database, name_filter)
+    return futures
 
 
-def get_col_default_null_able_info(column):
-    if column['IS_NULLABLE'] == 'NO':
-        if column['COLUMN_DEFAULT'] is not None:
-            if column['DATA_TYPE'] == 'timestamp':
-                null_able = " NOT NULL DEFAULT %s" % column['COLUMN_DEFAULT']
-            else:
-                null_able = " NOT NULL DEFAULT '%s'" % column['COLUMN_DEFAULT']
-        else:
-            null_able = " NOT NULL"
-    else:
-        if column['COLUMN_DEFAULT'] is not None:
-            if column['DATA_TYPE'] == 'timestamp':
-                null_able = " NULL DEFAULT %s" % column['COLUMN_DEFAULT']
-            else:
-                null_able = " DEFAULT '%s'" % column['COLUMN_DEFAULT']
-        else:
-            null_able = ' DEFAULT NULL'
+def wait_metadata(futures):
+    """
+    等待 submit_metadata() 的查询全部完成，返回结果
+    """
+    return dict((name, future.result()) for name, future in futures.items())
 
-    return null_able
 
+def snapshot_encode(value):
+    """
+    JSON 无法直接表示的值（CREATE_TIME 等 datetime、bytes）转为字符串
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    return str(value)
 
-def get_column_after(ordinal_position, column_pos):
-    pos = ordinal_position - 1
-    if pos in column_pos:
-        return "AFTER `%s`" % column_pos[pos]['COLUMN_NAME']
-    else:
-        return "FIRST"
+
+def encode_table_block(table_data, column_data_list, index_list, partition_list, foreign_key_list):
+    """
+    单表元数据编码为压缩块：Table / Column / Index / Partition / ForeignKey 都是元组，直接存为 JSON 数组
+    """
+    return zlib.compress(json.dumps({
+        'table': table_data,
+        'columns': column_data_list,
+        'statistics': index_list,
+        'partitions': partition_list,
+        'foreign_keys': foreign_key_list,
+    }, default=snapshot_encode, separators=(',', ':')).encode('utf-8'))
 
 
-def get_add_keys(index_name, statistic):
-    non_unique = statistic[1]['NON_UNIQUE']
+def decode_table_block(block):
+    """
+    encode_table_block() 的逆过程
+    """
+    block = json.loads(zlib.decompress(block))
+    return {
+        'table': None if block['table'] is None else Table._make(intern_row(block['table'])),
+        'columns': [Column._make(intern_row(values)) for values in block['columns']],
+        'statistics': [Index(sys.intern(index_name), non_unique, sys.intern(index_type),
+                             tuple((sys.intern(column_name), sub_part) for column_name, sub_part in columns))
+                       for index_name, non_unique, index_type, columns in block['statistics']],
+        'partitions': [Partition._make(intern_row(values)) for values in block['partitions']],
+        'foreign_keys': [ForeignKey(sys.intern(constraint_name), tuple(intern_row(columns)), referenced_schema,
+                                    sys.intern(referenced_table), tuple(intern_row(referenced_columns)), update_rule,
+                                    delete_rule)
+                         for constraint_name, columns, referenced_schema, referenced_table, referenced_columns,
+                         update_rule, delete_rule in block['foreign_keys']],
+    }
 
-    if 1 == non_unique:
-        columns_name = []
 
-        for k in sorted(statistic):
-            sub_part = ''
+def write_snapshot(path, database, metadata):
+    """
+    把 submit_metadata() 读取的元数据写成快照文件，
+    每张表单独压缩，方便加载时按表懒解码
+    """
+    _, default_character = metadata['schema']
+    tables = []
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, 0))
+        for table_name, table_data in metadata['tables'].items():
+            block = encode_table_block(table_data, metadata['columns'].get(table_name, []),
+                                       metadata['statistics'].get(table_name, []),
+                                       metadata['partitions'].get(table_name, []),
+                                       metadata['foreign_keys'].get(table_name, []))
+            tables.append([table_name, f.tell(), len(block)])
+            f.write(block)
+
+        index_offset = f.tell()
+        f.write(zlib.compress(json.dumps({
+            'database': database,
+            'charset': default_character,
+            'server_version': metadata['version'],
+            'tables': tables,
+        }, separators=(',', ':')).encode('utf-8')))
+        f.seek(len(SNAPSHOT_MAGIC))
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, index_offset))
+    os.replace(tmp_path, path)
+    return len(tables)
+
+
+class Snapshot(object):
+    """
+    只读快照：文件 mmap 映射，打开时只解析索引区，
+    表数据在第一次访问时才解压解码，并只缓存最近用到的少量表
+    """
 
-            if statistic[k]['SUB_PART'] is not None:
-                sub_part = '(%d)' % statistic[k]['SUB_PART']
+    def __init__(self, path, cache_size=128):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise Exception('快照文件 `%s` 格式错误。' % path)
+        header_end = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+        if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            self.close()
+            raise Exception('快照文件 `%s` 格式错误。' % path)
+        version, index_offset = SNAPSHOT_HEADER.unpack(self._mmap[len(SNAPSHOT_MAGIC):header_end])
+        if version != SNAPSHOT_VERSION:
+            self.close()
+            raise Exception('快照文件 `%s` 版本 %d 不支持。' % (path, version))
+
+        index = json.loads(zlib.decompress(self._mmap[index_offset:]))
+        self.database = index['database']
+        self.default_character = index['charset']
+        self.server_version = index['server_version']
+        self._blocks = dict((table_name, (offset, length)) for table_name, offset, length in index['tables'])
+        self.load = functools.lru_cache(maxsize=cache_size)(self._load)
+
+    def _load(self, table_name):
+        offset, length = self._blocks[table_name]
+        return decode_table_block(self._mmap[offset:offset + length])
+
+    def metadata(self, name_filter=None):
+        """
+        与 wait_metadata() 返回同样结构，tables/columns/statistics/partitions/foreign_keys 为懒加载的映射；
+        name_filter 为 TableFilter 时只包含通过过滤的表（只检查索引区的表名，不解码表数据）
+        """
+        table_names = None
+        if name_filter is not None:
+            table_names = dict.fromkeys(table_name for table_name in self._blocks
+                                        if match_table_filter(name_filter, table_name))
+        return {
+            'version': self.server_version,
+            'schema': (True, self.default_character),
+            'tables': SnapshotView(self, 'table', table_names),
+            'columns': SnapshotView(self, 'columns', table_names),
+            'statistics': SnapshotView(self, 'statistics', table_names),
+            'partitions': SnapshotView(self, 'partitions', table_names),
+            'foreign_keys': SnapshotView(self, 'foreign_keys', table_names),
+        }
 
-            columns_name.append(
-                "`{column_name}`{sub_part}".format(column_name=statistic[k]['COLUMN_NAME'], sub_part=sub_part))
+    def close(self):
+        if getattr(self, 'load', None) is not None:
+            self.load.cache_clear()
+        self._mmap.close()
+        self._file.close()
 
-        return "KEY `{index_name}` ({columns_name})".format(index_name=index_name, columns_name=",".join(columns_name))
-    else:
-        columns_name = []
 
-        if 'PRIMARY' == index_name:
+class SnapshotView(Mapping):
+    """
+    表名 -> 快照中该表的某一部分（table/columns/statistics/partitions/foreign_keys），按需解码；
+    table_names（有序的 dict）不为 None 时只包含这些表
+    """
 
-            for k in sorted(statistic):
-                sub_part = ''
+    def __init__(self, snapshot, part, table_names=None):
+        self._snapshot = snapshot
+        self._part = part
+        self._table_names = snapshot._blocks if table_names is None else table_names
 
-                if statistic[k]['SUB_PART'] is not None:
-                    sub_part = '(%d)' % statistic[k]['SUB_PART']
+    def __getitem__(self, table_name):
+        if table_name not in self._table_names:
+            raise KeyError(table_name)
+        return self._snapshot.load(table_name)[self._part]
 
-                columns_name.append(
-                    "`{column_name}{sub_part}`".format(column_name=statistic[k]['COLUMN_NAME'], sub_part=sub_part))
+    def __contains__(self, table_name):
+        return table_name in self._table_names
 
-            return "PRIMARY KEY ({columns_name})".format(columns_name=",".join(columns_name))
-        else:
-            for k in sorted(statistic):
-                sub_part = ''
+    def __iter__(self):
+        return iter(self._table_names)
 
-                if statistic[k]['SUB_PART'] is not None:
-                    sub_part = '(%d)' % statistic[k]['SUB_PART']
+    def __len__(self):
+        return len(self._table_names)
 
-                columns_name.append(
-                    "`{column_name}`{sub_part}".format(column_name=statistic[k]['COLUMN_NAME'], sub_part=sub_part))
 
-            return "UNIQUE KEY `{index_name}` ({columns_name})".format(index_name=index_name,
-                                                                       columns_name=",".join(columns_name))
+def table_fingerprint(table_data):
+    """
+    表结构指纹：get_table() 已读到的 CREATE_TIME / UPDATE_TIME / VERSION
+    """
+    return json.dumps([table_data.create_time, table_data.update_time, table_data.version],
+                      default=snapshot_encode)
 
 
-def reset_calc_position(column_name, local_pos, target_columns, status):
-    if 1 == status:
-        # ADD ...
-        for k, v in target_columns.items():
-            cur_pos = v['ORDINAL_POSITION']
-            if cur_pos >= local_pos:
-                target_columns[k]['ORDINAL_POSITION'] = target_columns[k]['ORDINAL_POSITION'] + 1
+class MetadataCache(object):
+    """
+    本地元数据缓存（sqlite），按 (server, schema, table) 保存字段和索引信息，
+    表指纹不变就复用；按最近使用时间和总大小淘汰
+    """
 
-    elif 2 == status:
-        # MODIFY ...
-        if column_name in target_columns:
-            target_columns[column_name]['ORDINAL_POSITION'] = local_pos
-    elif 3 == status:
-        # DROP ...
-        for k, v in target_columns.items():
-            cur_pos = v['ORDINAL_POSITION']
+    def __init__(self, path, max_age, max_size):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS `meta` (`name` TEXT PRIMARY KEY, `value` TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS `cache` ("
+                         "`server` TEXT, `schema_name` TEXT, `table_name` TEXT, `fingerprint` TEXT, "
+                         "`payload` BLOB, `size` INTEGER, `used_at` REAL, "
+                         "PRIMARY KEY (`server`, `schema_name`, `table_name`))")
+        # 块格式与快照相同，块格式或字段列表变了旧缓存就不能用了
+        fields = json.dumps([SNAPSHOT_VERSION, COLUMN_FIELDS, STATISTIC_FIELDS])
+        row = self._db.execute("SELECT `value` FROM `meta` WHERE `name` = 'fields'").fetchone()
+        if row is None or row[0] != fields:
+            self._db.execute("DELETE FROM `cache`")
+            self._db.execute("REPLACE INTO `meta` VALUES ('fields', ?)", (fields,))
+        self._db.commit()
+
+    def lookup(self, server, database, table_data_dic):
+        """
+        返回 (column_data_dic, statistic_data_dic, misses)，misses 为需要重新查询的表名
+        """
+        with self._lock:
+            cached = dict((table_name, (fingerprint, payload)) for table_name, fingerprint, payload in self._db.execute(
+                "SELECT `table_name`, `fingerprint`, `payload` FROM `cache` WHERE `server` = ? AND `schema_name` = ?",
+                (server, database)))
+
+        column_data_dic = {}
+        statistic_data_dic = {}
+        hits = []
+        misses = []
+        for table_name, table_data in table_data_dic.items():
+            entry = cached.get(table_name)
+            if entry is not None and entry[0] == table_fingerprint(table_data):
+                block = decode_table_block(entry[1])
+                column_data_dic[table_name] = block['columns']
+                statistic_data_dic[table_name] = block['statistics']
+                hits.append(table_name)
+            else:
+                misses.append(table_name)
+
+        with self._lock:
+            now = time.time()
+            self._db.executemany("UPDATE `cache` SET `used_at` = ? WHERE `server` = ? AND `schema_name` = ? AND `table_name` = ?",
+                                 [(now, server, database, table_name) for table_name in hits])
+            self._db.commit()
+            self.hits += len(hits)
+            self.misses += len(misses)
+        return column_data_dic, statistic_data_dic, misses
+
+    def store(self, server, database, table_data_dic, column_data_dic, statistic_data_dic, table_names):
+        """
+        保存 table_names 这些表的字段、索引信息
+        """
+        now = time.time()
+        rows = []
+        for table_name in table_names:
+            payload = encode_table_block(None, column_data_dic.get(table_name, []), statistic_data_dic.get(table_name, []),
+                                         [], [])
+            rows.append((server, database, table_name, table_fingerprint(table_data_dic[table_name]),
+                         payload, len(payload), now))
+        with self._lock:
+            self._db.executemany("REPLACE INTO `cache` VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def evict(self):
+        """
+        删除超过 max_age 秒未使用的条目，再按最近使用时间淘汰到 max_size 字节以内
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM `cache` WHERE `used_at` < ?", (time.time() - self.max_age,))
+            total = 0
+            expired = []
+            for rowid, size in self._db.execute("SELECT `rowid`, `size` FROM `cache` ORDER BY `used_at` DESC"):
+                total += size
+                if total > self.max_size:
+                    expired.append((rowid,))
+            self._db.executemany("DELETE FROM `cache` WHERE `rowid` = ?", expired)
+            self._db.commit()
+
+    def close(self):
+        self.evict()
+        self._db.close()
+
+
+def submit_table_details(executor, cache, backend, database, metadata, table_names=None, name_filter=None):
+    """
+    为 table_names（None 表示全部表）补齐 metadata 的字段和索引信息：
+    有缓存时先按表指纹查缓存，只为失效或未缓存的表提交查询，整库查询时带上 name_filter；
+    返回 (futures, misses)
+    """
+    if table_names is None:
+        table_names = list(metadata['tables'])
+    if cache is not None:
+        metadata['columns'], metadata['statistics'], misses = cache.lookup(
+            backend.server, database, dict((table_name, metadata['tables'][table_name]) for table_name in table_names))
+    else:
+        metadata['columns'], metadata['statistics'], misses = {}, {}, table_names
+    if not misses:
+        return {}, misses
+    # 大部分表都要查时直接整库查询，比很长的 IN 列表便宜
+    query_table_names = misses if len(misses) * 2 <= len(metadata['tables']) else None
+    return {
+        'columns': executor.submit(backend.get_columns, database, query_table_names, name_filter),
+        'statistics': executor.submit(backend.get_statistics, database, query_table_names, name_filter),
+    }, misses
 
-            if cur_pos >= local_pos:
-                target_columns[k]['ORDINAL_POSITION'] = target_columns[k]['ORDINAL_POSITION'] - 1
 
-    return target_columns
+def wait_table_details(cache, server, database, metadata, futures, misses):
+    """
+    等待 submit_table_details() 的查询完成，合并结果，有缓存时写回缓存
+    """
+    if not futures:
+        return metadata
+    fetched = wait_metadata(futures)
+    for table_name in misses:
+        metadata['columns'][table_name] = fetched['columns'].get(table_name, [])
+        metadata['statistics'][table_name] = fetched['statistics'].get(table_name, [])
+    if cache is not None:
+        cache.store(server, database, metadata['tables'], metadata['columns'], metadata['statistics'], misses)
+    return metadata
+
+
+def same_digest_tables(source_metadata, target_metadata):
+    """
+    两边结构摘要相同的表，不需要再比较字段和索引
+    """
+    if 'digests' not in source_metadata or 'digests' not in target_metadata:
+        return set()
+    source_digests = source_metadata['digests']
+    target_digests = target_metadata['digests']
+    return set(table_name for table_name in source_metadata['tables']
+               if table_name in target_metadata['tables']
+               and source_digests.get(table_name) == target_digests.get(table_name))
 
 
-def filter_statistics(statistic):
-    return {
-        'NON_UNIQUE': statistic['NON_UNIQUE'],
-        'INDEX_NAME': statistic['INDEX_NAME'],
-        'SEQ_IN_INDEX': statistic['SEQ_IN_INDEX'],
-        'COLUMN_NAME': statistic['COLUMN_NAME'],
-        'SUB_PART': statistic['SUB_PART'],
-        'INDEX_TYPE': statistic['INDEX_TYPE'],
+def fetch_metadata(executor, sides, cache=None, digest=False, source_metadata=None, name_filter=None):
+    """
+    并发读取元数据，sides 为 [(backend, database), ...]。
+    不用缓存也不比较摘要时一轮查完；否则先查表信息（和结构摘要），
+    再只为需要的表查询字段和索引。
+    digest 时：给出已加载的 source_metadata（含摘要）则 sides 都是与之比较的 target，
+    否则 sides 为 [source, target] 两边；只有一边时只多查一次摘要。
+    name_filter 对两边都生效，服务器上没能过滤掉的表读取后再去掉
+    """
+    details = cache is None and not digest
+    futures_list = [submit_metadata(executor, backend, database, details=details, digest=digest, name_filter=name_filter)
+                    for backend, database in sides]
+    metadata_list = [filter_metadata(wait_metadata(futures), name_filter) for futures in futures_list]
+    if details:
+        return metadata_list
+
+    table_names_list = [None] * len(sides)
+    if digest and source_metadata is not None:
+        table_names_list = [[table_name for table_name in source_metadata['tables']
+                             if table_name in metadata['tables']
+                             and table_name not in same_digest_tables(source_metadata, metadata)]
+                            for metadata in metadata_list]
+    elif digest and len(sides) == 2:
+        source_metadata, target_metadata = metadata_list
+        same_tables = same_digest_tables(source_metadata, target_metadata)
+        source_table_names = [table_name for table_name in source_metadata['tables'] if table_name not in same_tables]
+        target_table_names = [table_name for table_name in source_table_names if table_name in target_metadata['tables']]
+        table_names_list = [source_table_names, target_table_names]
+
+    submitted = [submit_table_details(executor, cache, backend, database, metadata, table_names, name_filter)
+                 for (backend, database), metadata, table_names in zip(sides, metadata_list, table_names_list)]
+    for (backend, database), metadata, (futures, misses) in zip(sides, metadata_list, submitted):
+        wait_table_details(cache, backend.server, database, metadata, futures, misses)
+    return metadata_list
+
+
+def open_metadata_pages(executor, backend, database, page_size, name_filter=None):
+    """
+    分页读取一个库的元数据，内存只与一页的大小有关：
+    返回 (header, pages)，header 含 version / schema 和整库外键反查的 referenced_tables（只与外键数量有关）；pages 为迭代器，
+    按表名（二进制序）逐页产出与 fetch_metadata() 结构相同、只含这一页 page_size 张表的 metadata，
+    每页先按 keyset 读 TABLES，再并发读取这些表的字段、索引、分区和外键；上一页用完才读下一页
+    """
+    futures = {
+        'version': executor.submit(backend.get_server_version),
+        'schema': executor.submit(backend.get_schema, database),
+        'foreign_keys': executor.submit(backend.get_foreign_keys, database),
     }
+    header = wait_metadata(futures)
+    header['referenced_tables'] = get_referenced_tables(header.pop('foreign_keys'))
+
+    def iter_pages():
+        after = ''
+        while after is not None:
+            first = after == ''
+            after, tables = backend.get_table_page(database, after, page_size, name_filter)
+            if not tables:
+                if first and after is None and name_filter is None:
+                    raise Exception('源数据库 `%s` 没有数据表。' % database)
+                continue
+            table_names = list(tables)
+            page = wait_metadata(dict((part, executor.submit(getattr(backend, 'get_%s' % part), database, table_names))
+                                      for part in ('columns', 'statistics', 'partitions', 'foreign_keys')))
+            page.update(header, tables=tables)
+            yield page
+
+    return header, iter_pages()
+
+
+def diff_table_changes(source_table_name, source_metadata, target_metadata, same_tables=()):
+    """
+    比较源库中的一张表，返回 TableChanges：target 中不存在为 CREATE（全部字段、索引都是 ADD），
+    否则为 ALTER，changes 按子句顺序排列，并按目标库版本和表大小估计执行方式和代价
+    """
+    source_table_data = source_metadata['tables'][source_table_name]
+    source_columns, source_columns_pos = get_column_dic_and_pos(source_metadata['columns'].get(source_table_name, []))
+    source_statistics = get_statistics(source_metadata['statistics'].get(source_table_name, []))
+    target_version = parse_server_version(target_metadata.get('version'))
+
+    if source_table_name not in target_metadata['tables']:
+        # CREATE TABLE...
+        changes = []
+        if source_columns:
+            changes += [ColumnChange('ADD', column_name, column, None,
+                                     get_column_after(column.ordinal_position, source_columns_pos), column.ordinal_position)
+                        for column_name, column in source_columns.items()]
+            changes += [IndexChange('ADD', index_name, index, None, None) for index_name, index in source_statistics.items()]
+            changes += [ForeignKeyChange('ADD', foreign_key.constraint_name, foreign_key, None)
+                        for foreign_key in source_metadata.get('foreign_keys', {}).get(source_table_name, [])]
+            source_partitions = source_metadata.get('partitions', {}).get(source_table_name)
+            if source_partitions:
+                changes.append(PartitionChange('MANUAL' if source_partitions[0].subpartition_method else 'PARTITION',
+                                               (), tuple(source_partitions), None, 0))
+        return TableChanges(source_table_name, 'CREATE', tuple(changes), source_table_data, None, target_version,
+                            None, None, 0, None, (), ())
+
+    target_table_data = target_metadata['tables'][source_table_name]
+    changes = []
+    for option in ('engine', 'table_collation'):
+        if getattr(source_table_data, option) != getattr(target_table_data, option):
+            changes.append(OptionChange(option.upper(), getattr(source_table_data, option), getattr(target_table_data, option)))
+    # 外键、分区不在结构摘要内，总是比较；只有一边读取了这部分信息（如外部构造的元数据）时不比较
+    trailing_changes = []
+    if 'foreign_keys' in source_metadata and 'foreign_keys' in target_metadata:
+        trailing_changes += get_foreign_key_changes(source_metadata['foreign_keys'].get(source_table_name, []),
+                                                    target_metadata['foreign_keys'].get(source_table_name, []))
+    if 'partitions' in source_metadata and 'partitions' in target_metadata:
+        trailing_changes += get_partition_changes(source_metadata['partitions'].get(source_table_name, []),
+                                                  target_metadata['partitions'].get(source_table_name, []),
+                                                  target_table_data)
+    if source_table_name in same_tables:
+        return TableChanges(source_table_name, 'ALTER', tuple(changes + trailing_changes), source_table_data,
+                            target_table_data, target_version, None, None, 0, None, (), ())
+
+    # ALTER TABLE
+    target_columns, _ = get_column_dic_and_pos(target_metadata['columns'].get(source_table_name, []))
+    target_statistics = get_statistics(target_metadata['statistics'].get(source_table_name, []))
+    alter_clauses = []
+    # for column
+    if source_columns and target_columns and source_columns != target_columns:
+        # drop column
+        for column_name, column in target_columns.items():
+            if column_name not in source_columns:
+                changes.append(ColumnChange('DROP', column_name, None, column, None, None))
+                alter_clauses.append(classify_column_change('DROP', None, column, target_version))
+
+        # add / modify column: 按 source 顺序逐个处理，保持不动的字段之外才带 AFTER / FIRST
+        stable_columns = get_stable_columns(list(source_columns), list(target_columns))
+        # 最后一个两边都有的字段之后新增的字段是追加在表尾
+        last_common_position = max([column.ordinal_position for column_name, column in source_columns.items()
+                                    if column_name in target_columns] or [0])
+        for column_name, column in source_columns.items():
+            after = get_column_after(column.ordinal_position, source_columns_pos)
+            if column_name not in target_columns:
+                changes.append(ColumnChange('ADD', column_name, column, None, after, column.ordinal_position))
+                alter_clauses.append(classify_column_change(
+                    'ADD' if column.ordinal_position < last_common_position else 'APPEND', column, None, target_version))
+                continue
+            if not same_column_definition(column, target_columns[column_name]):
+                action = 'MODIFY'
+                if column_name in stable_columns:
+                    after = None
+            elif column_name not in stable_columns:
+                action = 'MOVE'
+            else:
+                continue
+            changes.append(ColumnChange(action, column_name, column, target_columns[column_name], after,
+                                        column.ordinal_position))
+            alter_clauses.append(classify_column_change(
+                'MOVE' if after is not None else 'MODIFY', column, target_columns[column_name], target_version))
+
+    # for index
+    if source_statistics and source_statistics != target_statistics:
+        # index diff: 按签名 (唯一性, 有序字段及前缀长度, 索引类型) 哈希比较
+        source_signatures = dict((index_name, get_index_signature(index))
+                                 for index_name, index in source_statistics.items())
+        target_signatures = dict((index_name, get_index_signature(index))
+                                 for index_name, index in target_statistics.items())
+
+        # rename: 名字只在一边存在但签名相同的索引 (PRIMARY 除外)
+        rename_candidates = {}
+        for index_name, signature in target_signatures.items():
+            if index_name not in source_signatures and 'PRIMARY' != index_name:
+                rename_candidates.setdefault(signature, []).append(index_name)
+        renamed_indexes = {}
+        for index_name, signature in source_signatures.items():
+            if index_name not in target_signatures and 'PRIMARY' != index_name and rename_candidates.get(signature):
+                renamed_indexes[index_name] = rename_candidates[signature].pop(0)
+        renamed_target_indexes = set(renamed_indexes.values())
+
+        # drop index for index name
+        for target_index_name, index in target_statistics.items():
+            if target_index_name not in source_signatures and target_index_name not in renamed_target_indexes:
+                changes.append(IndexChange('DROP', target_index_name, None, index, None))
+                alter_clauses.append(classify_index_change('DROP', target_index_name))
+        for index_name, index in source_statistics.items():
+            if index_name in target_signatures:
+                # modify index = DROP INDEX ... AND ADD KEY ...
+                if source_signatures[index_name] != target_signatures[index_name]:
+                    changes.append(IndexChange('MODIFY', index_name, index, target_statistics[index_name], None))
+                    alter_clauses.append(classify_index_change('MODIFY', index_name))
+            elif index_name in renamed_indexes:
+                # RENAME INDEX 只改元数据，不重建索引；MySQL 5.7、MariaDB 10.5.2 之前没有 RENAME INDEX，按 DROP + ADD 估计
+                changes.append(IndexChange('RENAME', index_name, index, target_statistics[renamed_indexes[index_name]],
+                                           renamed_indexes[index_name]))
+                alter_clauses.append(classify_index_change('RENAME' if has_rename_index(target_version) else 'MODIFY',
+                                                           index_name))
+            else:
+                changes.append(IndexChange('ADD', index_name, index, None, None))
+                alter_clauses.append(classify_index_change('ADD', index_name))
+
+    algorithm, lock, cost = None, None, 0
+    online_key = None
+    foreign_key_tables = ()
+    if alter_clauses:
+        algorithm, lock, cost = get_alter_cost(alter_clauses, target_table_data, target_version)
+        online_key = get_online_key(target_statistics, target_columns, source_columns)
+        foreign_key_tables = get_foreign_key_tables(source_table_name, target_metadata)
+    return TableChanges(source_table_name, 'ALTER', tuple(changes + trailing_changes), source_table_data,
+                        target_table_data, target_version, algorithm, lock, cost, online_key,
+                        tuple(column_name for column_name in target_columns if column_name in source_columns),
+                        foreign_key_tables)
+
+
+def get_foreign_key_tables(table_name, target_metadata):
+    """
+    target 中与这张表有外键关系的表名（排序）：本表外键引用的表、外键引用本表的同库表；
+    分页读取的页只含部分表的外键，引用本表的表取自 header 中整库的 referenced_tables；没有外键信息时返回 None
+    """
+    if 'foreign_keys' not in target_metadata:
+        return None
+    tables = set(foreign_key.referenced_table if foreign_key.referenced_schema is None else
+                 '%s.%s' % (foreign_key.referenced_schema, foreign_key.referenced_table)
+                 for foreign_key in target_metadata['foreign_keys'].get(table_name, []))
+    if 'referenced_tables' in target_metadata:
+        tables.update(target_metadata['referenced_tables'].get(table_name, ()))
+    else:
+        tables.update(get_referenced_tables(target_metadata['foreign_keys']).get(table_name, ()))
+    return tuple(sorted(tables))
+
+
+def get_referenced_tables(foreign_keys):
+    """
+    按外键反查：被引用的同库表名 -> 引用它的其它表名集合
+    """
+    referenced_tables = {}
+    for table_name, table_foreign_keys in foreign_keys.items():
+        update_referenced_tables(referenced_tables, table_name, (), table_foreign_keys)
+    return referenced_tables
+
+
+def update_referenced_tables(referenced_tables, table_name, old_foreign_keys, new_foreign_keys):
+    """
+    一张表的外键从 old_foreign_keys 变为 new_foreign_keys 时，就地更新 get_referenced_tables() 的反查结果
+    """
+    for foreign_key in old_foreign_keys:
+        if foreign_key.referenced_schema is None and foreign_key.referenced_table != table_name:
+            referenced_tables.get(foreign_key.referenced_table, set()).discard(table_name)
+    for foreign_key in new_foreign_keys:
+        if foreign_key.referenced_schema is None and foreign_key.referenced_table != table_name:
+            referenced_tables.setdefault(foreign_key.referenced_table, set()).add(table_name)
+
+
+def get_change_notes(table_changes):
+    """
+    TableChanges 的差异说明，每个变更一行（索引先列出需要删除的，再列出需要新增、改名的）
+    """
+    table_name = table_changes.table_name
+    if table_changes.action == 'DROP':
+        return ['TABLE: {} SRC no exist but DES exist, need drop'.format(table_name)]
+    if table_changes.action == 'CREATE':
+        if not table_changes.changes:
+            return []
+        return ['TABLE: {} SRC exist but DES not exist, need add DES table'.format(table_name)] + \
+            [get_partition_note(table_name, change) for change in table_changes.changes
+             if isinstance(change, PartitionChange) and change.action == 'MANUAL']
+
+    notes = []
+    index_add_notes = []
+    trailing_notes = []
+    for change in table_changes.changes:
+        if isinstance(change, PartitionChange):
+            trailing_notes.append(get_partition_note(table_name, change))
+        elif isinstance(change, ForeignKeyChange):
+            trailing_notes.append({
+                'DROP': 'TABLE: {} FOREIGN KEY: {} SRC no exist but DES exist, need drop DES foreign key',
+                'ADD': 'TABLE: {} FOREIGN KEY: {} SRC exist but DES not exist, need add DES foreign key',
+                'MODIFY': 'TABLE: {} FOREIGN KEY: {} SRC and DES is different, need drop and add DES foreign key',
+            }[change.action].format(table_name, change.constraint_name))
+        elif isinstance(change, OptionChange):
+            notes.append('TABLE: {} SRC {} is {} but DES {} is {}'.format(
+                table_name, change.option, change.source, change.option, change.target))
+        elif isinstance(change, ColumnChange):
+            notes.append({
+                'DROP': 'TABLE: {} COLUMN: {} SRC no exist but DES exist, need drop DES column',
+                'ADD': 'TABLE: {} COLUMN: {} SRC exist but DES not exist, need add DES column',
+                'MODIFY': 'TABLE: {} COLUMN: {} SRC and DES is different, need modify DES column',
+                'MOVE': 'TABLE: {} COLUMN: {} SRC and DES position is different, need move DES column',
+            }[change.action].format(table_name, change.column_name))
+        else:
+            if change.action in ('DROP', 'MODIFY'):
+                notes.append('TABLE: {} INDEX: {} SRC not exist  but DES exist, need drop DES index'.format(
+                    table_name, change.index_name))
+            if change.action == 'RENAME':
+                index_add_notes.append('TABLE: {} INDEX: {} SRC and DES is same but name is different, '
+                                       'need rename DES index {}'.format(table_name, change.index_name, change.old_name))
+            elif change.action in ('ADD', 'MODIFY'):
+                index_add_notes.append('TABLE: {} INDEX: {} SRC exist but DES not exist, need add DES index'.format(
+                    table_name, change.index_name))
+    return notes + index_add_notes + trailing_notes
+
+
+def get_partition_note(table_name, change):
+    """
+    一个分区变更的差异说明
+    """
+    partition_names = ','.join(change.partition_names)
+    if change.action == 'ADD' and not change.partitions:
+        return 'TABLE: {} SRC has {} more partitions than DES, need add DES partitions, estimated cost {}'.format(
+            table_name, change.count, format_size(change.cost))
+    if change.action == 'ADD':
+        return 'TABLE: {} PARTITION: {} SRC exist but DES not exist, need add DES partition'.format(
+            table_name, ','.join(partition.partition_name for partition in change.partitions))
+    if change.action == 'DROP':
+        return 'TABLE: {} PARTITION: {} SRC no exist but DES exist, need drop DES partition'.format(
+            table_name, partition_names)
+    if change.action == 'REORGANIZE':
+        return 'TABLE: {} PARTITION: {} SRC and DES is different, need reorganize DES partition into {}, ' \
+               'estimated cost {}'.format(table_name, partition_names,
+                                          ','.join(partition.partition_name for partition in change.partitions),
+                                          format_size(change.cost))
+    if change.action == 'COALESCE':
+        return 'TABLE: {} SRC has {} fewer partitions than DES, need coalesce DES partitions, estimated cost {}'.format(
+            table_name, change.count, format_size(change.cost))
+    if change.action == 'PARTITION':
+        return 'TABLE: {} SRC and DES partitions is different, need repartition DES table by {}, ' \
+               'estimated cost {}'.format(table_name, get_partition_scheme(change.partitions[0]), format_size(change.cost))
+    if change.action == 'REMOVE':
+        return 'TABLE: {} SRC is not partitioned but DES is, need remove DES partitioning, estimated cost {}'.format(
+            table_name, format_size(change.cost))
+    return 'TABLE: {} SRC and DES subpartitions is different, need repartition DES table manually'.format(table_name)
+
+
+def get_change_clauses(change, default_character, version=ServerVersion(5, 7, 0, None)):
+    """
+    一个字段 / 索引变更的 ALTER 子句，version 为目标库版本（MySQL 5.7、MariaDB 10.5.2 之前没有 RENAME INDEX，改为 DROP + ADD）；
+    表选项变更只报告，没有子句；
+    外键变更由 get_foreign_key_statements()、分区变更由 get_partition_statement() 单独生成
+    """
+    if isinstance(change, ColumnChange):
+        if change.action == 'DROP':
+            return ["  DROP COLUMN `%s`" % change.column_name]
+        return ["  {action} COLUMN `{column_name}` {definition}{after}".format(
+            action='ADD' if change.action == 'ADD' else 'MODIFY', column_name=change.column_name,
+            definition=get_column_definition(change.source, default_character),
+            after='' if change.after is None else ' ' + change.after)]
+    if isinstance(change, IndexChange):
+        clauses = []
+        if change.action in ('DROP', 'MODIFY'):
+            clauses.append("  DROP PRIMARY KEY" if 'PRIMARY' == change.index_name else "  DROP INDEX `%s`" % change.index_name)
+        if change.action == 'RENAME' and has_rename_index(version):
+            clauses.append("  RENAME INDEX `%s` TO `%s`" % (change.old_name, change.index_name))
+        elif change.action == 'RENAME':
+            clauses += ["  DROP INDEX `%s`" % change.old_name, "  ADD %s" % get_add_keys(change.source)]
+        elif change.action in ('ADD', 'MODIFY'):
+            clauses.append("  ADD %s" % get_add_keys(change.source))
+        return clauses
+    return []
+
+
+def render_table_changes(table_changes, default_character, ddl_algorithm=False, online=None):
+    """
+    把 TableChanges 生成为语句：DROP / CREATE / ALTER；ddl_algorithm 时 ALTER 加上 ALGORITHM= / LOCK= 子句，
+    超过 online 阈值且需要重建或扫描的表改为生成在线变更计划（影子表 + 触发器 + 分批复制 + RENAME）；
+    有外键变更时第一条语句为删除外键、最后一条为新增外键；
+    返回 (diff_sql, diff, 估计代价)
+    """
+    table_name = table_changes.table_name
+    diff = get_change_notes(table_changes)
+    drop_foreign_key_sql, add_foreign_key_sql = get_foreign_key_statements(table_name, table_changes.changes)
+    if table_changes.action == 'DROP':
+        return drop_foreign_key_sql + ["DROP TABLE IF EXISTS `%s`;" % table_name], diff, 0
+
+    if table_changes.action == 'CREATE':
+        if not table_changes.changes:
+            return [], diff, 0
+        columns = [change for change in table_changes.changes if isinstance(change, ColumnChange)]
+        indexes = [change for change in table_changes.changes if isinstance(change, IndexChange)]
+        create_tables = ["CREATE TABLE IF NOT EXISTS `%s` (" % table_name]
+        # COLUMN...
+        for change in columns:
+            create_tables.append("  `{column_name}` {definition}{dot}".format(
+                column_name=change.column_name, definition=get_column_definition(change.source, default_character),
+                dot=',' if change is not columns[-1] or indexes else ''))
+        # key
+        create_tables.append(",\n".join("  {key_slot}".format(key_slot=get_add_keys(change.source)) for change in indexes))
+        partitions = [change for change in table_changes.changes
+                      if isinstance(change, PartitionChange) and change.action == 'PARTITION']
+        create_tables.append(") ENGINE={engine} DEFAULT CHARSET={charset}{partition};".format(
+            engine=table_changes.source.engine, charset=default_character,
+            partition=''.join('\n' + get_partition_clause(change.partitions) for change in partitions)))
+        return ["\n".join(create_tables)] + add_foreign_key_sql, diff, 0
+
+    # ALTER LIST...
+    alter_columns = [clause for change in table_changes.changes
+                     for clause in get_change_clauses(change, default_character, table_changes.version)]
+    # 分区操作不能和其它子句写在同一条 ALTER 中，每个单独一条，放在最后
+    partition_changes = [change for change in table_changes.changes if isinstance(change, PartitionChange)]
+    partition_sql = [statement for statement in (get_partition_statement(table_name, change) for change in partition_changes)
+                     if statement is not None]
+    statement_cost = sum(change.cost for change in partition_changes)
+    # foreign_key_checks 开启时 ADD FOREIGN KEY 只能 COPY
+    if add_foreign_key_sql:
+        statement_cost += (table_changes.target.data_length or 0) + (table_changes.target.index_length or 0)
+    if not alter_columns:
+        return drop_foreign_key_sql + partition_sql + add_foreign_key_sql, diff, statement_cost
+    target_table_data = table_changes.target
+    diff.append('TABLE: {} ALTER ALGORITHM is {} LOCK is {}, estimated cost {} ({} rows)'.format(
+        table_name, table_changes.algorithm, table_changes.lock, format_size(table_changes.cost),
+        target_table_data.table_rows or 0))
+    if table_changes.cost > 0 and is_online_table(target_table_data, online):
+        # 影子表由 CREATE TABLE ... LIKE 建立，不带外键：本表的外键会丢失，引用本表的外键切换后指向旧表，旧表删不掉
+        if table_changes.foreign_key_tables is None:
+            diff.append('TABLE: {} is large but its foreign keys are unknown, keep direct ALTER'.format(table_name))
+        elif table_changes.foreign_key_tables:
+            diff.append('TABLE: {} is large but has foreign keys with {}, keep direct ALTER'.format(
+                table_name, ', '.join('`%s`' % name for name in table_changes.foreign_key_tables)))
+        elif not has_trigger_order(table_changes.version):
+            # MySQL 5.7.2、MariaDB 10.2.3 之前同一事件只能有一个触发器，而多语句的触发器体（BEGIN ... END）不能直接交给 mysql 客户端执行
+            diff.append('TABLE: {} is large but online schema change needs MySQL 5.7.2 or MariaDB 10.2.3 or later, '
+                        'keep direct ALTER'.format(table_name))
+        elif not target_table_data.table_rows or not target_table_data.avg_row_length:
+            # 没有行数统计就无法按主键范围切分，复制会变成一条锁住整张表的 INSERT ... SELECT
+            diff.append('TABLE: {} is large but TABLE_ROWS / AVG_ROW_LENGTH are missing, '
+                        'keep direct ALTER'.format(table_name))
+        elif table_changes.online_key is not None and target_table_data.auto_increment:
+            online_sql, chunk_count = get_online_plan(table_name, target_table_data, alter_columns, table_changes.online_key,
+                                                      table_changes.copy_columns, online.chunk_size)
+            diff.append('TABLE: {} is large, need online schema change by PRIMARY KEY `{}` in {} chunks'.format(
+                table_name, table_changes.online_key, chunk_count))
+            return drop_foreign_key_sql + online_sql + partition_sql + add_foreign_key_sql, diff, \
+                table_changes.cost + statement_cost
+        else:
+            diff.append('TABLE: {} is large but PRIMARY KEY is not a single integer AUTO_INCREMENT column, '
+                        'keep direct ALTER'.format(table_name))
+    if ddl_algorithm and table_changes.version >= (5, 6, 0):
+        # 5.6 之前没有 ALGORITHM / LOCK 子句；ALGORITHM=INSTANT 只能配 LOCK=DEFAULT
+        alter_columns.append("  ALGORITHM=%s, LOCK=%s" % (
+            table_changes.algorithm, 'DEFAULT' if table_changes.algorithm == 'INSTANT' else table_changes.lock))
+    return drop_foreign_key_sql + ["ALTER TABLE `%s`\n%s;" % (table_name, ',\n'.join(alter_columns))] + \
+        partition_sql + add_foreign_key_sql, diff, table_changes.cost + statement_cost
+
+
+def diff_table(source_table_name, source_metadata, target_metadata, same_tables=(), ddl_algorithm=False,
+               online=None):
+    """
+    比较源库中的一张表并生成语句：diff_table_changes() + render_table_changes()；
+    返回 (diff_sql, diff, 估计代价)
+    """
+    _, source_default_character = source_metadata['schema']
+    return render_table_changes(diff_table_changes(source_table_name, source_metadata, target_metadata, same_tables),
+                                source_default_character, ddl_algorithm, online)
+
+
+def iter_schema_changes(source_metadata, target_metadata):
+    """
+    逐表比较 source / target 两边的元数据（fetch_metadata() 或 Snapshot.metadata() 的结果），
+    每比较完一张有差异的表就产出它的 TableChanges；先产出需要 DROP 的表
+    """
+    # 结构摘要相同的表只比较表选项
+    same_tables = same_digest_tables(source_metadata, target_metadata)
+    target_version = parse_server_version(target_metadata.get('version'))
+    # 外键反查整库只算一次，不必每张表扫描全部外键
+    if 'foreign_keys' in target_metadata and 'referenced_tables' not in target_metadata:
+        target_metadata = dict(target_metadata, referenced_tables=get_referenced_tables(target_metadata['foreign_keys']))
+
+    # DROP TABLE...
+    for target_table_name in target_metadata['tables']:
+        if target_table_name not in source_metadata['tables']:
+            yield get_drop_table_changes(target_table_name, target_metadata, target_version)
+
+    for source_table_name in source_metadata['tables']:
+        table_changes = measure_table_changes(source_table_name, source_metadata, target_metadata, same_tables)
+        if table_changes.changes:
+            yield table_changes
+
+
+def get_drop_table_changes(table_name, target_metadata, target_version):
+    """
+    target 中多出的表：DROP，带上它引用同库其它表的外键（DROP）
+    """
+    return TableChanges(table_name, 'DROP', tuple(
+        ForeignKeyChange('DROP', foreign_key.constraint_name, None, foreign_key)
+        for foreign_key in target_metadata.get('foreign_keys', {}).get(table_name, [])
+        if foreign_key.referenced_schema is None and foreign_key.referenced_table != table_name),
+        None, target_metadata['tables'][table_name], target_version, None, None, 0, None, (), ())
+
+
+def measure_table_changes(source_table_name, source_metadata, target_metadata, same_tables=()):
+    """
+    diff_table_changes()，有 --timings 时计入 diff 阶段
+    """
+    if timings is None:
+        return diff_table_changes(source_table_name, source_metadata, target_metadata, same_tables)
+    with timings.measure('diff', source_table_name):
+        return diff_table_changes(source_table_name, source_metadata, target_metadata, same_tables)
+
+
+def iter_page_tables(pages):
+    """
+    open_metadata_pages() 的各页展开为 (表名, 所在页)
+    """
+    for page in pages:
+        for table_name in page['tables']:
+            yield table_name, page
+
+
+def iter_merge_schema_changes(source_pages, target_header, target_pages):
+    """
+    归并连接方式逐表比较：source_pages / target_pages 为 open_metadata_pages() 的页迭代器（都按表名的二进制序），
+    两边同时向前走，每比较完一张有差异的表就产出它的 TableChanges，DROP / CREATE / ALTER 按表名交错；
+    每边同时只持有一页，不需要整库的模型（没有结构摘要，不比较摘要）
+    """
+    target_version = parse_server_version(target_header.get('version'))
+    # target 中不存在的表与这个空页比较（CREATE）
+    empty_page = dict(target_header, tables={}, columns={}, statistics={}, partitions={}, foreign_keys={})
+    source_tables = iter_page_tables(source_pages)
+    target_tables = iter_page_tables(target_pages)
+    source_item = next(source_tables, None)
+    target_item = next(target_tables, None)
+    while source_item is not None or target_item is not None:
+        if source_item is None or (target_item is not None and target_item[0] < source_item[0]):
+            target_table_name, target_page = target_item
+            yield get_drop_table_changes(target_table_name, target_page, target_version)
+            target_item = next(target_tables, None)
+            continue
+        source_table_name, source_page = source_item
+        target_page = empty_page
+        if target_item is not None and target_item[0] == source_table_name:
+            target_page = target_item[1]
+            target_item = next(target_tables, None)
+        table_changes = measure_table_changes(source_table_name, source_page, target_page)
+        if table_changes.changes:
+            yield table_changes
+        source_item = next(source_tables, None)
+
+
+def iter_render_changes(schema_changes, default_character, ddl_algorithm=False, online=None):
+    """
+    逐表生成 iter_schema_changes() 的结果，产出 (表名, diff_sql, diff, 估计代价)
+    """
+    for table_changes in schema_changes:
+        if timings is None:
+            diff_sql, diff, cost = render_table_changes(table_changes, default_character, ddl_algorithm, online)
+        else:
+            with timings.measure('render', table_changes.table_name):
+                diff_sql, diff, cost = render_table_changes(table_changes, default_character, ddl_algorithm, online)
+        if diff_sql or diff:
+            yield table_changes.table_name, diff_sql, diff, cost
+
+
+def iter_schema_diff(source_metadata, target_metadata, ddl_algorithm=False, online=None):
+    """
+    逐表比较 source / target 两边的元数据并生成语句，
+    每比较完一张表就产出 (表名, diff_sql, diff, 估计代价)；先产出需要 DROP 的表
+    """
+    _, source_default_character = source_metadata['schema']
+    return iter_render_changes(iter_schema_changes(source_metadata, target_metadata), source_default_character,
+                               ddl_algorithm, online)
+
+
+def fetch_schema_changes(source, target, jobs=4, cache=None, digest=False, name_filter=None):
+    """
+    作为库使用的入口：source / target 为 (backend, database)，并发读取两边元数据后比较，
+    返回 (TableChanges 列表, source 默认字符集)，交给 render_table_changes() 生成语句；
+    backend 可以在多次调用间复用，连接池中的连接保持打开；name_filter 为 make_table_filter() 的结果
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        source_metadata, target_metadata = fetch_metadata(executor, [source, target], cache, digest,
+                                                          name_filter=name_filter)
+    _, source_default_character = source_metadata['schema']
+    return list(iter_schema_changes(source_metadata, target_metadata)), source_default_character
+
+
+def sort_table_diffs(table_diffs):
+    """
+    iter_schema_diff() 的结果按估计代价从小到大排序，代价相同保持原顺序
+    """
+    return sorted(table_diffs, key=lambda table_diff: table_diff[3])
+
+
+def get_diff_layers(schema_changes, table_diffs):
+    """
+    按外键依赖把 iter_render_changes() 的结果分层：schema_changes 为 TableChanges 列表，
+    table_diffs 为对应的 (表名, diff_sql, diff, 估计代价)，其顺序即层内的顺序。
+    每张表的语句分为 删除外键 / 本表变更 / 新增外键 三组，组内按顺序执行；
+    删除外键的组排在被引用表的变更（含 DROP TABLE）之前，新增外键的组排在被引用表的变更（含 CREATE TABLE）之后，
+    边只会从删除外键的组指向变更组、从变更组指向新增外键的组，不会成环。
+    返回层列表，每层为 [(表名, 语句列表, 估计代价)]，同一层的组之间没有依赖，可以并发执行
+    """
+    table_changes_dic = dict((table_changes.table_name, table_changes) for table_changes in schema_changes)
+    groups = []
+    drop_groups, change_groups, add_groups = {}, {}, {}
+    for table_name, diff_sql, _, cost in table_diffs:
+        if not diff_sql:
+            continue
+        table_changes = table_changes_dic[table_name]
+        foreign_key_actions = set(change.action for change in table_changes.changes if isinstance(change, ForeignKeyChange))
+        # render_table_changes() 中删除外键、新增外键各是第一条、最后一条语句
+        start = 1 if foreign_key_actions & {'DROP', 'MODIFY'} else 0
+        end = len(diff_sql) - 1 if table_changes.action != 'DROP' and foreign_key_actions & {'ADD', 'MODIFY'} \
+            else len(diff_sql)
+        for group_dic, group_sql, group_cost in ((drop_groups, diff_sql[:start], 0), (change_groups, diff_sql[start:end], cost),
+                                                 (add_groups, diff_sql[end:], 0)):
+            if group_sql:
+                group_dic[table_name] = len(groups)
+                groups.append((table_name, group_sql, group_cost))
+
+    edges = [set() for _ in groups]
+    for table_name in change_groups.keys() | drop_groups.keys() | add_groups.keys():
+        chain = [group_dic[table_name] for group_dic in (drop_groups, change_groups, add_groups) if table_name in group_dic]
+        for before, after in zip(chain, chain[1:]):
+            edges[before].add(after)
+        for change in table_changes_dic[table_name].changes:
+            if not isinstance(change, ForeignKeyChange):
+                continue
+            if change.action in ('DROP', 'MODIFY') and change.target.referenced_schema is None \
+                    and change.target.referenced_table != table_name and change.target.referenced_table in change_groups:
+                edges[drop_groups[table_name]].add(change_groups[change.target.referenced_table])
+            if change.action in ('ADD', 'MODIFY') and change.source.referenced_schema is None \
+                    and change.source.referenced_table != table_name and change.source.referenced_table in change_groups:
+                edges[change_groups[change.source.referenced_table]].add(add_groups[table_name])
+
+    indegrees = [0] * len(groups)
+    for afters in edges:
+        for after in afters:
+            indegrees[after] += 1
+    layers = []
+    ready = [index for index, indegree in enumerate(indegrees) if indegree == 0]
+    while ready:
+        layers.append([groups[index] for index in ready])
+        next_ready = []
+        for index in ready:
+            for after in edges[index]:
+                indegrees[after] -= 1
+                if indegrees[after] == 0:
+                    next_ready.append(after)
+        ready = sorted(next_ready)
+    return layers
+
+
+def get_layer_sql(layers):
+    """
+    get_diff_layers() 的结果按层展开为语句列表
+    """
+    return [sql for layer in layers for _, diff_sql, _ in layer for sql in diff_sql]
+
+
+def diff_schema_layers(source_metadata, target_metadata, ddl_algorithm=False, sort_by_cost=False, online=None):
+    """
+    比较 source / target 两边的元数据，
+    返回 (layers, diff)：get_diff_layers() 分好层的语句（sort_by_cost 时层内按估计代价排序），以及差异说明
+    """
+    _, source_default_character = source_metadata['schema']
+    schema_changes = list(iter_schema_changes(source_metadata, target_metadata))
+    table_diffs = list(iter_render_changes(schema_changes, source_default_character, ddl_algorithm, online))
+    if sort_by_cost:
+        table_diffs = sort_table_diffs(table_diffs)
+    return get_diff_layers(schema_changes, table_diffs), [line for _, _, table_diff, _ in table_diffs for line in table_diff]
+
+
+def diff_schema(source_metadata, target_metadata, ddl_algorithm=False, sort_by_cost=False, online=None):
+    """
+    比较 source / target 两边的元数据，
+    返回 (diff_sql, diff)：需要在 target 上执行的语句（按外键依赖排好顺序），以及差异说明
+    """
+    layers, diff = diff_schema_layers(source_metadata, target_metadata, ddl_algorithm, sort_by_cost, online)
+    return get_layer_sql(layers), diff
+
+
+@timed('render')
+def format_diff(diff_sql, diff, default_character):
+    """
+    diff 输出文本：差异说明、SET NAMES 和全部语句
+    """
+    return '\n'.join(diff) + '\n' + 'SET NAMES %s;\n' % default_character + '\n' + '\n\n'.join(diff_sql)
+
+
+@timed('render')
+def format_diff_layers(layers, diff, default_character):
+    """
+    --layers 的输出文本：差异说明、SET NAMES，语句按层输出；
+    每层前的注释标明层号和组数，每组前的注释标明表名，同一层的组可以并发执行，组内语句按顺序执行
+    """
+    blocks = []
+    for number, layer in enumerate(layers, 1):
+        blocks.append('-- LAYER {}/{}: {} groups can run concurrently'.format(number, len(layers), len(layer)))
+        for table_name, diff_sql, _ in layer:
+            blocks.append('-- GROUP: {}\n{}'.format(table_name, '\n\n'.join(diff_sql)))
+    return '\n'.join(diff) + '\n' + 'SET NAMES %s;\n' % default_character + '\n' + '\n\n'.join(blocks)
+
+
+def write_diff_stream(output, table_diffs, default_character):
+    """
+    流式输出 iter_schema_diff() 的结果：每张表比较完立即写出并 flush，
+    第一条输出前先写 SET NAMES，差异说明写成 SQL 注释，输出可以直接交给下游执行；
+    返回写出的语句数
+    """
+    count = 0
+    header = False
+    for table_name, diff_sql, diff, _ in table_diffs:
+        start = time.perf_counter()
+        if not header:
+            output.write('SET NAMES %s;\n\n' % default_character)
+            header = True
+        for diff_line in diff:
+            output.write('-- %s\n' % diff_line)
+        for sql in diff_sql:
+            output.write('%s\n\n' % sql)
+        if not diff_sql:
+            output.write('\n')
+        output.flush()
+        count += len(diff_sql)
+        if timings is not None:
+            timings.add_call('render', time.perf_counter() - start, table_name)
+    return count
+
+
+def get_apply_settings(connection):
+    """
+    获取 目标库会话的 lock_wait_timeout 和 max_execution_time（MySQL 5.7.8 之前 / MariaDB 没有，为 None）
+    """
+    cursor_setting = connection.cursor()
+    cursor_setting.execute("SELECT @@SESSION.lock_wait_timeout")
+    settings = {'lock_wait_timeout': cursor_setting.fetchone()[0], 'max_execution_time': None}
+    try:
+        cursor_setting.execute("SELECT @@SESSION.max_execution_time")
+        settings['max_execution_time'] = cursor_setting.fetchone()[0]
+    except mysql.connector.Error:
+        pass
+    cursor_setting.close()
+    return settings
+
+
+def apply_table_diff(pool, table_name, diff_sql, lock_wait_timeout, stopped, progress):
+    """
+    --apply 的一个任务：在一个连接上按顺序执行一张表的全部语句，
+    stopped 被设置（其他表已失败）后不再开始新的语句；
+    返回 (表名, 已执行语句数, 耗时, 错误信息)
+    """
+    applied = 0
+    start = time.time()
+    if stopped.is_set():
+        return table_name, applied, 0.0, None
+    connection = pool.get_connection()
+    try:
+        cursor_apply = connection.cursor()
+        if lock_wait_timeout is not None:
+            cursor_apply.execute("SET SESSION lock_wait_timeout = %d" % lock_wait_timeout)
+        for sql in diff_sql:
+            if stopped.is_set():
+                break
+            statement_start = time.time()
+            try:
+                cursor_apply.execute(sql)
+            except mysql.connector.Error as e:
+                stopped.set()
+                return table_name, applied, time.time() - start, '%s (statement %d: %s)' % (
+                    e, applied + 1, sql.split('\n', 1)[0])
+            applied += 1
+            progress(table_name, sql, time.time() - statement_start)
+        cursor_apply.close()
+    finally:
+        connection.close()
+    return table_name, applied, time.time() - start, None
+
+
+def apply_diffs(pool, layers, apply_jobs, lock_wait_timeout=None):
+    """
+    在目标库上执行 get_diff_layers() 的结果：逐层执行，一层全部执行完再开始下一层，
+    同一层的不同组并发执行（最多 apply_jobs 组），同一组的语句按顺序执行；
+    任一语句失败后不再开始新的语句，已在执行的语句执行完为止；
+    按层、组的顺序返回 apply_table_diff() 的结果
+    """
+    total = sum(len(diff_sql) for layer in layers for _, diff_sql, _ in layer)
+    stopped = threading.Event()
+    done = [0]
+    lock = threading.Lock()
+
+    def progress(table_name, sql, seconds):
+        with lock:
+            done[0] += 1
+            click.echo('[{}/{}] {:.2f}s {}: {}'.format(done[0], total, seconds, table_name, sql.split('\n', 1)[0]),
+                       err=True)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=apply_jobs) as executor:
+        for layer in layers:
+            futures = [executor.submit(apply_table_diff, pool, table_name, diff_sql, lock_wait_timeout, stopped, progress)
+                       for table_name, diff_sql, _ in layer]
+            results.extend(future.result() for future in futures)
+    return results
+
+
+def expand_target_template(template):
+    """
+    展开 DSN 模板中的 {start..end} 分片范围，start 有前导零时按其宽度补零
+    """
+    match = TARGET_RANGE.search(template)
+    if match is None:
+        return [template]
+    start, end = match.group(1), match.group(2)
+    width = len(start) if start.startswith('0') else 0
+    targets = []
+    for number in range(int(start), int(end) + 1):
+        targets.extend(expand_target_template('%s%0*d%s' % (template[:match.start()], width, number,
+                                                            template[match.end():])))
+    return targets
+
+
+def expand_targets(lines):
+    """
+    解析 --targets-file：每行一个 DSN 或 DSN 模板，空行和 # 开头的行忽略
+    """
+    targets = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            targets.extend(expand_target_template(line))
+    return targets
+
+
+def init_fleet_worker(source_snapshot_path):
+    """
+    fleet 子进程初始化：每个进程只打开一次源库快照（mmap，各进程共享页缓存）
+    """
+    global fleet_source_snapshot
+    fleet_source_snapshot = Snapshot(source_snapshot_path)
+
+
+def diff_fleet_target(target, target_database, jobs, output_dir, name_filter=None, ddl_algorithm=False,
+                      sort_by_cost=False, online=None, show_layers=False):
+    """
+    fleet 子进程：读取一个目标库（只读通过 name_filter 的表），与源库快照比较，结果写到 output_dir/<host>_<port>.sql，
+    ddl_algorithm / sort_by_cost / online / show_layers 与单个目标库时相同；
+    返回 (server, 语句数, 错误信息)
+    """
+    server = get_server_name(target)
+    backend = None
+    try:
+        backend = MySQLBackend.connect(target, jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            target_metadata, = fetch_metadata(executor, [(backend, target_database)], name_filter=name_filter)
+        source_metadata = fleet_source_snapshot.metadata(name_filter)
+        layers, diff = diff_schema_layers(source_metadata, target_metadata, ddl_algorithm, sort_by_cost, online)
+        diff_sql = get_layer_sql(layers)
+        _, source_default_character = source_metadata['schema']
+        with open(os.path.join(output_dir, '%s.sql' % re.sub(r'[^\w.-]', '_', server)), 'w') as f:
+            if diff_sql and show_layers:
+                f.write(format_diff_layers(layers, diff, source_default_character) + '\n')
+            elif diff_sql:
+                f.write(format_diff(diff_sql, diff, source_default_character) + '\n')
+        return server, len(diff_sql), None
+    except Exception as e:
+        return server, None, str(e)
+    finally:
+        if backend is not None:
+            backend.close()
+
+
+def diff_fleet(source_snapshot_path, targets, target_database, jobs, processes, output_dir, name_filter=None,
+               ddl_algorithm=False, sort_by_cost=False, online=None, show_layers=False):
+    """
+    用进程池把一个源库快照与全部目标库比较，按 targets 顺序返回 diff_fleet_target() 的结果
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    results = [None] * len(targets)
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_fleet_worker,
+                             initargs=(source_snapshot_path,)) as executor:
+        futures = dict((executor.submit(diff_fleet_target, target, target_database, jobs, output_dir, name_filter,
+                                        ddl_algorithm, sort_by_cost, online, show_layers), index)
+                       for index, target in enumerate(targets))
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            click.echo('[{}/{}] {}'.format(done, len(targets), results[futures[future]][0]), err=True)
+    return results
+
+
+def parse_db_pairs(db_values):
+    """
+    解析全部 --db 参数为 [(source_db, target_db)]，只写 <db> 时两边同名；
+    target_db 可以是 * / ? 通配符
+    """
+    db_pairs = []
+    for db_value in db_values:
+        source_database, _, target_database = db_value.partition(':')
+        db_pairs.append((source_database, target_database or source_database))
+    return db_pairs
+
+
+def is_db_pattern(database):
+    return '*' in database or '?' in database
+
+
+def resolve_db_pairs(connection, db_pairs):
+    """
+    展开 target_db 中的通配符：只查询一次 SCHEMATA，在本地匹配全部模式
+    """
+    if not any(is_db_pattern(target_database) for _, target_database in db_pairs):
+        return db_pairs
+    cursor_schema = connection.cursor()
+    cursor_schema.execute("SELECT `SCHEMA_NAME` FROM `information_schema`.`SCHEMATA` ORDER BY `SCHEMA_NAME` ASC")
+    schema_names = [row[0] for row in cursor_schema.fetchall()]
+    cursor_schema.close()
+
+    resolved = []
+    for source_database, target_database in db_pairs:
+        if is_db_pattern(target_database):
+            resolved.extend((source_database, schema_name) for schema_name in schema_names
+                            if fnmatch.fnmatchcase(schema_name, target_database))
+        else:
+            resolved.append((source_database, target_database))
+    return resolved
+
+
+def diff_db_pair(executor, backend, source_metadata, target_database, cache=None, digest=False,
+                 ddl_algorithm=False, online=None, name_filter=None):
+    """
+    多库调度中的一个任务：读取一个目标库，与已加载的源库模型比较，
+    返回 (TableChanges 列表, iter_render_changes() 的逐表结果列表)
+    """
+    digest = digest and 'digests' in source_metadata
+    target_metadata, = fetch_metadata(executor, [(backend, target_database)], cache, digest, source_metadata, name_filter)
+    _, source_default_character = source_metadata['schema']
+    schema_changes = list(iter_schema_changes(source_metadata, target_metadata))
+    return schema_changes, list(iter_render_changes(schema_changes, source_default_character, ddl_algorithm, online))
+
+
+def get_ddl_tables(query, default_database):
+    """
+    DDL 语句涉及的表：[(库名, 表名)]，表名不带库名时为 default_database；
+    ALTER TABLE ... RENAME TO 同时包含新表名，不是表级 DDL 时为空
+    """
+    match = DDL_STATEMENT.match(query)
+    if match is None:
+        return []
+    tables = []
+    pos = match.end()
+    while True:
+        name = DDL_TABLE_NAME.match(query, pos)
+        if name is None:
+            break
+        first = (name.group(1) or '').replace('``', '`') or name.group(2)
+        second = (name.group(3) or '').replace('``', '`') or name.group(4)
+        tables.append((first, second) if second else (default_database, first))
+        pos = name.end()
+        separator = DDL_TABLE_SEPARATOR.match(query, pos) if match.group('multi') else None
+        if separator is None:
+            break
+        pos = separator.end()
+    if match.group('alter'):
+        rename = DDL_ALTER_RENAME.search(query, pos)
+        if rename is not None:
+            tables.extend(get_ddl_tables('RENAME TABLE ' + query[rename.end():], default_database))
+    return tables
+
+
+def read_event_file(path, poll_interval, events):
+    """
+    --watch-events 的读取线程：每行一个 JSON 事件
+    {"side": "source" | "target"（省略时两边都算）, "database": 语句的默认库（省略时为该边比较的库）, "query": DDL 语句}，
+    转为 (边的序号, 默认库, 语句) 放入 events；'-' 为 stdin，读到 EOF 结束，
+    文件则像 tail -f 一样等待追加的事件；结束时放入 None
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        line = ''
+        while True:
+            chunk = f.readline()
+            if not chunk:
+                if path == '-':
+                    break
+                time.sleep(poll_interval)
+                continue
+            line += chunk
+            if not line.endswith('\n') and path != '-':
+                continue
+            if line.strip():
+                try:
+                    event = json.loads(line)
+                    side_indexes = {'source': (0,), 'target': (1,), None: (0, 1)}[event.get('side')]
+                    events.put((side_indexes, event.get('database'), event['query']))
+                except (ValueError, KeyError, TypeError) as e:
+                    click.secho('WARNING: invalid watch event %r: %s' % (line.strip(), e), fg='yellow', err=True)
+            line = ''
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        events.put(None)
+
+
+def get_binlog_reader():
+    """
+    --watch-binlog 依赖 mysql-replication 包，没有安装时报错
+    """
+    try:
+        from pymysqlreplication import BinLogStreamReader
+        from pymysqlreplication.event import QueryEvent
+    except ImportError:
+        raise click.UsageError('--watch-binlog 需要安装 mysql-replication：pip install mysql-replication')
+    return BinLogStreamReader, QueryEvent
+
+
+def read_binlog_events(information, server_id, side_indexes, events):
+    """
+    --watch-binlog 的读取线程：以从库身份从当前位置读取 information 服务器的 binlog，
+    把其中的语句（QueryEvent，DDL 总是以语句形式记录）放入 events；
+    账号需要 REPLICATION SLAVE / REPLICATION CLIENT 权限；结束时放入 None
+    """
+    binlog_stream_reader, query_event = get_binlog_reader()
+    db_config = get_db_config(information)
+    stream = None
+    try:
+        stream = binlog_stream_reader(
+            connection_settings={'host': db_config['host'], 'port': int(db_config['port']),
+                                 'user': db_config['user'], 'passwd': db_config['password']},
+            server_id=server_id, only_events=[query_event], blocking=True, resume_stream=True)
+        for event in stream:
+            schema = event.schema
+            if isinstance(schema, (bytes, bytearray)):
+                schema = schema.decode('utf-8')
+            events.put((side_indexes, schema or None, event.query))
+    except Exception as e:
+        click.secho('ERROR: binlog of %s: %s' % (get_server_name(information), e), fg='red', err=True)
+    finally:
+        if stream is not None:
+            stream.close()
+        events.put(None)
+
+
+def refresh_tables(backend, database, metadata, table_names):
+    """
+    重新读取 table_names 这些表的表信息、字段、索引、分区和外键并更新到 metadata，已删除的表从 metadata 中去掉；
+    metadata 带有外键反查 referenced_tables 时只按这些表的外键变化更新它
+    """
+    table_names = sorted(table_names)
+    refreshed = {
+        'tables': backend.get_tables(database, table_names),
+        'columns': backend.get_columns(database, table_names),
+        'statistics': backend.get_statistics(database, table_names),
+        'partitions': backend.get_partitions(database, table_names),
+        'foreign_keys': backend.get_foreign_keys(database, table_names),
+    }
+    if 'referenced_tables' in metadata:
+        for table_name in table_names:
+            update_referenced_tables(metadata['referenced_tables'], table_name,
+                                     metadata['foreign_keys'].get(table_name, []),
+                                     refreshed['foreign_keys'].get(table_name, []))
+    for part, values in refreshed.items():
+        for table_name in table_names:
+            if table_name in values:
+                metadata[part][table_name] = values[table_name]
+            else:
+                metadata[part].pop(table_name, None)
+
+
+def diff_watched_table(table_name, source_metadata, target_metadata, ddl_algorithm=False, online=None):
+    """
+    --watch 中重新比较一张表，返回 (diff_sql, diff)
+    """
+    if table_name in source_metadata['tables']:
+        if timings is None:
+            diff_sql, diff, _ = diff_table(table_name, source_metadata, target_metadata, (), ddl_algorithm, online)
+        else:
+            with timings.measure('diff', table_name):
+                diff_sql, diff, _ = diff_table(table_name, source_metadata, target_metadata, (), ddl_algorithm, online)
+        return diff_sql, diff
+    return drop_table(source_metadata['tables'], {table_name: None} if table_name in target_metadata['tables'] else {})
+
+
+def emit_watch_event(output, hook, event):
+    """
+    一条漂移事件：JSON 写一行到 output；指定 hook 时再执行 hook 命令，事件从 stdin 传入
+    """
+    line = json.dumps(event, ensure_ascii=False, default=snapshot_encode)
+    click.echo(line, file=output)
+    output.flush()
+    if hook is not None:
+        result = subprocess.run(hook, shell=True, input=line + '\n', universal_newlines=True)
+        if result.returncode != 0:
+            click.secho('WARNING: watch hook exited with %d' % result.returncode, fg='yellow', err=True)
+
+
+def watch_drift(executor, sides, events, sources, emit, debounce=0.5, ddl_algorithm=False, online=None,
+                name_filter=None):
+    """
+    --watch：两边模型只完整加载一次并报告当前的全部差异；之后从 events 读取 DDL，
+    debounce 秒内到达的事件合并为一批，只刷新并重新比较涉及的表（不通过 name_filter 的表忽略），
+    某张表的差异出现、变化或消失时调用 emit(事件)；sides 为 [source, target] 的 (backend, database)，
+    sources 个事件来源都结束（各放入一个 None）后返回
+    """
+    metadata_list = fetch_metadata(executor, sides, name_filter=name_filter)
+    source_metadata, target_metadata = metadata_list
+    # 外键反查只建一次，之后随 refresh_tables() 增量更新，每个事件的代价与整库的外键数无关
+    target_metadata['referenced_tables'] = get_referenced_tables(target_metadata['foreign_keys'])
+    table_diffs = {}
+    table_names = set(source_metadata['tables']) | set(target_metadata['tables'])
+    initial = True
+    while True:
+        for table_name in sorted(table_names):
+            diff_sql, diff = diff_watched_table(table_name, source_metadata, target_metadata, ddl_algorithm, online)
+            if diff_sql == table_diffs.get(table_name, []):
+                continue
+            if diff_sql:
+                table_diffs[table_name] = diff_sql
+            else:
+                table_diffs.pop(table_name, None)
+            emit({
+                'time': datetime.datetime.now().isoformat(),
+                'status': 'drift' if diff_sql else 'resolved',
+                'initial': initial,
+                'source': sides[0][1],
+                'target': sides[1][1],
+                'table': table_name,
+                'diff': diff,
+                'sql': diff_sql,
+            })
+        initial = False
+        if sources == 0:
+            return
+
+        batch = [events.get()]
+        deadline = time.time() + debounce
+        while True:
+            try:
+                batch.append(events.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        start = time.time()
+        touched = [set(), set()]
+        for event in batch:
+            if event is None:
+                sources -= 1
+                continue
+            side_indexes, default_database, query = event
+            for index in side_indexes:
+                database = sides[index][1]
+                touched[index].update(table_name for table_database, table_name
+                                      in get_ddl_tables(query, default_database or database)
+                                      if table_database == database and match_table_filter(name_filter, table_name))
+        futures = [executor.submit(refresh_tables, backend, database, metadata, table_names)
+                   for (backend, database), metadata, table_names in zip(sides, metadata_list, touched) if table_names]
+        for future in futures:
+            future.result()
+        table_names = touched[0] | touched[1]
+        if table_names:
+            click.echo('watch: {} events, {} tables refreshed in {:.3f}s'.format(
+                len(batch), len(table_names), time.time() - start), err=True)
+
+
+def revalidate_metadata(backend, database, metadata):
+    """
+    重新读取 TABLES，只为指纹（CREATE_TIME / UPDATE_TIME / VERSION）变化、新增或已删除的表刷新字段、索引、分区和外键；
+    在副本上更新，不影响正在使用旧模型的比较；返回 (新模型, 刷新的表数)
+    """
+    tables = backend.get_tables(database)
+    table_names = [table_name for table_name, table_data in tables.items()
+                   if table_name not in metadata['tables']
+                   or table_fingerprint(table_data) != table_fingerprint(metadata['tables'][table_name])]
+    table_names += [table_name for table_name in metadata['tables'] if table_name not in tables]
+    metadata = dict(metadata, tables=dict(metadata['tables']), columns=dict(metadata['columns']),
+                    statistics=dict(metadata['statistics']), partitions=dict(metadata['partitions']),
+                    foreign_keys=dict(metadata['foreign_keys']))
+    if 'referenced_tables' in metadata:
+        metadata['referenced_tables'] = dict((table_name, set(child_tables))
+                                             for table_name, child_tables in metadata['referenced_tables'].items())
+    if table_names:
+        refresh_tables(backend, database, metadata, table_names)
+    return metadata, len(table_names)
+
+
+def table_changes_to_dict(table_changes):
+    """
+    TableChanges 转为可以 JSON 序列化的 dict，变更中的 Column / Index / Partition 也转为 dict
+    """
+    return {
+        'table': table_changes.table_name,
+        'action': table_changes.action,
+        'algorithm': table_changes.algorithm,
+        'lock': table_changes.lock,
+        'cost': table_changes.cost,
+        'changes': [dict([('type', type(change).__name__)] + [
+            (field, value._asdict() if hasattr(value, '_asdict') else
+             [item._asdict() for item in value] if field == 'partitions' else value)
+            for field, value in change._asdict().items()]) for change in table_changes.changes],
+    }
+
+
+class DiffServer(object):
+    """
+    --serve 的常驻状态：每个 DSN 一个连接池（MySQLBackend），每个 (服务器, 库) 一份结构模型；
+    模型超过 model_ttl 秒后下次使用时按表指纹增量刷新；记录请求数和最近的延迟
+    """
+
+    def __init__(self, jobs, model_ttl):
+        self.jobs = jobs
+        self.model_ttl = model_ttl
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.backends = {}
+        self.models = {}
+        self.model_locks = {}
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.scheduler = ThreadPoolExecutor(max_workers=jobs)
+
+    def get_backend(self, information):
+        """
+        DSN 对应的 MySQLBackend；建立连接池在锁外进行，慢的连接不阻塞其它请求和 /health，
+        同一 DSN 并发建立时保留先完成的一个
+        """
+        with self.lock:
+            backend = self.backends.get(information)
+        if backend is not None:
+            return backend
+        backend = MySQLBackend.connect(information, self.jobs)
+        with self.lock:
+            existing = self.backends.setdefault(information, backend)
+        if existing is not backend:
+            backend.close()
+        return existing
+
+    def get_model(self, information, database, fresh=False):
+        """
+        返回 (结构模型, 'hit' / 'loaded' / 'revalidated')
+        """
+        backend = self.get_backend(information)
+        key = (backend.server, database)
+        with self.lock:
+            model_lock = self.model_locks.setdefault(key, threading.Lock())
+        with model_lock:
+            entry = self.models.get(key)
+            if entry is not None and not fresh and time.time() - entry[1] < self.model_ttl:
+                return entry[0], 'hit'
+            if entry is None:
+                metadata, = fetch_metadata(self.executor, [(backend, database)])
+                state = 'loaded'
+            else:
+                # 连接池大小为 jobs，取不到连接时直接报错而不是等待；
+                # 所有查询都经过 executor（jobs 个线程），同一 DSN 同时借出的连接就不会超过 jobs
+                metadata, _ = self.executor.submit(revalidate_metadata, backend, database, entry[0]).result()
+                state = 'revalidated'
+            self.models[key] = (metadata, time.time())
+            return metadata, state
+
+    def diff(self, request):
+        """
+        /diff：{"source": DSN, "target": DSN（省略为 source）, "db": "<source_db>:<target_db>",
+        "ddl_algorithm", "sort_by_cost", "online_min_size" (MB), "online_min_rows", "online_chunk_size" (MB),
+        "changes"（同时返回结构化变更）, "fresh"（不用缓存的模型）,
+        "include" / "exclude"（表名模式列表，与 --include / --exclude 相同，在缓存的模型上过滤）}
+        """
+        source_database, _, target_database = request['db'].partition(':')
+        target_database = target_database or source_database
+        fresh = bool(request.get('fresh'))
+        source_future = self.scheduler.submit(self.get_model, request['source'], source_database, fresh)
+        target_future = self.scheduler.submit(self.get_model, request.get('target') or request['source'],
+                                              target_database, fresh)
+        (source_metadata, source_state), (target_metadata, target_state) = source_future.result(), target_future.result()
+        name_filter = make_table_filter(request.get('include', ()), request.get('exclude', ()))
+        source_metadata = filter_metadata(source_metadata, name_filter)
+        target_metadata = filter_metadata(target_metadata, name_filter)
+
+        online = None
+        if request.get('online_min_size') is not None or request.get('online_min_rows') is not None:
+            online = OnlineOptions(None if request.get('online_min_size') is None else request['online_min_size'] * 1024 * 1024,
+                                   request.get('online_min_rows'), request.get('online_chunk_size', 16) * 1024 * 1024)
+        _, source_default_character = source_metadata['schema']
+        schema_changes = list(iter_schema_changes(source_metadata, target_metadata))
+        table_diffs = list(iter_render_changes(schema_changes, source_default_character,
+                                               bool(request.get('ddl_algorithm')), online))
+        if request.get('sort_by_cost'):
+            table_diffs = sort_table_diffs(table_diffs)
+        layers = get_diff_layers(schema_changes, table_diffs)
+        response = {
+            'models': {'source': source_state, 'target': target_state},
+            'character': source_default_character,
+            'sql': get_layer_sql(layers),
+            'layers': [[{'table': table_name, 'sql': diff_sql} for table_name, diff_sql, _ in layer] for layer in layers],
+            'diff': [line for _, _, diff, _ in table_diffs for line in diff],
+        }
+        if request.get('changes'):
+            response['changes'] = [table_changes_to_dict(table_changes) for table_changes in schema_changes]
+        return response
+
+    def invalidate(self, request):
+        """
+        /invalidate：{"server": DSN 或 <host>:<port>（省略为全部）, "database": 库名（省略为全部）}，返回删除的模型数
+        """
+        server = request.get('server')
+        if server is not None and '@' in server:
+            server = get_server_name(server)
+        with self.lock:
+            keys = [key for key in self.models
+                    if (server is None or key[0] == server) and (request.get('database') is None or key[1] == request['database'])]
+            for key in keys:
+                del self.models[key]
+        return {'invalidated': len(keys)}
+
+    def health(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+
+        now = time.time()
+        with self.lock:
+            return {
+                'status': 'ok',
+                'uptime': now - self.start,
+                'requests': self.requests,
+                'errors': self.errors,
+                'servers': sorted(backend.server for backend in self.backends.values()),
+                'models': [{'server': server, 'database': database, 'tables': len(metadata['tables']), 'age': now - checked}
+                           for (server, database), (metadata, checked) in sorted(self.models.items())],
+                'latency': {'count': len(latencies), 'mean': sum(latencies) / len(latencies) if latencies else None,
+                            'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                            'max': latencies[-1] if latencies else None},
+            }
+
+    def record(self, seconds, error):
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self.latencies.append(seconds)
+
+    def close(self):
+        self.executor.shutdown()
+        self.scheduler.shutdown()
+        for backend in self.backends.values():
+            backend.close()
+
+
+class DiffRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    --serve 的 HTTP 接口：POST /diff、POST /invalidate、GET /health，请求和响应都是 JSON
+    """
+
+    def address_string(self):
+        # unix socket 没有客户端地址
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def send_json(self, status, body):
+        content = json.dumps(body, ensure_ascii=False, default=snapshot_encode).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, func):
+        start = time.perf_counter()
+        status = 200
+        try:
+            body = func()
+        except (ValueError, KeyError, TypeError) as e:
+            status, body = 400, {'error': 'bad request: %s' % e}
+        except Exception as e:
+            status, body = 500, {'error': str(e)}
+        seconds = time.perf_counter() - start
+        if isinstance(body, dict) and status == 200:
+            body['seconds'] = seconds
+        self.server.diff_server.record(seconds, status != 200)
+        self.send_json(status, body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8') or '{}') if length else {}
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.server.diff_server.health())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        diff_server = self.server.diff_server
+        if self.path == '/diff':
+            self.handle_request(lambda: diff_server.diff(self.read_json()))
+        elif self.path == '/invalidate':
+            self.handle_request(lambda: diff_server.invalidate(self.read_json()))
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        click.echo('%s - %s' % (self.address_string(), format % args), err=True)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(address, jobs, model_ttl):
+    """
+    --serve：address 含 / 时监听该路径的 unix socket，否则为 <host>:<port> 的 HTTP 端口；Ctrl-C 退出
+    """
+    if '/' in address:
+        if os.path.exists(address):
+            os.remove(address)
+        httpd = UnixHTTPServer(address, DiffRequestHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        httpd = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), DiffRequestHandler)
+    httpd.diff_server = DiffServer(jobs, model_ttl)
+    click.echo('sqldiff server listening on {}'.format(address), err=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        httpd.diff_server.close()
+        if '/' in address and os.path.exists(address):
+            os.remove(address)
+
+
+@click.command()
+@click.option("--source", help="指定源服务器。(格式: <user>:<password>@<host>:<port>)")
+@click.option("--target", help="指定目标服务器。(格式: <user>:<password>@<host>:<port>)")
+@click.option("--db", multiple=True,
+              help="指定数据库，可重复指定多对；<target_db> 可用 * ? 通配符匹配多个目标库。(格式: <source_db>:<target_db>)")
+@click.option("--jobs", default=4, show_default=True, type=click.IntRange(1, mysql.connector.pooling.CNX_POOL_MAXSIZE),
+              help="元数据并发查询数，同时也是每个服务器连接池的大小。")
+@click.option("--source-snapshot", type=click.Path(exists=True, dir_okay=False), help="从快照文件读取源库结构，代替 --source。")
+@click.option("--target-snapshot", type=click.Path(exists=True, dir_okay=False), help="从快照文件读取目标库结构，代替 --target。")
+@click.option("--dump-snapshot", type=click.Path(dir_okay=False), help="把源库结构保存为快照文件后退出，不做 diff。")
+@click.option("--cache", "cache_path", type=click.Path(dir_okay=False), help="本地元数据缓存文件，表指纹未变的表不再查询字段和索引。")
+@click.option("--cache-max-age", default=7 * 24 * 3600, show_default=True, type=click.IntRange(0),
+              help="缓存条目超过多少秒未使用即淘汰。")
+@click.option("--cache-max-size", default=256, show_default=True, type=click.IntRange(0),
+              help="缓存文件中条目的总大小上限(MB)，超出按最近使用时间淘汰。")
+@click.option("--include", multiple=True,
+              help="只比较匹配的表，可多次指定：表名、通配符（* ? [...]）或 re: 开头的正则，尽量转为 information_schema 查询条件。")
+@click.option("--exclude", multiple=True, help="不比较匹配的表，可多次指定，格式同 --include；被排除的表也不会生成 DROP。")
+@click.option("--filter-file", type=click.File('r'),
+              help="表名过滤文件：每行一个 --include 模式，! 开头为 --exclude 模式，# 开头为注释。")
+@click.option("--digest", is_flag=True, help="先在服务器上计算每张表的结构摘要，只比较摘要不同的表（两边都是在线库时生效）。")
+@click.option("--targets-file", type=click.File('r'),
+              help="fleet 模式：每行一个目标服务器 DSN，支持 {001..800} 分片范围；源库只读取一次。")
+@click.option("--processes", type=click.IntRange(1), help="fleet 模式的进程数。[默认: CPU 核数]")
+@click.option("--output-dir", default="sqldiff-fleet", show_default=True, type=click.Path(file_okay=False),
+              help="fleet 模式下每个目标库的结果文件目录。")
+@click.option("--stream", is_flag=True,
+              help="流式输出：每张表比较完立即输出，差异说明写成 SQL 注释，SET NAMES 在最前。")
+@click.option("--page-size", type=click.IntRange(1),
+              help="与 --stream 一起使用：两边按表名分页读取元数据（每页这么多张表）并归并比较，内存只与页大小有关。")
+@click.option("--ddl-algorithm", is_flag=True,
+              help="ALTER 语句末尾加上 ALGORITHM= / LOCK= 子句（按目标库版本和表大小估计）。")
+@click.option("--sort-by-cost", is_flag=True, help="按估计代价从小到大输出各表的语句，不能与 --stream 同时使用。")
+@click.option("--layers", "show_layers", is_flag=True,
+              help="按外键依赖分层输出语句，标明每层中可以并发执行的组，不能与 --stream 同时使用。")
+@click.option("--online-min-size", type=click.IntRange(0),
+              help="DATA_LENGTH 达到多少 MB 的表改为生成在线变更计划（影子表 + 触发器 + 分批复制 + RENAME）。")
+@click.option("--online-min-rows", type=click.IntRange(0), help="TABLE_ROWS 达到多少行的表改为生成在线变更计划。")
+@click.option("--online-chunk-size", default=16, show_default=True, type=click.IntRange(1),
+              help="在线变更每批复制的数据量(MB)，按 AVG_ROW_LENGTH 换算为行数。")
+@click.option("--apply", is_flag=True, help="在目标库上直接执行生成的语句，执行报告输出到 stdout 或 --output 文件。")
+@click.option("--apply-jobs", default=4, show_default=True,
+              type=click.IntRange(1, mysql.connector.pooling.CNX_POOL_MAXSIZE),
+              help="--apply 时最多同时变更的表数；同一张表的语句按顺序执行。")
+@click.option("--lock-wait-timeout", type=click.IntRange(1),
+              help="--apply 时执行语句的会话 lock_wait_timeout(秒)，避免 DDL 长时间等待元数据锁阻塞业务。")
+@click.option("--dry-run", is_flag=True, help="与 --apply 一起使用：检查目标库设置并输出将要执行的语句，不执行。")
+@click.option("--watch-events", type=click.Path(dir_okay=False, allow_dash=True),
+              help="监视模式：两边模型只加载一次，之后按文件中的 DDL 事件（每行一个 JSON，像 tail -f 一样持续读取，"
+                   "- 为 stdin）只刷新并重新比较涉及的表，差异出现、变化或消失时输出一行 JSON 事件。")
+@click.option("--watch-binlog", is_flag=True, help="监视模式：从 source / target 服务器的 binlog 读取 DDL 事件（需要 mysql-replication）。")
+@click.option("--watch-server-id", default=4242, show_default=True, type=click.IntRange(1),
+              help="--watch-binlog 以从库身份连接时使用的 server_id，不能与已有的从库重复。")
+@click.option("--watch-debounce", default=0.5, show_default=True, type=click.FloatRange(0),
+              help="监视模式中多少秒内到达的事件合并为一批处理。")
+@click.option("--watch-hook", help="监视模式中每条漂移事件还交给这个 shell 命令处理，事件 JSON 从 stdin 传入。")
+@click.option("--async-fetch", is_flag=True,
+              help="用 asyncio（mysql.connector.aio）读取 source / target 的元数据：--jobs 个连接同时建立，分块查询同时发出，"
+                   "适合跨地域等高延迟链路。")
+@click.option("--serve", "serve_address",
+              help="服务模式：常驻并监听 <host>:<port> 的 HTTP 端口或 unix socket 路径，保持各 DSN 的连接池和结构模型，"
+                   "接受 POST /diff、POST /invalidate、GET /health。")
+@click.option("--serve-model-ttl", default=30, show_default=True, type=click.FloatRange(0),
+              help="服务模式中结构模型缓存多少秒后，下次使用前按表指纹增量刷新。")
+@click.option("--timings", "show_timings", is_flag=True,
+              help="统计各阶段（连接、各类元数据查询、diff、输出）的查询数、行数、字节数和耗时以及最慢的表，汇总输出到 stderr；"
+                   "fleet 模式只统计主进程。")
+@click.option("--timings-output", type=click.Path(dir_okay=False), help="计量结果写到文件，供调度系统采集。")
+@click.option("--timings-format", default="json", show_default=True, type=click.Choice(['json', 'prometheus']),
+              help="--timings-output 的格式：JSON 或 Prometheus text-file。")
+@click.option("--output", default="-", type=click.File('w'), help="diff 结果输出文件。[默认: stdout]")
+@click.pass_context
+def mysqldiff(ctx, source, target, db, jobs, source_snapshot, target_snapshot, dump_snapshot,
+              cache_path, cache_max_age, cache_max_size, include, exclude, filter_file, digest, targets_file, processes,
+              output_dir, stream, page_size, ddl_algorithm, sort_by_cost, show_layers, online_min_size, online_min_rows, online_chunk_size,
+              apply, apply_jobs, lock_wait_timeout, dry_run, watch_events, watch_binlog, watch_server_id, watch_debounce,
+              watch_hook, async_fetch, serve_address, serve_model_ttl, show_timings, timings_output, timings_format, output):
+    """
+    数据库结构差异(target 2 source) 工具
+
+    :param source :输入指定源服务器(格式: <user>:<password>@<host>:<port>)
+
+    :param target :输入指定目标服务器(格式: <user>:<password>@<host>:<port>)
+
+    :param db     :指定数据库(格式: <source_db>:<target_db>)，可多次指定；如 canon:tenant_* 与全部 tenant_ 库比较
+
+    :param jobs   :元数据并发查询数
+
+    :param source_snapshot / target_snapshot :用快照文件代替对应的服务器
+
+    :param dump_snapshot :只把源库结构保存为快照文件(此时 --db 可只写 <source_db>)
+
+    :param cache  :本地元数据缓存文件，按表的 CREATE_TIME/UPDATE_TIME/VERSION 判断是否失效
+
+    :param include / exclude / filter_file :只比较通过过滤的表，条件尽量在服务器上执行，DROP 也只针对通过过滤的表
+
+    :param digest :先比较每张表的结构摘要，只拉取摘要不同的表的字段和索引
+
+    :param targets_file :fleet 模式，一个源库与文件中的全部目标库比较，结果写到 --output-dir；
+                         --ddl-algorithm / --sort-by-cost / --layers / --online-* 同样作用于每个目标库，不能与 --cache / --digest 同时使用
+
+    :param stream :每张表比较完立即输出到 stdout 或 --output 文件
+
+    :param page_size :与 stream 一起使用，两边分页读取并按表名归并比较，内存只与页大小有关
+
+    :param ddl_algorithm / sort_by_cost :ALTER 加上估计的 ALGORITHM / LOCK，按估计代价排序输出
+
+    :param layers :按外键依赖分层输出，同一层的组可以并发执行
+
+    :param online_min_size / online_min_rows :超过阈值的大表生成在线变更计划代替直接 ALTER
+
+    :param apply  :在目标库上按外键依赖逐层执行生成的语句(层内 --apply-jobs 组同时执行)，任一语句失败即停止，--dry-run 只检查不执行
+
+    :param watch_events / watch_binlog :监视模式，按 DDL 事件只重新比较涉及的表，漂移事件输出为 JSON 行
+
+    :param async_fetch :用 asyncio 读取元数据，高延迟链路上总耗时接近几个 RTT
+
+    :param serve  :服务模式，常驻并通过 HTTP / unix socket 接受 diff 请求，连接和结构模型保持在内存中
+
+    :param timings :输出各阶段、各表、各查询的计量，--timings-output 另存为 JSON / Prometheus 文件
+
+    输出 diff 以及 alter 具体语句
+    """
+    if serve_address is not None:
+        serve(serve_address, jobs, serve_model_ttl)
+        return
+    if not db:
+        raise click.UsageError('必须指定 --db。')
+    if source is None and source_snapshot is None:
+        raise click.UsageError('必须指定 --source 或 --source-snapshot。')
+    if dump_snapshot is not None and source is None:
+        raise click.UsageError('--dump-snapshot 需要指定 --source。')
+    if targets_file is not None and (target is not None or target_snapshot is not None or dump_snapshot is not None):
+        raise click.UsageError('--targets-file 不能与 --target / --target-snapshot / --dump-snapshot 同时使用。')
+    if targets_file is not None and (cache_path is not None or digest):
+        # 各子进程读的是不同的目标库，源库来自快照：没有可以共用的缓存文件，也没有两边都在线的摘要可比
+        raise click.UsageError('--targets-file 不能与 --cache / --digest 同时使用。')
+    if source is None and target is None and target_snapshot is None and dump_snapshot is None and targets_file is None:
+        raise click.UsageError('使用 --source-snapshot 时必须指定 --target 或 --target-snapshot。')
+    if stream and sort_by_cost:
+        raise click.UsageError('--sort-by-cost 不能与 --stream 同时使用。')
+    if stream and show_layers:
+        raise click.UsageError('--layers 不能与 --stream 同时使用。')
+    if page_size is not None and (not stream or source_snapshot is not None or target_snapshot is not None
+                                  or cache_path is not None or digest or targets_file is not None):
+        raise click.UsageError('--page-size 需要与 --stream 一起使用，两边都要是在线库，'
+                               '不能与 --cache / --digest / --targets-file 同时使用。')
+    if dry_run and not apply:
+        raise click.UsageError('--dry-run 需要与 --apply 一起使用。')
+    if apply and (stream or target_snapshot is not None or dump_snapshot is not None or targets_file is not None):
+        raise click.UsageError('--apply 不能与 --stream / --target-snapshot / --dump-snapshot / --targets-file 同时使用。')
+    watch = watch_events is not None or watch_binlog
+    if watch and (source is None or target_snapshot is not None or dump_snapshot is not None or targets_file is not None
+                  or apply or stream or sort_by_cost):
+        raise click.UsageError('监视模式需要 --source，不能与 --source-snapshot / --target-snapshot / --dump-snapshot / '
+                               '--targets-file / --apply / --stream / --sort-by-cost 同时使用。')
+    if watch_binlog:
+        get_binlog_reader()
+
+    global timings
+    timings = Timings() if show_timings or timings_output is not None else None
+
+    source_backend = None
+    target_backend = None
+    apply_pool = None
+    snapshots = []
+    cache = None
+    online = None
+    if online_min_size is not None or online_min_rows is not None:
+        online = OnlineOptions(None if online_min_size is None else online_min_size * 1024 * 1024, online_min_rows,
+                               online_chunk_size * 1024 * 1024)
+
+    try:
+        name_filter = make_table_filter(include, exclude, filter_file or ())
+        db_pairs = parse_db_pairs(db)
+        source_database, target_database = db_pairs[0]
+        multi_db = len(db_pairs) > 1 or is_db_pattern(target_database)
+        if multi_db and (dump_snapshot is not None or targets_file is not None or target_snapshot is not None or apply
+                         or watch or page_size is not None):
+            raise click.UsageError('多个 --db 或通配符不能与 --dump-snapshot / --targets-file / --target-snapshot / --apply / '
+                                   '--page-size / 监视模式同时使用。')
+
+        if source_snapshot is None:
+            if async_fetch:
+                source_backend = get_async_backend(source, jobs)
+            else:
+                source_backend = MySQLBackend(get_server_name(source), get_connection_pool(source, jobs))
+
+        if dump_snapshot is not None:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                source_metadata = filter_metadata(wait_metadata(submit_metadata(
+                    executor, source_backend, source_database, name_filter=name_filter)), name_filter)
+            table_count = write_snapshot(dump_snapshot, source_database, source_metadata)
+            click.echo('snapshot of `{}` ({} tables) saved to {}'.format(source_database, table_count, dump_snapshot), err=True)
+            return
+
+        if targets_file is not None:
+            targets = expand_targets(targets_file)
+            for fleet_target in targets:
+                get_server_name(fleet_target)
+            fleet_snapshot = source_snapshot
+            if source_snapshot is None:
+                # 在线源库只读取一次，存为临时快照供各子进程 mmap
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    source_metadata, = fetch_metadata(executor, [(source_backend, source_database)],
+                                                      name_filter=name_filter)
+                fd, fleet_snapshot = tempfile.mkstemp(suffix='.snapshot')
+                os.close(fd)
+            try:
+                if source_snapshot is None:
+                    write_snapshot(fleet_snapshot, source_database, source_metadata)
+                results = diff_fleet(fleet_snapshot, targets, target_database, jobs, processes, output_dir, name_filter,
+                                     ddl_algorithm, sort_by_cost, online, show_layers)
+            finally:
+                if source_snapshot is None:
+                    os.remove(fleet_snapshot)
+
+            drifted = failed = 0
+            for server, count, error in results:
+                if error is not None:
+                    failed += 1
+                    print('{}\tERROR\t{}'.format(server, error))
+                elif count:
+                    drifted += 1
+                    print('{}\tDRIFT\t{} statements'.format(server, count))
+                else:
+                    print('{}\tOK'.format(server))
+            print('{} targets: {} drifted, {} in sync, {} failed'.format(
+                len(results), drifted, len(results) - drifted - failed, failed))
+            if failed:
+                sys.exit(1)
+            return
+
+        # target:
+        if target_snapshot is None:
+            if target is not None and async_fetch:
+                target_backend = get_async_backend(target, jobs)
+            elif target is not None:
+                target_backend = MySQLBackend(get_server_name(target), get_connection_pool(target, jobs))
+            else:
+                target_backend = source_backend
+
+        if cache_path is not None:
+            cache = MetadataCache(cache_path, cache_max_age, cache_max_size * 1024 * 1024)
+
+        if multi_db:
+            db_pairs = target_backend.query(resolve_db_pairs, db_pairs)
+            if not db_pairs:
+                raise Exception('目标服务器上没有与 --db 匹配的数据库。')
+
+            # 每个源库只加载一次；每对 (源库, 目标库) 是调度器中的一个任务，
+            # 任务内的查询统一交给 executor，连接数不超过 --jobs
+            with ThreadPoolExecutor(max_workers=jobs) as executor, ThreadPoolExecutor(max_workers=jobs) as scheduler:
+                source_models = {}
+                for pair_source_database, _ in db_pairs:
+                    if pair_source_database in source_models:
+                        continue
+                    if source_backend is not None:
+                        source_models[pair_source_database], = fetch_metadata(
+                            executor, [(source_backend, pair_source_database)], cache, digest, name_filter=name_filter)
+                    else:
+                        if not snapshots:
+                            snapshots.append(Snapshot(source_snapshot))
+                        source_models[pair_source_database] = snapshots[0].metadata(name_filter)
+
+                futures = [scheduler.submit(diff_db_pair, executor, target_backend,
+                                            source_models[pair_source_database], pair_target_database, cache, digest,
+                                            ddl_algorithm, online, name_filter)
+                           for pair_source_database, pair_target_database in db_pairs]
+                # 按 --db 的顺序输出，每对比较完立即输出
+                for (pair_source_database, pair_target_database), future in zip(db_pairs, futures):
+                    schema_changes, table_diffs = future.result()
+                    if not any(diff_sql for _, diff_sql, _, _ in table_diffs):
+                        continue
+                    _, source_default_character = source_models[pair_source_database]['schema']
+                    click.echo('-- {} -> {}\nUSE `{}`;\n'.format(pair_source_database, pair_target_database,
+                                                                 pair_target_database), file=output)
+                    if stream:
+                        write_diff_stream(output, table_diffs, source_default_character)
+                    else:
+                        if sort_by_cost:
+                            table_diffs = sort_table_diffs(table_diffs)
+                        layers = get_diff_layers(schema_changes, table_diffs)
+                        diff = [line for _, _, table_diff, _ in table_diffs for line in table_diff]
+                        if show_layers:
+                            click.echo(format_diff_layers(layers, diff, source_default_character) + '\n', file=output)
+                        else:
+                            click.echo(format_diff(get_layer_sql(layers), diff, source_default_character) + '\n',
+                                       file=output)
+
+            if cache is not None:
+                click.echo('metadata cache: {} hit, {} miss'.format(cache.hits, cache.misses), err=True)
+            return
+
+        if page_size is not None:
+            # 两边逐页读取、按表名归并，每张表比较完立即输出，不持有整库的模型
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                source_header, source_pages = open_metadata_pages(executor, source_backend, source_database, page_size,
+                                                                  name_filter)
+                target_header, target_pages = open_metadata_pages(executor, target_backend, target_database, page_size,
+                                                                  name_filter)
+                _, source_default_character = source_header['schema']
+                _, target_default_character = target_header['schema']
+                click.echo('source database default table CHARACTER name is {}'.format(source_default_character), err=True)
+                click.echo('target database default table CHARACTER name is {}'.format(target_default_character), err=True)
+                write_diff_stream(output, iter_render_changes(iter_merge_schema_changes(source_pages, target_header,
+                                                                                        target_pages),
+                                                              source_default_character, ddl_algorithm, online),
+                                  source_default_character)
+            return
+
+        if watch:
+            sides = [(source_backend, source_database), (target_backend, target_database)]
+            events = queue.Queue()
+            readers = []
+            if watch_events is not None:
+                readers.append(threading.Thread(target=read_event_file, args=(watch_events, watch_debounce or 0.5, events)))
+            if watch_binlog:
+                for information in [source] if target is None else [source, target]:
+                    side_indexes = tuple(index for index, (backend, _) in enumerate(sides)
+                                         if backend.server == get_server_name(information))
+                    readers.append(threading.Thread(target=read_binlog_events,
+                                                    args=(information, watch_server_id, side_indexes, events)))
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                watch_drift(executor, sides, events, len(readers),
+                            functools.partial(emit_watch_event, output, watch_hook), watch_debounce, ddl_algorithm, online,
+                            name_filter)
+            return
+
+        # source 与 target 的元数据查询互不依赖，一起放进线程池；快照则直接映射文件
+        sides = []
+        if source_backend is not None:
+            sides.append((source_backend, source_database))
+        if target_backend is not None:
+            sides.append((target_backend, target_database))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            metadata_list = fetch_metadata(executor, sides, cache, digest=digest and len(sides) == 2,
+                                           name_filter=name_filter)
+
+        if source_backend is not None:
+            source_metadata = metadata_list.pop(0)
+        else:
+            snapshots.append(Snapshot(source_snapshot))
+            source_metadata = snapshots[-1].metadata(name_filter)
+        if target_backend is not None:
+            target_metadata = metadata_list.pop(0)
+        else:
+            snapshots.append(Snapshot(target_snapshot))
+            target_metadata = snapshots[-1].metadata(name_filter)
+
+        if cache is not None:
+            click.echo('metadata cache: {} hit, {} miss'.format(cache.hits, cache.misses), err=True)
+
+        # 流式输出时 stdout 只输出 SQL，--apply 时 stdout 只输出执行报告，提示信息写到 stderr
+        notice_err = stream or apply
+        source_exist, source_default_character = source_metadata['schema']
+        if source_exist:
+            click.echo('source database default table CHARACTER name is {}'.format(source_default_character),
+                       file=None if notice_err else output, err=notice_err)
+        target_exist, target_default_character = target_metadata['schema']
+        if target_exist:
+            click.echo('target database default table CHARACTER name is {}'.format(target_default_character),
+                       file=None if notice_err else output, err=notice_err)
+
+        if apply:
+            schema_changes = list(iter_schema_changes(source_metadata, target_metadata))
+            table_diffs = [table_diff for table_diff in iter_render_changes(schema_changes, source_default_character,
+                                                                            ddl_algorithm, online) if table_diff[1]]
+            if sort_by_cost:
+                table_diffs = sort_table_diffs(table_diffs)
+            # 外键依赖决定执行顺序：删除外键 -> 被引用表的变更 -> 新增外键
+            layers = get_diff_layers(schema_changes, table_diffs)
+
+            # DDL 等元数据锁时会阻塞其后的全部读写，先检查目标库设置
+            settings = target_backend.query(get_apply_settings)
+            click.echo('target lock_wait_timeout is {}, max_execution_time is {}'.format(
+                settings['lock_wait_timeout'], settings['max_execution_time']), err=True)
+            if lock_wait_timeout is None and settings['lock_wait_timeout'] > 60:
+                click.secho('WARNING: lock_wait_timeout is {}s, a DDL waiting for a metadata lock blocks every query '
+                            'behind it; consider --lock-wait-timeout'.format(settings['lock_wait_timeout']),
+                            fg='yellow', err=True)
+            if settings['max_execution_time']:
+                click.secho('WARNING: max_execution_time is {}ms, SELECT statements on the target may be '
+                            'interrupted'.format(settings['max_execution_time']), fg='yellow', err=True)
+
+            statement_count = sum(len(diff_sql) for _, diff_sql, _, _ in table_diffs)
+            if dry_run:
+                diff = [line for _, _, table_diff, _ in table_diffs for line in table_diff]
+                click.echo(format_diff_layers(layers, diff, source_default_character), file=output)
+                click.echo('dry-run: {} statements on {} tables in {} layers, --apply-jobs {}'.format(
+                    statement_count, len(table_diffs), len(layers), apply_jobs), err=True)
+                return
+
+            apply_pool = get_apply_pool(target or source, target_database, apply_jobs, source_default_character)
+            # 同一张表的各组结果合并为一行报告：已执行语句数和耗时累加，取第一个错误
+            table_results = dict((table_name, [0, 0.0, None]) for table_name, _, _, _ in table_diffs)
+            for table_name, count, seconds, error in apply_diffs(apply_pool, layers, apply_jobs, lock_wait_timeout):
+                table_result = table_results[table_name]
+                table_result[0] += count
+                table_result[1] += seconds
+                table_result[2] = table_result[2] or error
+            applied = failed = skipped = 0
+            for table_name, diff_sql, _, _ in table_diffs:
+                count, seconds, error = table_results[table_name]
+                applied += count
+                if error is not None:
+                    failed += 1
+                    click.echo('{}\tFAILED\t{}/{} statements\t{:.2f}s\t{}'.format(
+                        table_name, count, len(diff_sql), seconds, error), file=output)
+                elif count == len(diff_sql):
+                    click.echo('{}\tAPPLIED\t{} statements\t{:.2f}s'.format(table_name, count, seconds), file=output)
+                elif count:
+                    skipped += 1
+                    click.echo('{}\tPARTIAL\t{}/{} statements\t{:.2f}s'.format(
+                        table_name, count, len(diff_sql), seconds), file=output)
+                else:
+                    skipped += 1
+                    click.echo('{}\tSKIPPED'.format(table_name), file=output)
+            click.echo('applied {}/{} statements: {} tables, {} failed, {} not finished'.format(
+                applied, statement_count, len(table_diffs), failed, skipped), file=output)
+            if failed:
+                sys.exit(1)
+            return
+
+        if stream:
+            write_diff_stream(output, iter_schema_diff(source_metadata, target_metadata, ddl_algorithm, online),
+                              source_default_character)
+        else:
+            layers, diff = diff_schema_layers(source_metadata, target_metadata, ddl_algorithm, sort_by_cost, online)
+            if layers and show_layers:
+                click.echo(format_diff_layers(layers, diff, source_default_character), file=output)
+            elif layers:
+                click.echo(format_diff(get_layer_sql(layers), diff, source_default_character), file=output)
+
+    except Exception as e:
+        click.secho('ERROR: %s' % e, fg='red', err=True)
+        sys.exit(1)
+    finally:
+        if timings is not None:
+            if show_timings:
+                click.echo(timings.summary(), err=True)
+            if timings_output is not None:
+                timings.write(timings_output, timings_format)
+        if source_backend is not None:
+            source_backend.close()
+        if target_backend is not None and target_backend is not source_backend:
+            target_backend.close()
+        if apply_pool is not None:
+            close_connection_pool(apply_pool)
+        for snapshot in snapshots:
+            snapshot.close()
+        if cache is not None:
+            cache.close()
+
+
+def get_col_default_null_able_info(column):
+    if column.is_nullable == 'NO':
+        if column.column_default is not None:
+            if column.data_type == 'timestamp':
+                null_able = " NOT NULL DEFAULT %s" % column.column_default
+            else:
+                null_able = " NOT NULL DEFAULT '%s'" % column.column_default
+        else:
+            null_able = " NOT NULL"
+    else:
+        if column.column_default is not None:
+            if column.data_type == 'timestamp':
+                null_able = " NULL DEFAULT %s" % column.column_default
+            else:
+                null_able = " DEFAULT '%s'" % column.column_default
+        else:
+            null_able = ' DEFAULT NULL'
+
+    return null_able
+
+
+def get_column_after(ordinal_position, column_pos):
+    pos = ordinal_position - 1
+    if pos in column_pos:
+        return "AFTER `%s`" % column_pos[pos].column_name
+    else:
+        return "FIRST"
+
+
+def get_add_keys(index):
+    columns_name = []
+    for column_name, sub_part in index.columns:
+        if sub_part is None:
+            sub_part = ''
+        else:
+            sub_part = '(%d)' % sub_part
+
+        if 'PRIMARY' == index.index_name:
+            columns_name.append("`{column_name}{sub_part}`".format(column_name=column_name, sub_part=sub_part))
+        else:
+            columns_name.append("`{column_name}`{sub_part}".format(column_name=column_name, sub_part=sub_part))
+
+    if 1 == index.non_unique:
+        return "KEY `{index_name}` ({columns_name})".format(index_name=index.index_name, columns_name=",".join(columns_name))
+    elif 'PRIMARY' == index.index_name:
+        return "PRIMARY KEY ({columns_name})".format(columns_name=",".join(columns_name))
+    else:
+        return "UNIQUE KEY `{index_name}` ({columns_name})".format(index_name=index.index_name,
+                                                                   columns_name=",".join(columns_name))
+
+
+def get_foreign_key_changes(source_foreign_keys, target_foreign_keys):
+    """
+    按约束名比较一张表两边的外键，返回 ForeignKeyChange 列表（先 DROP，再按 source 顺序 ADD / MODIFY）
+    """
+    source_foreign_key_dic = dict((foreign_key.constraint_name, foreign_key) for foreign_key in source_foreign_keys)
+    target_foreign_key_dic = dict((foreign_key.constraint_name, foreign_key) for foreign_key in target_foreign_keys)
+    changes = [ForeignKeyChange('DROP', constraint_name, None, foreign_key)
+               for constraint_name, foreign_key in target_foreign_key_dic.items()
+               if constraint_name not in source_foreign_key_dic]
+    for constraint_name, foreign_key in source_foreign_key_dic.items():
+        if constraint_name not in target_foreign_key_dic:
+            changes.append(ForeignKeyChange('ADD', constraint_name, foreign_key, None))
+        elif foreign_key != target_foreign_key_dic[constraint_name]:
+            changes.append(ForeignKeyChange('MODIFY', constraint_name, foreign_key, target_foreign_key_dic[constraint_name]))
+    return changes
+
+
+def get_foreign_key_definition(foreign_key):
+    """
+    外键定义，如 CONSTRAINT `fk` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE ON UPDATE RESTRICT
+    """
+    referenced_table = '`%s`' % foreign_key.referenced_table
+    if foreign_key.referenced_schema is not None:
+        referenced_table = '`%s`.%s' % (foreign_key.referenced_schema, referenced_table)
+    return "CONSTRAINT `{name}` FOREIGN KEY ({columns}) REFERENCES {table} ({referenced_columns}) " \
+           "ON DELETE {delete_rule} ON UPDATE {update_rule}".format(
+               name=foreign_key.constraint_name, columns=",".join("`%s`" % column for column in foreign_key.columns),
+               table=referenced_table,
+               referenced_columns=",".join("`%s`" % column for column in foreign_key.referenced_columns),
+               delete_rule=foreign_key.delete_rule, update_rule=foreign_key.update_rule)
+
+
+def get_foreign_key_statements(table_name, changes):
+    """
+    删除外键、新增外键的语句，返回 (删除语句列表, 新增语句列表)，各最多一条 ALTER；
+    MODIFY 拆到两条语句中，避免同名约束在一条 ALTER 中先删后加
+    """
+    drop_clauses = ["  DROP FOREIGN KEY `%s`" % change.constraint_name for change in changes
+                    if isinstance(change, ForeignKeyChange) and change.action in ('DROP', 'MODIFY')]
+    add_clauses = ["  ADD %s" % get_foreign_key_definition(change.source) for change in changes
+                   if isinstance(change, ForeignKeyChange) and change.action in ('ADD', 'MODIFY')]
+    drop_sql = ["ALTER TABLE `%s`\n%s;" % (table_name, ',\n'.join(drop_clauses))] if drop_clauses else []
+    add_sql = ["ALTER TABLE `%s`\n%s;" % (table_name, ',\n'.join(add_clauses))] if add_clauses else []
+    return drop_sql, add_sql
+
+
+def get_index_signature(index):
+    """
+    索引签名: (NON_UNIQUE, 有序的 (字段, 前缀长度), INDEX_TYPE)，不含索引名
+    """
+    return index.non_unique, index.columns, index.index_type
+
+
+def get_stable_columns(source_column_names, target_column_names):
+    """
+    两边都有的字段按 target 顺序排列，取它们在 source 中序号的最长递增子序列（O(n log n)）：
+    这些字段相对顺序已经正确，不需要移动，其余公共字段才需要 AFTER / FIRST
+    """
+    source_index = dict((column_name, index) for index, column_name in enumerate(source_column_names))
+    sequence = [column_name for column_name in target_column_names if column_name in source_index]
+
+    tails = []
+    tail_keys = []
+    previous = [None] * len(sequence)
+    for i, column_name in enumerate(sequence):
+        key = source_index[column_name]
+        k = bisect.bisect_left(tail_keys, key)
+        if k > 0:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_keys.append(key)
+        else:
+            tails[k] = i
+            tail_keys[k] = key
+
+    stable_columns = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        stable_columns.add(sequence[i])
+        i = previous[i]
+    return stable_columns
+
+
+def same_column_definition(source_column, target_column):
+    """
+    字段定义是否相同（不比较 ordinal_position，位置由 get_stable_columns() 处理）
+    """
+    return source_column._replace(ordinal_position=None) == target_column._replace(ordinal_position=None)
+
+
+def get_column_definition(column, default_character):
+    """
+    字段类型、字符集、NULL / DEFAULT 和 EXTRA 部分
+    """
+    character = extra = ''
+    if column.character_set_name is not None:
+        if column.character_set_name != default_character:
+            character = ' CHARACTER SET %s' % column.character_set_name
+    if column.extra != '':
+        extra = ' %s' % column.extra.upper()
+    return '{column_type}{character}{null_able}{extra}'.format(
+        column_type=column.column_type, character=character,
+        null_able=get_col_default_null_able_info(column), extra=extra)
+
+
+def parse_server_version(version):
+    """
+    VERSION() 的结果解析为 ServerVersion；未知时按 5.7 估计，
+    MariaDB 的 INSTANT 规则与 MySQL 不同，也按 5.7 保守估计，另外记下 MariaDB 自己的版本
+    """
+    match = re.match(r'(\d+)\.(\d+)\.(\d+)', version or '')
+    if match is None:
+        return ServerVersion(5, 7, 0, None)
+    if 'mariadb' in version.lower():
+        # 5.5.5-10.4.1-MariaDB：复制协议要求的 5.5.5- 前缀之后才是真实版本
+        match = re.match(r'(?:5\.5\.5-)?(\d+)\.(\d+)\.(\d+)', version)
+        return ServerVersion(5, 7, 0, tuple(int(part) for part in match.groups()))
+    return ServerVersion(*[int(part) for part in match.groups()], None)
+
+
+def has_rename_index(version):
+    """
+    目标库是否支持 RENAME INDEX：MySQL 5.7、MariaDB 10.5.2 起
+    """
+    if version.mariadb is not None:
+        return version.mariadb >= (10, 5, 2)
+    return version >= (5, 7, 0)
+
+
+def has_trigger_order(version):
+    """
+    目标库是否支持同一事件的多个触发器（FOLLOWS）：MySQL 5.7.2、MariaDB 10.2.3 起
+    """
+    if version.mariadb is not None:
+        return version.mariadb >= (10, 2, 3)
+    return version >= (5, 7, 2)
+
+
+def classify_column_change(action, source_column, target_column, version):
+    """
+    估计一个字段子句的执行方式，返回 (ALGORITHM, LOCK, 工作量)，工作量为 metadata / index / rebuild；
+    action: DROP / ADD (中间插入) / APPEND (追加在表尾) / MOVE (位置变化) / MODIFY
+    """
+    if action == 'DROP':
+        if version >= (8, 0, 29):
+            return 'INSTANT', 'NONE', 'metadata'
+        return 'INPLACE', 'NONE', 'rebuild'
+    if action in ('ADD', 'APPEND'):
+        if 'auto_increment' in source_column.extra.lower():
+            return 'INPLACE', 'SHARED', 'rebuild'
+        if version >= (8, 0, 29) or (action == 'APPEND' and version >= (8, 0, 12)):
+            return 'INSTANT', 'NONE', 'metadata'
+        return 'INPLACE', 'NONE', 'rebuild'
+
+    if (source_column.column_type != target_column.column_type
+            or source_column.character_set_name != target_column.character_set_name
+            or source_column.collation_name != target_column.collation_name):
+        # VARCHAR 加长且长度前缀字节数不变（都 < 256 或都 >= 256 字节）只改元数据，其余类型变化都要复制表
+        if (source_column.data_type == target_column.data_type == 'varchar'
+                and source_column.character_set_name == target_column.character_set_name
+                and source_column.collation_name == target_column.collation_name
+                and (target_column.character_octet_length or 0) <= (source_column.character_octet_length or 0)
+                and ((source_column.character_octet_length or 0) < 256) == ((target_column.character_octet_length or 0) < 256)):
+            return 'INPLACE', 'NONE', 'rebuild' if action == 'MOVE' else 'metadata'
+        return 'COPY', 'SHARED', 'rebuild'
+    if action == 'MOVE' or source_column.is_nullable != target_column.is_nullable \
+            or source_column.extra != target_column.extra:
+        return 'INPLACE', 'NONE', 'rebuild'
+    # 只有默认值不同
+    if version >= (8, 0, 0):
+        return 'INSTANT', 'NONE', 'metadata'
+    return 'INPLACE', 'NONE', 'metadata'
+
+
+def classify_index_change(action, index_name):
+    """
+    估计一个索引子句的执行方式，返回 (ALGORITHM, LOCK, 工作量)；
+    action: DROP / ADD / MODIFY (DROP + ADD) / RENAME；二级索引删除、改名只改元数据，新建要扫描全表，主键变化要重建表
+    """
+    if 'PRIMARY' == index_name:
+        if action == 'DROP':
+            # 只删主键不加新主键不能 INPLACE
+            return 'COPY', 'SHARED', 'rebuild'
+        return 'INPLACE', 'NONE', 'rebuild'
+    if action in ('ADD', 'MODIFY'):
+        return 'INPLACE', 'NONE', 'index'
+    return 'INPLACE', 'NONE', 'metadata'
+
+
+def get_alter_cost(alter_clauses, table_data, version):
+    """
+    合并一条 ALTER 全部子句的估计，返回 (ALGORITHM, LOCK, 估计代价)；
+    代价按需要读写的字节数估计：重建表为 DATA_LENGTH + INDEX_LENGTH，
+    不重建表时每新增一个二级索引扫描一遍 DATA_LENGTH，只改元数据为 0
+    """
+    algorithm = max((clause[0] for clause in alter_clauses), key=DDL_ALGORITHMS.index)
+    lock = max((clause[1] for clause in alter_clauses), key=DDL_LOCKS.index)
+    if version < (5, 6, 0):
+        algorithm, lock = 'COPY', 'SHARED'
+
+    data_length = table_data.data_length or 0
+    index_length = table_data.index_length or 0
+    works = [work for _, _, work in alter_clauses]
+    if algorithm == 'COPY' or 'rebuild' in works:
+        cost = data_length + index_length
+    else:
+        cost = data_length * works.count('index')
+    return algorithm, lock, cost
+
+
+def get_partition_scheme(partition):
+    """
+    分区方式和表达式，如 RANGE(TO_DAYS(`created`)) / RANGE COLUMNS(`created`) / LINEAR HASH(`id`)
+    """
+    return '%s(%s)' % (partition.partition_method, partition.partition_expression or '')
+
+
+def get_partition_size(partitions):
+    """
+    一组分区需要复制的字节数
+    """
+    return sum((partition.data_length or 0) + (partition.index_length or 0) for partition in partitions)
+
+
+def get_partition_changes(source_partitions, target_partitions, table_data):
+    """
+    比较一张表两边的分区，返回 PartitionChange 列表：
+    分区方式相同时只处理有差异的分区（RANGE / LIST 按分区名和 PARTITION_DESCRIPTION 比较，HASH / KEY 只比较分区数），
+    不重建整张表；分区方式不同或一边不分区时才整表重新分区
+    """
+    if not source_partitions and not target_partitions:
+        return []
+    target_names = tuple(partition.partition_name for partition in target_partitions)
+    table_size = (table_data.data_length or 0) + (table_data.index_length or 0)
+    if not source_partitions:
+        return [PartitionChange('REMOVE', target_names, (), None, table_size)]
+    source_keys = [(partition.partition_name, partition.partition_description) for partition in source_partitions]
+    target_keys = [(partition.partition_name, partition.partition_description) for partition in target_partitions]
+    if target_partitions and get_partition_scheme(source_partitions[0]) == get_partition_scheme(target_partitions[0]) \
+            and source_keys == target_keys:
+        return []
+    if source_partitions[0].subpartition_method or (target_partitions and target_partitions[0].subpartition_method):
+        # 子分区的方式和个数不在 PARTITION_FIELDS 中，无法生成完整的分区定义
+        return [PartitionChange('MANUAL', target_names, tuple(source_partitions), None, 0)]
+    if not target_partitions or get_partition_scheme(source_partitions[0]) != get_partition_scheme(target_partitions[0]):
+        return [PartitionChange('PARTITION', target_names, tuple(source_partitions), None, table_size)]
+
+    method = source_partitions[0].partition_method
+    if method.endswith('HASH') or method.endswith('KEY'):
+        # 分区名是自动生成的 p0, p1, ...，增减分区都要重新散列全部行
+        count = len(source_partitions) - len(target_partitions)
+        if count > 0:
+            return [PartitionChange('ADD', (), (), count, table_size)]
+        if count < 0:
+            return [PartitionChange('COALESCE', (), (), -count, table_size)]
+        return []
+    if method.startswith('LIST'):
+        return get_list_partition_changes(source_partitions, target_partitions)
+    changes = get_range_partition_changes(source_partitions, target_partitions)
+    if changes is None:
+        return [PartitionChange('PARTITION', target_names, tuple(source_partitions), None, table_size)]
+    return changes
+
+
+def get_range_partition_changes(source_partitions, target_partitions):
+    """
+    RANGE 分区：两边名字和上界都相同的分区不动，以它们为界分段处理其余分区：
+    开头多出的分区 DROP（按时间滚动删除旧分区），末尾多出的 ADD / DROP，
+    中间的差异只 REORGANIZE 这一段（范围不一致时连同下一个相同的分区一起，使重组前后覆盖的范围相同）；
+    末尾的范围缩小无法只靠分区操作完成时返回 None
+    """
+    target_keys = set((partition.partition_name, partition.partition_description) for partition in target_partitions)
+    source_keys = set((partition.partition_name, partition.partition_description) for partition in source_partitions)
+    # 两边都按上界排序，相同的分区在两边的先后顺序一致
+    anchors = [(i, j) for (i, source_partition), (j, target_partition) in zip(
+        [(i, partition) for i, partition in enumerate(source_partitions)
+         if (partition.partition_name, partition.partition_description) in target_keys],
+        [(j, partition) for j, partition in enumerate(target_partitions)
+         if (partition.partition_name, partition.partition_description) in source_keys])]
+
+    changes = []
+    source_start = target_start = 0
+    for source_end, target_end in anchors:
+        source_run = source_partitions[source_start:source_end]
+        target_run = target_partitions[target_start:target_end]
+        anchor = source_partitions[source_end]
+        if source_run or target_run:
+            if not source_run and target_start == 0:
+                changes.append(PartitionChange('DROP', tuple(partition.partition_name for partition in target_run),
+                                               (), None, 0))
+            elif source_run and target_run \
+                    and source_run[-1].partition_description == target_run[-1].partition_description:
+                changes.append(get_reorganize_change(source_run, target_run))
+            else:
+                changes.append(get_reorganize_change(source_run + [anchor], target_run + [target_partitions[target_end]]))
+        source_start, target_start = source_end + 1, target_end + 1
+
+    source_run = source_partitions[source_start:]
+    target_run = target_partitions[target_start:]
+    if source_run and not target_run:
+        changes.append(PartitionChange('ADD', (), tuple(source_run), None, 0))
+    elif target_run and not source_run:
+        changes.append(PartitionChange('DROP', tuple(partition.partition_name for partition in target_run), (), None, 0))
+    elif source_run and target_run:
+        # 重组最后几个分区时范围只能扩大
+        try:
+            if get_partition_bound(source_run[-1].partition_description) < \
+                    get_partition_bound(target_run[-1].partition_description):
+                return None
+        except (TypeError, decimal.InvalidOperation):
+            return None
+        changes.append(get_reorganize_change(source_run, target_run))
+    return changes
+
+
+def get_list_partition_changes(source_partitions, target_partitions):
+    """
+    LIST 分区：source 中没有、值也不在 source 有差异的分区中的 target 分区 DROP；
+    其余有差异的 target 分区 REORGANIZE 为 source 中有差异的分区，没有则只 ADD 新分区
+    """
+    target_keys = set((partition.partition_name, partition.partition_description) for partition in target_partitions)
+    source_keys = set((partition.partition_name, partition.partition_description) for partition in source_partitions)
+    source_names = set(partition.partition_name for partition in source_partitions)
+    source_run = [partition for partition in source_partitions
+                  if (partition.partition_name, partition.partition_description) not in target_keys]
+    target_run = [partition for partition in target_partitions
+                  if (partition.partition_name, partition.partition_description) not in source_keys]
+    source_values = set(value for partition in source_run
+                        for value in PARTITION_VALUE.findall(partition.partition_description or ''))
+
+    changes = []
+    dropped = [partition for partition in target_run if partition.partition_name not in source_names
+               and not source_values.intersection(PARTITION_VALUE.findall(partition.partition_description or ''))]
+    if dropped:
+        changes.append(PartitionChange('DROP', tuple(partition.partition_name for partition in dropped), (), None, 0))
+    target_run = [partition for partition in target_run if partition not in dropped]
+    if target_run:
+        changes.append(get_reorganize_change(source_run, target_run))
+    elif source_run:
+        changes.append(PartitionChange('ADD', (), tuple(source_run), None, 0))
+    return changes
+
+
+def get_reorganize_change(source_run, target_run):
+    """
+    REORGANIZE：只复制 target_run 这几个分区的行
+    """
+    return PartitionChange('REORGANIZE', tuple(partition.partition_name for partition in target_run), tuple(source_run),
+                           None, get_partition_size(target_run))
+
+
+def get_partition_bound(description):
+    """
+    RANGE 分区的上界（PARTITION_DESCRIPTION，如 738000 / '2024-01-01',10 / MAXVALUE）转为可以比较的元组
+    """
+    bound = []
+    for value in PARTITION_VALUE.findall(description):
+        if value.upper() == 'MAXVALUE':
+            bound.append((1, 0))
+        elif value.startswith("'"):
+            bound.append((0, value[1:-1]))
+        else:
+            bound.append((0, decimal.Decimal(value)))
+    return tuple(bound)
+
+
+def get_partition_definition(partition):
+    """
+    一个分区的定义，如 PARTITION `p202401` VALUES LESS THAN (739282)
+    """
+    method = partition.partition_method
+    if method.startswith('RANGE'):
+        # RANGE COLUMNS 的 MAXVALUE 也要写在括号里
+        if partition.partition_description == 'MAXVALUE' and method == 'RANGE':
+            return "PARTITION `%s` VALUES LESS THAN MAXVALUE" % partition.partition_name
+        return "PARTITION `%s` VALUES LESS THAN (%s)" % (partition.partition_name, partition.partition_description)
+    if method.startswith('LIST'):
+        return "PARTITION `%s` VALUES IN (%s)" % (partition.partition_name, partition.partition_description)
+    return "PARTITION `%s`" % partition.partition_name
+
+
+def get_partition_clause(partitions):
+    """
+    按 partitions 整表分区的 PARTITION BY 子句
+    """
+    method = partitions[0].partition_method
+    if method.endswith('HASH') or method.endswith('KEY'):
+        return "PARTITION BY %s PARTITIONS %d" % (get_partition_scheme(partitions[0]), len(partitions))
+    return "PARTITION BY %s\n(%s)" % (get_partition_scheme(partitions[0]),
+                                      ',\n '.join(get_partition_definition(partition) for partition in partitions))
+
+
+def get_partition_statement(table_name, change):
+    """
+    一个分区变更的 ALTER 语句；MANUAL 只报告，返回 None
+    """
+    if change.action == 'ADD' and not change.partitions:
+        return "ALTER TABLE `%s` ADD PARTITION PARTITIONS %d;" % (table_name, change.count)
+    if change.action == 'ADD':
+        return "ALTER TABLE `%s` ADD PARTITION (\n  %s\n);" % (
+            table_name, ',\n  '.join(get_partition_definition(partition) for partition in change.partitions))
+    if change.action == 'DROP':
+        return "ALTER TABLE `%s` DROP PARTITION %s;" % (
+            table_name, ', '.join('`%s`' % partition_name for partition_name in change.partition_names))
+    if change.action == 'REORGANIZE':
+        return "ALTER TABLE `%s` REORGANIZE PARTITION %s INTO (\n  %s\n);" % (
+            table_name, ', '.join('`%s`' % partition_name for partition_name in change.partition_names),
+            ',\n  '.join(get_partition_definition(partition) for partition in change.partitions))
+    if change.action == 'COALESCE':
+        return "ALTER TABLE `%s` COALESCE PARTITION %d;" % (table_name, change.count)
+    if change.action == 'PARTITION':
+        return "ALTER TABLE `%s` %s;" % (table_name, get_partition_clause(change.partitions))
+    if change.action == 'REMOVE':
+        return "ALTER TABLE `%s` REMOVE PARTITIONING;" % table_name
+    return None
+
+
+def is_online_table(table_data, online):
+    """
+    表是否达到 online 阈值
+    """
+    if online is None:
+        return False
+    return ((online.min_size is not None and (table_data.data_length or 0) >= online.min_size)
+            or (online.min_rows is not None and (table_data.table_rows or 0) >= online.min_rows))
+
+
+def get_online_key(target_statistics, target_columns, source_columns):
+    """
+    在线变更按主键范围分批复制：目标表主键须为单个 AUTO_INCREMENT 整数字段，且变更后仍然存在；返回字段名，否则 None
+    """
+    primary = target_statistics.get('PRIMARY')
+    if primary is None or len(primary.columns) != 1:
+        return None
+    column_name, sub_part = primary.columns[0]
+    if column_name not in source_columns or target_columns[column_name].data_type not in INTEGER_TYPES \
+            or 'auto_increment' not in (target_columns[column_name].extra or '').lower():
+        return None
+    return column_name
+
+
+def get_online_prefix(table_name):
+    """
+    在线变更的影子表、旧表和触发器名的前缀：最长的 _<前缀>_osc_upd_old 不能超过 64 个字符，
+    表名太长时截断并加上表名摘要，使不同的表不会冲突
+    """
+    if len(table_name) <= ONLINE_PREFIX_LENGTH:
+        return table_name
+    digest = hashlib.md5(table_name.encode('utf-8')).hexdigest()[:8]
+    return '%s_%s' % (table_name[:ONLINE_PREFIX_LENGTH - len(digest) - 1], digest)
+
+
+def get_online_plan(table_name, table_data, alter_columns, key_name, copy_columns, chunk_size):
+    """
+    生成在线变更计划：
+    1. 建影子表并在影子表上执行 ALTER；
+    2. 原表加 INSERT / UPDATE / DELETE 触发器，把变更同步到影子表；UPDATE 可能修改主键，
+       先由一个触发器删除影子表中的旧主键，再由 FOLLOWS 它的触发器 REPLACE 新行（需要 MySQL 5.7.2、MariaDB 10.2.3 及以上）；
+    3. 按主键范围 INSERT IGNORE ... SELECT 分批复制到 AUTO_INCREMENT，每批约 chunk_size 字节，
+       每批可重复执行，中断后从失败的一批继续即可；
+    4. RENAME TABLE 原子切换，删除触发器和旧表；
+    返回 (语句列表, 复制批数)
+    """
+    prefix = get_online_prefix(table_name)
+    new_table = '_%s_new' % prefix
+    old_table = '_%s_old' % prefix
+    triggers = ['_%s_osc_%s' % (prefix, event) for event in ('ins', 'upd_old', 'upd', 'del')]
+    columns = ', '.join('`%s`' % column_name for column_name in copy_columns)
+    new_values = ', '.join('NEW.`%s`' % column_name for column_name in copy_columns)
+
+    online_sql = [
+        "CREATE TABLE `%s` LIKE `%s`;" % (new_table, table_name),
+        "ALTER TABLE `%s`\n%s;" % (new_table, ',\n'.join(alter_columns)),
+        "CREATE TRIGGER `%s` AFTER INSERT ON `%s` FOR EACH ROW REPLACE INTO `%s` (%s) VALUES (%s);" %
+        (triggers[0], table_name, new_table, columns, new_values),
+        "CREATE TRIGGER `%s` AFTER UPDATE ON `%s` FOR EACH ROW DELETE IGNORE FROM `%s` WHERE `%s` = OLD.`%s` "
+        "AND OLD.`%s` <> NEW.`%s`;" % (triggers[1], table_name, new_table, key_name, key_name, key_name, key_name),
+        "CREATE TRIGGER `%s` AFTER UPDATE ON `%s` FOR EACH ROW FOLLOWS `%s` REPLACE INTO `%s` (%s) VALUES (%s);" %
+        (triggers[2], table_name, triggers[1], new_table, columns, new_values),
+        "CREATE TRIGGER `%s` AFTER DELETE ON `%s` FOR EACH ROW DELETE IGNORE FROM `%s` WHERE `%s` = OLD.`%s`;" %
+        (triggers[3], table_name, new_table, key_name, key_name),
+    ]
+
+    # 每批行数按平均行长换算；主键稀疏时按 AUTO_INCREMENT / TABLE_ROWS 放大范围，使每批行数接近；
+    # 调用方保证 TABLE_ROWS / AVG_ROW_LENGTH 都有值，否则范围会扩大到整张表
+    chunk_rows = max(1, chunk_size // table_data.avg_row_length)
+    step = max(1, chunk_rows * table_data.auto_increment // table_data.table_rows)
+    copy = "INSERT IGNORE INTO `%s` (%s) SELECT %s FROM `%s`%%s LOCK IN SHARE MODE;" % (new_table, columns, columns, table_name)
+    bounds = list(range(step, table_data.auto_increment, step))
+    if not bounds:
+        online_sql.append(copy % '')
+    else:
+        online_sql.append(copy % (" WHERE `%s` < %d" % (key_name, bounds[0])))
+        for lower, upper in zip(bounds, bounds[1:]):
+            online_sql.append(copy % (" WHERE `%s` >= %d AND `%s` < %d" % (key_name, lower, key_name, upper)))
+        online_sql.append(copy % (" WHERE `%s` >= %d" % (key_name, bounds[-1])))
+
+    online_sql.append("RENAME TABLE `%s` TO `%s`, `%s` TO `%s`;" % (table_name, old_table, new_table, table_name))
+    for trigger in triggers:
+        online_sql.append("DROP TRIGGER IF EXISTS `%s`;" % trigger)
+    online_sql.append("DROP TABLE IF EXISTS `%s`;" % old_table)
+    return online_sql, len(bounds) + 1
+
+
+def format_size(size):
+    """
+    字节数转为便于阅读的 B / KB / MB / GB / TB
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '%d %s' % (size, unit) if unit == 'B' else '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TB' % size
+
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     mysqldiff(obj={})
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+sqldiff 的单元测试：全部基于 MemoryBackend，不需要 MySQL 服务器
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import sqldiff
+
+
+def table_row(table_name, table_rows=10, data_length=16384, avg_row_length=None, auto_increment=None):
+    return {'TABLE_NAME': table_name, 'ENGINE': 'InnoDB', 'TABLE_COLLATION': 'utf8mb4_general_ci',
+            'TABLE_ROWS': table_rows, 'DATA_LENGTH': data_length, 'INDEX_LENGTH': 0,
+            'AVG_ROW_LENGTH': avg_row_length, 'AUTO_INCREMENT': auto_increment}
+
+
+def column_rows(table_name, columns):
+    """
+    columns 为 [(字段名, 字段类型)] 或 [(字段名, 字段类型, EXTRA)]
+    """
+    rows = []
+    for position, column in enumerate(columns, 1):
+        column_name, column_type = column[:2]
+        rows.append({'TABLE_NAME': table_name, 'COLUMN_NAME': column_name, 'ORDINAL_POSITION': position,
+                     'IS_NULLABLE': 'NO', 'DATA_TYPE': column_type.split('(')[0], 'COLUMN_TYPE': column_type,
+                     'EXTRA': column[2] if len(column) > 2 else ''})
+    return rows
+
+
+def index_rows(table_name, index_name, column_names, non_unique=1):
+    return [{'TABLE_NAME': table_name, 'NON_UNIQUE': non_unique, 'INDEX_NAME': index_name, 'SEQ_IN_INDEX': seq,
+             'COLUMN_NAME': column_name, 'INDEX_TYPE': 'BTREE'} for seq, column_name in enumerate(column_names, 1)]
+
+
+def foreign_key_rows(table_name, constraint_name, column_name, referenced_table, referenced_column, database):
+    return [{'TABLE_NAME': table_name, 'CONSTRAINT_NAME': constraint_name, 'ORDINAL_POSITION': 1,
+             'COLUMN_NAME': column_name, 'REFERENCED_TABLE_SCHEMA': database, 'REFERENCED_TABLE_NAME': referenced_table,
+             'REFERENCED_COLUMN_NAME': referenced_column, 'UPDATE_RULE': 'RESTRICT', 'DELETE_RULE': 'RESTRICT'}]
+
+
+def partition_rows(table_name, method, expression, definitions):
+    return [{'TABLE_NAME': table_name, 'PARTITION_NAME': partition_name, 'PARTITION_ORDINAL_POSITION': position,
+             'PARTITION_METHOD': method, 'PARTITION_EXPRESSION': expression, 'PARTITION_DESCRIPTION': description,
+             'TABLE_ROWS': 100, 'DATA_LENGTH': 1024 ** 3, 'INDEX_LENGTH': 0}
+            for position, (partition_name, description) in enumerate(definitions, 1)]
+
+
+def make_schema(tables, statistics=(), partitions=(), foreign_keys=()):
+    """
+    tables 为 {表名: 字段列表} 或 {表名: (字段列表, TABLES 行的参数)}
+    """
+    schema = {'charset': 'utf8mb4', 'tables': [], 'columns': [], 'statistics': list(statistics),
+              'partitions': list(partitions), 'foreign_keys': list(foreign_keys)}
+    for table_name, columns in tables.items():
+        options = {}
+        if isinstance(columns, tuple):
+            columns, options = columns
+        schema['tables'].append(table_row(table_name, **options))
+        schema['columns'] += column_rows(table_name, columns)
+    return schema
+
+
+def fetch(source, target, version='8.0.32', name_filter=None):
+    """
+    source / target 分别放在两个 MemoryBackend 中（target 的版本为 version），返回两边的元数据
+    """
+    sides = [(sqldiff.MemoryBackend({'s': source}), 's'), (sqldiff.MemoryBackend({'t': target}, version), 't')]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return sqldiff.fetch_metadata(executor, sides, name_filter=name_filter)
+
+
+def diff(source, target, version='8.0.32', **kwargs):
+    """
+    返回 {表名: (diff_sql, diff)}
+    """
+    source_metadata, target_metadata = fetch(source, target, version)
+    return dict((table_name, (diff_sql, table_diff)) for table_name, diff_sql, table_diff, _
+                in sqldiff.iter_schema_diff(source_metadata, target_metadata, **kwargs))
+
+
+def test_paged_diff_matches_full_diff():
+    source = make_schema(dict(('t%02d' % i, [('id', 'int(11)'), ('v', 'int(11)' if i % 4 else 'bigint(20)')])
+                              for i in range(0, 30, 2)))
+    target = make_schema(dict(('t%02d' % i, [('id', 'int(11)'), ('v', 'int(11)')]) for i in range(0, 30, 3)))
+    source_metadata, target_metadata = fetch(source, target)
+    full = list(sqldiff.iter_schema_diff(source_metadata, target_metadata))
+    assert full
+    backend = sqldiff.MemoryBackend({'s': source, 't': target})
+    for page_size in (1, 4, 100):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            _, source_pages = sqldiff.open_metadata_pages(executor, backend, 's', page_size)
+            target_header, target_pages = sqldiff.open_metadata_pages(executor, backend, 't', page_size)
+            paged = list(sqldiff.iter_render_changes(
+                sqldiff.iter_merge_schema_changes(source_pages, target_header, target_pages), 'utf8mb4'))
+        assert sorted(paged) == sorted(full)
+        # 归并连接按表名顺序产出，DROP / CREATE / ALTER 交错
+        assert [table_name for table_name, _, _, _ in paged] == sorted(table_name for table_name, _, _, _ in full)
+
+
+def test_stable_columns_are_longest_increasing_subsequence():
+    assert sqldiff.get_stable_columns(['a', 'b', 'c', 'd', 'e'], ['b', 'c', 'd', 'e', 'a']) == {'b', 'c', 'd', 'e'}
+    assert sqldiff.get_stable_columns(['a', 'b', 'c'], ['c', 'b', 'a']) in ({'a'}, {'b'}, {'c'})
+    assert sqldiff.get_stable_columns(['a', 'b'], ['x', 'y']) == set()
+
+
+def test_column_reorder_moves_only_unstable_columns():
+    columns = ['a', 'b', 'c', 'd', 'e']
+    source = make_schema({'x': [(column_name, 'int(11)') for column_name in columns]})
+    target = make_schema({'x': [(column_name, 'int(11)') for column_name in columns[-1:] + columns[:-1]]})
+    assert diff(source, target)['x'][0] == ["ALTER TABLE `x`\n  MODIFY COLUMN `e` int(11) NOT NULL AFTER `d`;"]
+
+    source = make_schema({'x': [(column_name, 'int(11)') for column_name in ('a', 'b', 'n', 'c', 'd')]})
+    target = make_schema({'x': [(column_name, 'int(11)') for column_name in ('b', 'c', 'a', 'd', 'z')]})
+    assert diff(source, target)['x'][0] == ["ALTER TABLE `x`\n"
+                                            "  DROP COLUMN `z`,\n"
+                                            "  MODIFY COLUMN `a` int(11) NOT NULL FIRST,\n"
+                                            "  ADD COLUMN `n` int(11) NOT NULL AFTER `b`;"]
+
+
+def test_partition_changes_touch_only_changed_partitions():
+    columns = [('id', 'int(11)')]
+    tables = dict((table_name, columns) for table_name in ('r', 'h', 'l', 'n'))
+    source = make_schema(tables, partitions=partition_rows('r', 'RANGE', '`id`', [('p20', '20'), ('p30', '30'), ('p40', '40')])
+                         + partition_rows('h', 'HASH', '`id`', [('p%d' % i, None) for i in range(8)])
+                         + partition_rows('l', 'LIST', '`id`', [('pa', '1,2'), ('pb', '3')])
+                         + partition_rows('n', 'RANGE', '`id`', [('p10', '10'), ('p20', '20')]))
+    target = make_schema(tables, partitions=partition_rows('r', 'RANGE', '`id`', [('p10', '10'), ('p20', '20'), ('p30', '30')])
+                         + partition_rows('h', 'HASH', '`id`', [('p%d' % i, None) for i in range(4)])
+                         + partition_rows('l', 'LIST', '`id`', [('pa', '1,2'), ('pb', '3,4')]))
+    table_diffs = diff(source, target)
+    assert table_diffs['r'][0] == ["ALTER TABLE `r` DROP PARTITION `p10`;",
+                                   "ALTER TABLE `r` ADD PARTITION (\n  PARTITION `p40` VALUES LESS THAN (40)\n);"]
+    assert table_diffs['h'][0] == ["ALTER TABLE `h` ADD PARTITION PARTITIONS 4;"]
+    assert table_diffs['l'][0] == ["ALTER TABLE `l` REORGANIZE PARTITION `pb` INTO (\n  PARTITION `pb` VALUES IN (3)\n);"]
+    # target 不分区时才整表重新分区
+    assert table_diffs['n'][0] == ["ALTER TABLE `n` PARTITION BY RANGE(`id`)\n"
+                                   "(PARTITION `p10` VALUES LESS THAN (10),\n"
+                                   " PARTITION `p20` VALUES LESS THAN (20));"]
+
+
+def test_same_partitions_have_no_changes():
+    source = make_schema({'r': [('id', 'int(11)')]}, partitions=partition_rows('r', 'RANGE', '`id`', [('p10', '10')]))
+    assert diff(source, source) == {}
+
+
+def test_foreign_key_layers_order_drops_and_adds():
+    columns = [('id', 'int(11)'), ('pid', 'int(11)')]
+    source = make_schema({'np': columns, 'nc': columns, 'p': columns},
+                         foreign_keys=foreign_key_rows('nc', 'fk_nc', 'pid', 'np', 'id', 's'))
+    target = make_schema({'op': columns, 'oc': columns, 'p': columns},
+                         foreign_keys=foreign_key_rows('oc', 'fk_oc', 'pid', 'op', 'id', 't'))
+    layers, _ = sqldiff.diff_schema_layers(*fetch(source, target))
+    groups = [[(table_name, diff_sql[0].split('\n')[-1]) for table_name, diff_sql, _ in layer] for layer in layers]
+    assert len(groups) == 2
+    # 先删除外键再删除被引用的表，先建被引用的表再新增外键；同一层内没有依赖
+    assert ('oc', '  DROP FOREIGN KEY `fk_oc`;') in groups[0]
+    assert ('op', 'DROP TABLE IF EXISTS `op`;') in groups[1]
+    assert [table_name for table_name, _ in groups[0]].count('np') == 1
+    assert ('nc', '  ADD CONSTRAINT `fk_nc` FOREIGN KEY (`pid`) REFERENCES `np` (`id`) '
+                  'ON DELETE RESTRICT ON UPDATE RESTRICT;') in groups[1]
+    assert sqldiff.get_layer_sql(layers)[0] == "ALTER TABLE `oc`\n  DROP FOREIGN KEY `fk_oc`;"
+
+
+def test_name_filter_predicate_pushes_down_names_globs_and_portable_regex():
+    name_filter = sqldiff.make_table_filter(include=['users', 'order_*', 're:^log_[0-9]+$'], exclude=['tmp_?', 'skip'])
+    assert sqldiff.get_name_filter_predicate(name_filter) == (
+        " AND (`TABLE_NAME` IN (%s) OR `TABLE_NAME` LIKE %s OR `TABLE_NAME` REGEXP %s)"
+        " AND CAST(`TABLE_NAME` AS BINARY) NOT IN (%s) AND CAST(`TABLE_NAME` AS BINARY) NOT LIKE %s",
+        ('users', 'order\\_%', '^log_[0-9]+$', 'skip', 'tmp\\__'))
+    # \d 在 MySQL 5.7 的 REGEXP 中含义不同，include 整体只在本地检查；排除用的正则总是在本地检查
+    name_filter = sqldiff.make_table_filter(include=['users', 're:^a\\d+$'], exclude=['re:x'])
+    assert sqldiff.get_name_filter_predicate(name_filter) == ('', ())
+    assert sqldiff.get_name_filter_predicate(None) == ('', ())
+
+
+def test_portable_regex():
+    for pattern in ('^log_[0-9]+$', 'a(b|c){2,3}$', 'a\\.b'):
+        assert sqldiff.is_portable_regex(pattern), pattern
+    for pattern in ('\\d', '(?i)a', 'a*?', '[[:alpha:]]', 'a{300}', '(a', 'a|'):
+        assert not sqldiff.is_portable_regex(pattern), pattern
+
+
+def test_name_filter_limits_both_sides():
+    columns = [('id', 'int(11)')]
+    source = make_schema({'users': columns, 'order_1': columns, 'tmp_1': columns})
+    target = make_schema({'legacy': columns, 'tmp_2': columns})
+    name_filter = sqldiff.make_table_filter(include=['users', 'order_*', 'legacy', 'tmp_*'], exclude=['tmp_?'])
+    source_metadata, target_metadata = fetch(source, target, name_filter=name_filter)
+    assert sorted(source_metadata['tables']) == ['order_1', 'users']
+    assert sorted(target_metadata['tables']) == ['legacy']
+    assert sorted(table_name for table_name, _, _, _ in sqldiff.iter_schema_diff(source_metadata, target_metadata)) \
+        == ['legacy', 'order_1', 'users']
+
+
+def test_parse_server_version():
+    assert sqldiff.parse_server_version('8.0.32') == sqldiff.ServerVersion(8, 0, 32, None)
+    assert sqldiff.parse_server_version('5.7.44-log') == sqldiff.ServerVersion(5, 7, 44, None)
+    # MariaDB 按 5.7 估计，真实版本另外记下；5.5.5- 为复制协议要求的前缀
+    assert sqldiff.parse_server_version('5.5.5-10.4.1-MariaDB') == sqldiff.ServerVersion(5, 7, 0, (10, 4, 1))
+    assert sqldiff.parse_server_version('10.6.12-MariaDB-log') == sqldiff.ServerVersion(5, 7, 0, (10, 6, 12))
+    assert sqldiff.parse_server_version(None) == sqldiff.ServerVersion(5, 7, 0, None)
+
+
+def test_rename_index_falls_back_on_old_servers():
+    columns = [('id', 'int(11)'), ('v', 'int(11)')]
+    source = make_schema({'x': columns}, statistics=index_rows('x', 'idx_new', ['v']))
+    target = make_schema({'x': columns}, statistics=index_rows('x', 'idx_old', ['v']))
+    rename_sql = ["ALTER TABLE `x`\n  RENAME INDEX `idx_old` TO `idx_new`,\n  ALGORITHM=INPLACE, LOCK=NONE;"]
+    fallback_sql = ["ALTER TABLE `x`\n  DROP INDEX `idx_old`,\n  ADD KEY `idx_new` (`v`),\n  ALGORITHM=INPLACE, LOCK=NONE;"]
+    for version, expected_sql in (('8.0.32', rename_sql), ('5.7.44', rename_sql), ('5.6.51', fallback_sql),
+                                  ('10.6.12-MariaDB', rename_sql), ('5.5.5-10.4.1-MariaDB', fallback_sql)):
+        diff_sql, table_diff = diff(source, target, version, ddl_algorithm=True)['x']
+        assert diff_sql == expected_sql, version
+        # 代价估计与生成的语句一致：RENAME 只改元数据，DROP + ADD 要重建索引
+        assert table_diff[-1].endswith('estimated cost %s (10 rows)' % ('0 B' if expected_sql is rename_sql else '16.0 KB'))
+
+
+def test_algorithm_clause_follows_target_version():
+    source = make_schema({'x': [('id', 'int(11)'), ('v', 'int(11)'), ('w', 'int(11)')]})
+    target = make_schema({'x': [('id', 'int(11)'), ('v', 'int(11)')]})
+    add_column = "ALTER TABLE `x`\n  ADD COLUMN `w` int(11) NOT NULL AFTER `v`"
+    for version, clause, note in (('8.0.32', ',\n  ALGORITHM=INSTANT, LOCK=DEFAULT', 'INSTANT LOCK is NONE, estimated cost 0 B'),
+                                  ('8.0.10', ',\n  ALGORITHM=INPLACE, LOCK=NONE', 'INPLACE LOCK is NONE, estimated cost 16.0 KB'),
+                                  ('5.6.51', ',\n  ALGORITHM=INPLACE, LOCK=NONE', 'INPLACE LOCK is NONE, estimated cost 16.0 KB'),
+                                  # 5.6 之前没有 ALGORITHM / LOCK 子句
+                                  ('5.5.62', '', 'COPY LOCK is SHARED, estimated cost 16.0 KB')):
+        diff_sql, table_diff = diff(source, target, version, ddl_algorithm=True)['x']
+        assert diff_sql == [add_column + clause + ';'], version
+        assert table_diff[-1] == 'TABLE: x ALTER ALGORITHM is %s (10 rows)' % note, version
+
+
+def online_diff(table_name='big', extra='auto_increment', table_rows=1000, avg_row_length=100, version='8.0.32'):
+    """
+    一张 1 MB 的大表把 v 改为 bigint，按 min_size 生成在线变更计划，每批约 30000 字节
+    """
+    options = dict(table_rows=table_rows, avg_row_length=avg_row_length, auto_increment=1001, data_length=1024 * 1024)
+    target = make_schema({table_name: ([('id', 'int(11)', extra), ('v', 'int(11)')], options)},
+                         statistics=index_rows(table_name, 'PRIMARY', ['id'], 0))
+    source = make_schema({table_name: [('id', 'int(11)', extra), ('v', 'bigint(20)')]},
+                         statistics=index_rows(table_name, 'PRIMARY', ['id'], 0))
+    return diff(source, target, version, online=sqldiff.OnlineOptions(1024, None, 30000))[table_name]
+
+
+def test_online_plan_copies_in_primary_key_chunks():
+    diff_sql, table_diff = online_diff()
+    assert table_diff[-1] == 'TABLE: big is large, need online schema change by PRIMARY KEY `id` in 4 chunks'
+    assert diff_sql[:2] == ["CREATE TABLE `_big_new` LIKE `big`;", "ALTER TABLE `_big_new`\n  MODIFY COLUMN `v` bigint(20) NOT NULL;"]
+    copies = [sql for sql in diff_sql if sql.startswith('INSERT IGNORE')]
+    assert [copy.split(' FROM `big`')[1] for copy in copies] == [
+        " WHERE `id` < 300 LOCK IN SHARE MODE;", " WHERE `id` >= 300 AND `id` < 600 LOCK IN SHARE MODE;",
+        " WHERE `id` >= 600 AND `id` < 900 LOCK IN SHARE MODE;", " WHERE `id` >= 900 LOCK IN SHARE MODE;"]
+    assert diff_sql[-1] == "DROP TABLE IF EXISTS `_big_old`;"
+
+
+def test_online_plan_identifiers_fit_64_characters():
+    table_name = 't' * 60
+    diff_sql, _ = online_diff(table_name)
+    identifiers = set(re.findall(r'`([^`]+)`', '\n'.join(diff_sql))) - {table_name, 'id', 'v'}
+    assert len(identifiers) == 6
+    assert all(len(identifier) <= 64 for identifier in identifiers)
+    # 截断的前缀带表名摘要，前 60 个字符相同的两张表不会冲突
+    assert sqldiff.get_online_prefix(table_name) != sqldiff.get_online_prefix(table_name[:-1] + 'u')
+    assert sqldiff.get_online_prefix('big') == 'big'
+
+
+def test_online_plan_refused_without_row_stats():
+    for table_rows, avg_row_length in ((0, 100), (None, 100), (1000, None), (1000, 0)):
+        diff_sql, table_diff = online_diff(table_rows=table_rows, avg_row_length=avg_row_length)
+        assert table_diff[-1] == 'TABLE: big is large but TABLE_ROWS / AVG_ROW_LENGTH are missing, keep direct ALTER'
+        assert diff_sql == ["ALTER TABLE `big`\n  MODIFY COLUMN `v` bigint(20) NOT NULL;"]
+
+
+def test_online_plan_needs_auto_increment_primary_key():
+    diff_sql, table_diff = online_diff(extra='')
+    assert table_diff[-1] == 'TABLE: big is large but PRIMARY KEY is not a single integer AUTO_INCREMENT column, ' \
+                             'keep direct ALTER'
+    assert len(diff_sql) == 1
+
+
+def test_online_plan_needs_trigger_order():
+    _, table_diff = online_diff(version='5.6.51')
+    assert table_diff[-1] == 'TABLE: big is large but online schema change needs MySQL 5.7.2 or MariaDB 10.2.3 or later, ' \
+                             'keep direct ALTER'
+    _, table_diff = online_diff(version='10.4.1-MariaDB')
+    assert table_diff[-1].endswith('in 4 chunks')
+
+
+def test_refresh_tables_updates_referenced_tables():
+    columns = [('id', 'int(11)'), ('pid', 'int(11)')]
+    schema = make_schema({'p': columns, 'q': columns, 'c1': columns, 'c2': columns},
+                         foreign_keys=foreign_key_rows('c1', 'fk_c1', 'pid', 'p', 'id', 't')
+                         + foreign_key_rows('c2', 'fk_c2', 'pid', 'p', 'id', 't'))
+    backend = sqldiff.MemoryBackend({'t': schema})
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        metadata, = sqldiff.fetch_metadata(executor, [(backend, 't')])
+    metadata['referenced_tables'] = sqldiff.get_referenced_tables(metadata['foreign_keys'])
+    assert metadata['referenced_tables'] == {'p': {'c1', 'c2'}}
+
+    # c1 的外键删除，c2 的外键改为引用 q
+    schema['foreign_keys'] = foreign_key_rows('c2', 'fk_c2', 'pid', 'q', 'id', 't')
+    sqldiff.refresh_tables(backend, 't', metadata, ['c1', 'c2'])
+    assert dict((table_name, child_tables) for table_name, child_tables in metadata['referenced_tables'].items()
+                if child_tables) == sqldiff.get_referenced_tables(metadata['foreign_keys']) == {'q': {'c2'}}